@@ -0,0 +1,502 @@
+#!/usr/bin/python3
+"""
+Benchmark of the XLSX → ODM converter on synthetic metadata. 60 % of the
+variables (--dce-rate) fall into 3 DCEs (--dces) that share their HIERARCHY
+paths, so from 100000 variables on their Study Events are bigger than the
+split limit and are split (in sort_all_lines_and_columns); a Study Event
+still bigger than the limit afterwards counts as regression.
+
+Every phase of a conversion is timed and its memory is measured:
+pd.read_excel (read_sheets), sort_all_lines_and_columns (ingest_metadata),
+compute_final_ref_map, calculate_itemdef, emit_union_codelists and the
+serialization of the ODM files. Every ODM file is written once more by
+write_odm with the lxml emitter (phase lxml_emitter) and with the template
+emitter (phase template_emitter, must produce the same bytes), so the items
+per second of both emitters can be compared. The alias profiles essential,
+none and essential with --group-aliases are written by write_odm as well
+(phases aliases_<profile>), their sizes are compared with the full profile
+(the lxml_emitter phase). With the pandas reader the workbook is also read
+through the Parquet sidecar cache (phases fill_cache and read_cache), the
+cached sheets must have the same values of the same Python types. Memory is
+the growth of the peak RSS during the phase (including lxml), with
+--tracemalloc also the traced Python peak (much slower). Every size runs in its own process, so the RSS belongs to
+that size alone. The startup (import of the converter and --help) is
+measured in fresh interpreters and compared like the phases.
+
+$ python3 benchmarks/benchmark.py --sizes 1000 10000 --save-baseline
+$ python3 benchmarks/benchmark.py --sizes 1000 10000 --compare
+"""
+import argparse
+import io
+import json
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import dataquieR2ODM as converter  # noqa: E402
+from synthetic_metadata import SyntheticShape, generate_sheets, write_workbook  # noqa: E402
+
+DEFAULT_SIZES = [1000, 10000, 100000, 500000]
+DEFAULT_BASELINE = Path(__file__).resolve().parent / "baselines" / "baseline.json"
+# fixed, so the serialized files do not depend on the time of the run
+CREATION_DATETIME = "2024-01-01T00:00:00"
+# alias profiles measured besides full: (alias_profile, group_aliases)
+ALIAS_PROFILES = {
+    "essential": ("essential", False),
+    "none": ("none", False),
+    "essential_grouped": ("essential", True),
+}
+
+
+def _max_rss():
+    # ru_maxrss is in KiB on Linux, in bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+"""
+PhaseTimer sums the wall time and keeps the peak memory per phase.
+"""
+class PhaseTimer:
+    def __init__(self, trace=False):
+        """
+        :param trace: Also trace the Python peak memory with tracemalloc (bool)
+        """
+        self.trace = trace
+        self.phases = {}
+
+    @contextmanager
+    def phase(self, name):
+        if self.trace:
+            tracemalloc.reset_peak()
+            start_memory = tracemalloc.get_traced_memory()[0]
+        start_rss = _max_rss()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            entry = self.phases.setdefault(
+                name, {"seconds": 0.0, "rss_growth_bytes": 0, "peak_bytes": 0, "calls": 0}
+            )
+            entry["seconds"] += seconds
+            entry["calls"] += 1
+            entry["rss_growth_bytes"] += _max_rss() - start_rss
+            if self.trace:
+                peak = tracemalloc.get_traced_memory()[1] - start_memory
+                entry["peak_bytes"] = max(entry["peak_bytes"], peak)
+
+
+"""
+Whether a sheet read through the cache has the same columns and values of the
+same Python types as the workbook (1 and "1" are different VAR_NAMES).
+"""
+def _same_sheet(df, cached):
+    if cached is None or list(df.columns) != list(cached.columns):
+        return False
+    if [type(column) for column in df.columns] != [type(column) for column in cached.columns]:
+        return False
+    for column in df.columns:
+        values, cached_values = df[column], cached[column]
+        if not values.equals(cached_values):
+            return False
+        if [type(value) for value in values.tolist()] != [
+            type(value) for value in cached_values.tolist()
+        ]:
+            return False
+    return True
+
+
+"""
+Convert synthetic metadata of one shape phase by phase.
+"""
+def run_benchmark(
+    shape, trace=False, engine=None, in_memory=False, pretty_print=True, reader="pandas"
+):
+    if trace:
+        tracemalloc.start()
+    timer = PhaseTimer(trace)
+    df, missing_sheets = generate_sheets(shape)
+    first_sheet_name, all_sheets = "items", missing_sheets
+    bytes_written = 0
+    template_mismatches = 0
+    cache_mismatches = 0
+    alias_bytes = dict.fromkeys(("full",) + tuple(ALIAS_PROFILES), 0)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        workdir = Path(workdir)
+        if not in_memory:
+            path = workdir / f"synthetic_{shape.variables}.xlsx"
+            write_workbook(path, df, missing_sheets)
+            del df
+            with timer.phase("read_excel"):
+                first_sheet_name, df, all_sheets = converter.read_workbook(
+                    path, engine, reader
+                )
+            if reader == "pandas":
+                with timer.phase("fill_cache"):
+                    converter.read_workbook(path, engine, reader, cache=True)
+                with timer.phase("read_cache"):
+                    _, cached_df, cached_sheets = converter.read_workbook(
+                        path, engine, reader, cache=True
+                    )
+                cache_mismatches = sum(
+                    not _same_sheet(sheet_df, cached)
+                    for sheet_df, cached in [(df, cached_df)]
+                    + [(all_sheets[sheet], cached_sheets.get(sheet)) for sheet in all_sheets]
+                )
+                del cached_df, cached_sheets
+
+        options = converter.ConversionOptions(pretty_print=pretty_print)
+        with timer.phase("sort_all_lines_and_columns"):
+            (
+                varname_groups,
+                CodeLists,
+                dictionary_names,
+                varname_number,
+                missing_map,
+                missing_lists,
+            ) = converter.ingest_metadata(df, all_sheets, False, options)
+
+        for key, group in varname_groups.items():
+            with timer.phase("compute_final_ref_map"):
+                final_ref_map, combos_used = converter.compute_final_ref_map(
+                    CodeLists, group, varname_number, missing_lists, missing_map
+                )
+            odm, metadata = converter.calculate_odm_root(
+                "synthetic", key, first_sheet_name, CREATION_DATETIME
+            )
+            with timer.phase("calculate_itemdef"):
+                count_id = 1
+                for _, lines in group.items():
+                    for line in lines:
+                        converter.calculate_itemdef(
+                            metadata, line, count_id, CodeLists, dictionary_names, final_ref_map
+                        )
+                        count_id += 1
+            with timer.phase("emit_union_codelists"):
+                converter.emit_union_codelists(
+                    CodeLists, combos_used, metadata, missing_lists, missing_map
+                )
+            with timer.phase("serialization"):
+                xml_bytes = converter.ET.tostring(
+                    odm, encoding="utf-8", xml_declaration=True, pretty_print=pretty_print
+                )
+                (workdir / f"Study_synthetic_{key}.xml").write_bytes(xml_bytes)
+                bytes_written += len(xml_bytes)
+            del odm, metadata, xml_bytes
+
+            emitted = []
+            for emitter in ("lxml", "template"):
+                emitter_options = converter.ConversionOptions(
+                    pretty_print=pretty_print,
+                    creation_datetime=CREATION_DATETIME,
+                    emitter=emitter,
+                )
+                buffer = io.BytesIO()
+                with timer.phase(f"{emitter}_emitter"):
+                    converter.write_odm(
+                        buffer,
+                        key,
+                        group,
+                        "synthetic",
+                        first_sheet_name,
+                        CodeLists,
+                        dictionary_names,
+                        varname_number,
+                        missing_lists,
+                        missing_map,
+                        emitter_options,
+                    )
+                emitted.append(buffer.getvalue())
+            if emitted[0] != emitted[1]:
+                template_mismatches += 1
+            alias_bytes["full"] += len(emitted[0])
+            del emitted, buffer
+
+            for profile, (alias_profile, group_aliases) in ALIAS_PROFILES.items():
+                alias_options = converter.ConversionOptions(
+                    pretty_print=pretty_print,
+                    creation_datetime=CREATION_DATETIME,
+                    alias_profile=alias_profile,
+                    group_aliases=group_aliases,
+                )
+                buffer = io.BytesIO()
+                with timer.phase(f"aliases_{profile}"):
+                    converter.write_odm(
+                        buffer,
+                        key,
+                        group,
+                        "synthetic",
+                        first_sheet_name,
+                        CodeLists,
+                        dictionary_names,
+                        varname_number,
+                        missing_lists,
+                        missing_map,
+                        alias_options,
+                    )
+                alias_bytes[profile] += len(buffer.getvalue())
+                del buffer
+
+    if trace:
+        tracemalloc.stop()
+    lxml_seconds = timer.phases.get("lxml_emitter", {}).get("seconds", 0.0)
+    template_seconds = timer.phases.get("template_emitter", {}).get("seconds", 0.0)
+    return {
+        "size": shape.variables,
+        "shape": shape.to_dict(),
+        "phases": timer.phases,
+        "total_seconds": sum(entry["seconds"] for entry in timer.phases.values()),
+        "max_rss_bytes": _max_rss(),
+        "counts": {
+            "study_events": len(varname_groups),
+            "max_study_event_items": max(
+                (
+                    sum(len(lines) for lines in group.values())
+                    for group in varname_groups.values()
+                ),
+                default=0,
+            ),
+            "codelists": len(CodeLists),
+            "missing_lists": len(missing_lists),
+            "bytes_written": bytes_written,
+            "template_mismatches": template_mismatches,
+            "cache_mismatches": cache_mismatches,
+        },
+        "alias_profiles": {
+            profile: {
+                "bytes": size,
+                "seconds": timer.phases.get(
+                    "lxml_emitter" if profile == "full" else f"aliases_{profile}", {}
+                ).get("seconds", 0.0),
+            }
+            for profile, size in alias_bytes.items()
+        },
+        "throughput": {
+            "lxml_items_per_second": shape.variables / lxml_seconds if lxml_seconds else None,
+            "template_items_per_second": (
+                shape.variables / template_seconds if template_seconds else None
+            ),
+        },
+    }
+
+
+"""
+Startup of the converter: the import and `dataquieR2ODM.py --help`, each the
+best of repeats in a fresh interpreter.
+"""
+def measure_startup(repeats=5):
+    script = Path(converter.__file__).resolve()
+    commands = {
+        "import_seconds": [
+            sys.executable,
+            "-c",
+            f"import sys; sys.path.insert(0, {str(script.parent)!r}); import dataquieR2ODM",
+        ],
+        "help_seconds": [sys.executable, str(script), "--help"],
+    }
+    startup = {}
+    for name, command in commands.items():
+        best = None
+        for _ in range(repeats):
+            start = time.perf_counter()
+            subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+            seconds = time.perf_counter() - start
+            best = seconds if best is None else min(best, seconds)
+        startup[name] = best
+    return startup
+
+
+"""
+Compare the results with a baseline. A phase regresses if it is slower than
+the baseline by more than tolerance and by more than min_seconds, or if its
+RSS growth (or traced peak) is bigger by more than tolerance and by more than
+min_bytes; the same holds for the max RSS of every size. Returns the list of
+regressions as text.
+"""
+def compare(results, baseline, tolerance, min_seconds=0.05, min_bytes=16 * 2**20):
+    def _more_memory(size, old_size):
+        return size > old_size * (1 + tolerance) and size - old_size > min_bytes
+
+    regressions = []
+    # tracemalloc slows everything down and needs memory itself,
+    # such runs are not comparable
+    comparable = results.get("tracemalloc") == baseline.get("tracemalloc")
+    for name, seconds in results.get("startup", {}).items():
+        old_seconds = baseline.get("startup", {}).get(name)
+        if old_seconds and seconds > old_seconds * (1 + tolerance) and seconds - old_seconds > 0.02:
+            regressions.append(f"startup {name}: {old_seconds:.3f}s -> {seconds:.3f}s")
+    by_size = {entry["size"]: entry for entry in baseline["results"]}
+    for entry in results["results"]:
+        if entry["counts"].get("template_mismatches"):
+            regressions.append(
+                f"{entry['size']} template emitter: "
+                f"{entry['counts']['template_mismatches']} files differ from lxml"
+            )
+        if entry["counts"].get("max_study_event_items", 0) > converter.MAX_ITEMS:
+            regressions.append(
+                f"{entry['size']} split: a Study Event has "
+                f"{entry['counts']['max_study_event_items']} items (limit {converter.MAX_ITEMS})"
+            )
+        if entry["counts"].get("cache_mismatches"):
+            regressions.append(
+                f"{entry['size']} cache: "
+                f"{entry['counts']['cache_mismatches']} sheets differ from the workbook"
+            )
+        old = by_size.get(entry["size"])
+        if old is None or not comparable:
+            continue
+        if _more_memory(entry["max_rss_bytes"], old["max_rss_bytes"]):
+            regressions.append(
+                f"{entry['size']} max RSS: {old['max_rss_bytes'] / 2**20:.1f} MiB -> "
+                f"{entry['max_rss_bytes'] / 2**20:.1f} MiB"
+            )
+        for phase, new_phase in entry["phases"].items():
+            old_phase = old["phases"].get(phase)
+            if old_phase is None:
+                continue
+            seconds, old_seconds = new_phase["seconds"], old_phase["seconds"]
+            if seconds > old_seconds * (1 + tolerance) and seconds - old_seconds > min_seconds:
+                regressions.append(
+                    f"{entry['size']} {phase}: {old_seconds:.3f}s -> {seconds:.3f}s"
+                )
+            for memory in ("rss_growth_bytes", "peak_bytes"):
+                size, old_size = new_phase[memory], old_phase[memory]
+                if _more_memory(size, old_size):
+                    regressions.append(
+                        f"{entry['size']} {phase} {memory}: {old_size / 2**20:.1f} MiB -> "
+                        f"{size / 2**20:.1f} MiB"
+                    )
+    return regressions
+
+
+def print_results(results):
+    for name, seconds in results.get("startup", {}).items():
+        print(f"startup {name:<20} {seconds:>9.3f}s")
+    for entry in results["results"]:
+        print(
+            f"{entry['size']} variables: {entry['total_seconds']:.3f}s, "
+            f"max RSS {entry['max_rss_bytes'] / 2**20:.1f} MiB, "
+            f"{entry['counts']['bytes_written'] / 2**20:.1f} MiB written"
+        )
+        throughput = entry.get("throughput", {})
+        if throughput.get("lxml_items_per_second") and throughput.get("template_items_per_second"):
+            print(
+                f"  emitter lxml {throughput['lxml_items_per_second']:,.0f} items/s, "
+                f"template {throughput['template_items_per_second']:,.0f} items/s, "
+                f"{entry['counts']['template_mismatches']} files differ"
+            )
+        if "read_cache" in entry["phases"]:
+            print(f"  cache {entry['counts']['cache_mismatches']} sheets differ")
+        if entry.get("alias_profiles"):
+            print(
+                "  aliases "
+                + ", ".join(
+                    f"{profile} {values['bytes'] / 2**20:.1f} MiB {values['seconds']:.3f}s"
+                    for profile, values in entry["alias_profiles"].items()
+                )
+            )
+        for phase, values in entry["phases"].items():
+            print(
+                f"  {phase:<28} {values['seconds']:>9.3f}s "
+                f"{values['rss_growth_bytes'] / 2**20:>9.1f} MiB RSS "
+                f"{values['peak_bytes'] / 2**20:>9.1f} MiB traced"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark XLSX → ODM")
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="Numbers of variables"
+    )
+    parser.add_argument("--hierarchy-depth", type=int, default=4)
+    parser.add_argument("--value-label-codes", type=int, default=5)
+    parser.add_argument("--duplication-rate", type=float, default=0.95)
+    parser.add_argument("--missing-lists", type=int, default=3)
+    parser.add_argument("--note-length", type=int, default=80)
+    parser.add_argument("--numeric-varname-rate", type=float, default=0.1)
+    parser.add_argument("--dces", type=int, default=3)
+    parser.add_argument("--dce-rate", type=float, default=0.6)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--engine", default=None, help="pandas Excel engine")
+    parser.add_argument(
+        "--reader", choices=["pandas", "openpyxl"], default="pandas", help="Reader of the XLSX"
+    )
+    parser.add_argument(
+        "--in-memory",
+        action="store_true",
+        help="Skip writing and reading the XLSX (no read_excel phase)"
+    )
+    parser.add_argument(
+        "--tracemalloc",
+        action="store_true",
+        help="Also trace the Python peak memory per phase (much slower)"
+    )
+    parser.add_argument("--output", default=None, help="Write the results as JSON")
+    parser.add_argument("--baseline", default=str(DEFAULT_BASELINE))
+    parser.add_argument(
+        "--save-baseline", action="store_true", help="Store the results as baseline"
+    )
+    parser.add_argument(
+        "--compare", action="store_true", help="Fail on regressions against the baseline"
+    )
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    args = parser.parse_args()
+
+    results = {
+        "tracemalloc": args.tracemalloc,
+        "startup": measure_startup(),
+        "results": [],
+    }
+    for size in args.sizes:
+        shape = SyntheticShape(
+            variables=size,
+            hierarchy_depth=args.hierarchy_depth,
+            value_label_codes=args.value_label_codes,
+            duplication_rate=args.duplication_rate,
+            missing_lists=args.missing_lists,
+            note_length=args.note_length,
+            numeric_varname_rate=args.numeric_varname_rate,
+            dces=args.dces,
+            dce_rate=args.dce_rate,
+            seed=args.seed,
+        )
+        # a fresh process per size keeps the RSS of the sizes apart
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            results["results"].append(
+                executor.submit(
+                    run_benchmark,
+                    shape,
+                    args.tracemalloc,
+                    args.engine,
+                    args.in_memory,
+                    True,
+                    args.reader,
+                ).result()
+            )
+    print_results(results)
+
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=2))
+    baseline_path = Path(args.baseline)
+    if args.save_baseline:
+        baseline_path.parent.mkdir(parents=True, exist_ok=True)
+        baseline_path.write_text(json.dumps(results, indent=2))
+    if args.compare:
+        if not baseline_path.is_file():
+            sys.exit(f"No baseline {baseline_path}, store one with --save-baseline")
+        baseline = json.loads(baseline_path.read_text())
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print("REGRESSION", regression)
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,193 @@
+#!/usr/bin/python3
+"""
+Generates synthetic metadata in the dataquieR format: a first sheet with one
+row per variable and the missing-list sheets referenced by MISSING_LIST_TABLE.
+Size and shape are configurable, the output is deterministic for a seed.
+
+$ python3 benchmarks/synthetic_metadata.py 10000 /tmp/synthetic.xlsx
+"""
+import argparse
+import random
+
+import pandas as pd
+
+
+"""
+Shape of the synthetic metadata.
+"""
+class SyntheticShape:
+    def __init__(
+        self,
+        variables=1000,
+        hierarchy_depth=4,
+        hierarchy_width=4,
+        value_label_codes=5,
+        value_label_rate=0.6,
+        duplication_rate=0.95,
+        missing_lists=3,
+        missing_list_rate=0.5,
+        missing_codes=8,
+        note_length=80,
+        note_rate=0.3,
+        numeric_varname_rate=0.0,
+        dces=3,
+        dce_rate=0.0,
+        seed=1,
+    ):
+        """
+        :param variables: Number of rows of the first sheet (int)
+        :param hierarchy_depth: Number of HIERARCHY levels below SHIP|SHIPx (int)
+        :param hierarchy_width: Number of branches per HIERARCHY level (int)
+        :param value_label_codes: Number of codes of each VALUE_LABELS scale (int)
+        :param value_label_rate: Share of variables with VALUE_LABELS (float)
+        :param duplication_rate: Share of VALUE_LABELS reusing an existing scale (float)
+        :param missing_lists: Number of missing-list sheets (int)
+        :param missing_list_rate: Share of variables with a MISSING_LIST_TABLE (float)
+        :param missing_codes: Number of rows of each missing-list sheet (int)
+        :param note_length: Length of NOTE/NOTE_DE texts (int)
+        :param note_rate: Share of variables with notes (float)
+        :param numeric_varname_rate: Share of VAR_NAMES that are numbers (float)
+        :param dces: Number of DCEs (Study Events) the DCE variables fall into (int)
+        :param dce_rate: Share of variables with a DCE, their HIERARCHY paths are
+            shared with the other DCEs (float)
+        :param seed: Random seed (int)
+        """
+        self.variables = variables
+        self.hierarchy_depth = hierarchy_depth
+        self.hierarchy_width = hierarchy_width
+        self.value_label_codes = value_label_codes
+        self.value_label_rate = value_label_rate
+        self.duplication_rate = duplication_rate
+        self.missing_lists = missing_lists
+        self.missing_list_rate = missing_list_rate
+        self.missing_codes = missing_codes
+        self.note_length = note_length
+        self.note_rate = note_rate
+        self.numeric_varname_rate = numeric_varname_rate
+        self.dces = dces
+        self.dce_rate = dce_rate
+        self.seed = seed
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+
+def _scale(rng, codes, number, language):
+    words = ("yes", "no", "never", "often", "always") if language == "en" else (
+        "ja", "nein", "nie", "oft", "immer"
+    )
+    return "|".join(
+        f"{code}={rng.choice(words)} {number}" for code in range(1, codes + 1)
+    )
+
+
+"""
+Generate the sheets: returns (first_sheet_df, {missing_sheet_name: df}).
+"""
+def generate_sheets(shape):
+    rng = random.Random(shape.seed)
+    missing_names = [f"MISSING_{i}" for i in range(1, shape.missing_lists + 1)]
+    scales = []
+    note = ("Lorem ipsum dolor sit amet " * (shape.note_length // 27 + 1))[
+        : shape.note_length
+    ]
+
+    rows = []
+    for i in range(shape.variables):
+        path = ["SHIP", f"SHIP{rng.randrange(3)}"] + [
+            f"L{level}_{rng.randrange(shape.hierarchy_width)}"
+            for level in range(shape.hierarchy_depth)
+        ]
+        value_labels = value_labels_de = None
+        if rng.random() < shape.value_label_rate:
+            if scales and rng.random() < shape.duplication_rate:
+                value_labels, value_labels_de = rng.choice(scales)
+            else:
+                number = len(scales)
+                value_labels = _scale(rng, shape.value_label_codes, number, "en")
+                value_labels_de = _scale(rng, shape.value_label_codes, number, "de")
+                scales.append((value_labels, value_labels_de))
+        has_note = rng.random() < shape.note_rate
+        # numbers next to strings make VAR_NAMES a mixed column
+        numeric_varname = (
+            shape.numeric_varname_rate and rng.random() < shape.numeric_varname_rate
+        )
+        dce = None
+        if shape.dce_rate and rng.random() < shape.dce_rate:
+            dce = f"DCE_{rng.randrange(shape.dces)}"
+        rows.append(
+            {
+                "VAR_NAMES": i if numeric_varname else f"v{i:07d}",
+                "LABEL": f"Variable {i}",
+                "LABEL_DE": f"Variable {i}",
+                "LONG_LABEL": f"Long label of variable {i}",
+                "VALUE_LABELS": value_labels,
+                "VALUE_LABELS_DE": value_labels_de,
+                "MISSING_LIST_TABLE": (
+                    rng.choice(missing_names)
+                    if missing_names and rng.random() < shape.missing_list_rate
+                    else None
+                ),
+                "HIERARCHY": "|".join(path),
+                "DCE": dce,
+                "STUDY_SEGMENT": path[-1],
+                "NOTE": note if has_note else None,
+                "NOTE_DE": note if has_note else None,
+                "DATA_TYPE": rng.choice(("integer", "string", "float", "datetime")),
+                "VARIABLE_ORDER": i,
+            }
+        )
+    df = pd.DataFrame(rows)
+
+    missing_sheets = {}
+    for number, sheet in enumerate(missing_names):
+        missing_sheets[sheet] = pd.DataFrame(
+            {
+                "CODE_VALUE": [-(900 + code + number) for code in range(shape.missing_codes)],
+                "CODE_LABEL": [f"Missing reason {code}" for code in range(shape.missing_codes)],
+                "CODE_CLASS": ["MISSING"] * shape.missing_codes,
+            }
+        )
+    return df, missing_sheets
+
+
+"""
+Write the sheets as XLSX workbook (first sheet "items").
+"""
+def write_workbook(path, df, missing_sheets):
+    with pd.ExcelWriter(path) as writer:
+        df.to_excel(writer, sheet_name="items", index=False)
+        for sheet, mdf in missing_sheets.items():
+            mdf.to_excel(writer, sheet_name=sheet, index=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate synthetic dataquieR metadata")
+    parser.add_argument("variables", type=int, help="Number of variables")
+    parser.add_argument("file", help="Path of the XLSX file to write")
+    parser.add_argument("--hierarchy-depth", type=int, default=4)
+    parser.add_argument("--hierarchy-width", type=int, default=4)
+    parser.add_argument("--value-label-codes", type=int, default=5)
+    parser.add_argument("--duplication-rate", type=float, default=0.95)
+    parser.add_argument("--missing-lists", type=int, default=3)
+    parser.add_argument("--note-length", type=int, default=80)
+    parser.add_argument("--numeric-varname-rate", type=float, default=0.0)
+    parser.add_argument("--dces", type=int, default=3)
+    parser.add_argument("--dce-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    shape = SyntheticShape(
+        variables=args.variables,
+        hierarchy_depth=args.hierarchy_depth,
+        hierarchy_width=args.hierarchy_width,
+        value_label_codes=args.value_label_codes,
+        duplication_rate=args.duplication_rate,
+        missing_lists=args.missing_lists,
+        note_length=args.note_length,
+        numeric_varname_rate=args.numeric_varname_rate,
+        dces=args.dces,
+        dce_rate=args.dce_rate,
+        seed=args.seed,
+    )
+    write_workbook(args.file, *generate_sheets(shape))
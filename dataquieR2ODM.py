@@ -1,16 +1,380 @@
 #!/usr/bin/python3
 import argparse
-import pandas as pd
-import numpy as np
-from lxml import etree as ET
+from collections import OrderedDict
 from datetime import datetime
+from functools import lru_cache
+import importlib
 import os
 import sys
-import html
-from itertools import zip_longest
-import ast
 from pathlib import Path
+from contextlib import contextmanager, nullcontext
 import hashlib
+import copy
+import glob
+import gzip
+import io
+import json
+import re
+import threading
+import time
+import tracemalloc
+import zipfile
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+"""
+_LazyModule stands in for a heavy module (pandas, numpy, lxml) and imports it
+on the first attribute access. It then replaces itself in the globals, so
+--help and conversions that never need a module do not pay for its import.
+"""
+class _LazyModule:
+    def __init__(self, alias, module_name):
+        """
+        :param alias: Global name of the module in this file (str)
+        :param module_name: Name of the module to import (str)
+        """
+        self._alias = alias
+        self._module_name = module_name
+
+    def __getattr__(self, attr):
+        module = importlib.import_module(self._module_name)
+        globals()[self._alias] = module
+        return getattr(module, attr)
+
+
+pd = _LazyModule("pd", "pandas")
+np = _LazyModule("np", "numpy")
+ET = _LazyModule("ET", "lxml.etree")
+
+ODM_NSMAP = {
+    None: "http://www.cdisc.org/ns/odm/v1.3",
+    "ns2": "http://www.w3.org/2000/09/xmldsig#",
+}
+METADATA_ATTRIBUTES = {"OID": "MDV.1", "Name": "MetaDataVersion"}
+# maximum number of items of each ODM file
+MAX_ITEMS = 5700
+# bump when the generated ODM changes, so incremental runs rebuild everything
+MANIFEST_VERSION = 1
+# default folder of the ODM files (relative to the working directory)
+OUTPUT_DIR = Path("../output")
+# number of distinct VALUE_LABELS strings whose parsed codelist is cached
+VALUE_LABELS_CACHE_SIZE = 4096
+# number of compiled missing-list sheets that are cached
+MISSING_LIST_CACHE_SIZE = 256
+# Study Events waiting between two stages of --pipeline
+PIPELINE_DEPTH = 2
+# bump when the fingerprints of the definition index (--diff) change
+DEFINITIONS_VERSION = 1
+
+PLAN_VERSION = 1
+# options that change the bytes of the ODM files, fixed by a --plan
+PLAN_OPTIONS = (
+    "pretty_print",
+    "max_items",
+    "max_bytes",
+    "creation_datetime",
+    "compress",
+    "alias_profile",
+    "group_aliases",
+)
+# named alias profiles, any other profile is a whitelist of columns
+ALIAS_PROFILES = ("full", "essential", "none")
+# columns that are already part of the ODM (Name, Question, Description,
+# CodeList, DataType, CodedValue, Decode) and dropped by the profile "essential"
+REDUNDANT_ALIAS_COLUMNS = frozenset(
+    {
+        "VARNAMES",
+        "VAR_NAMES",
+        "LABEL",
+        "LABEL_DE",
+        "NOTE",
+        "NOTE_DE",
+        "VALUE_LABELS",
+        "VALUE_LABELS_DE",
+        "DATA_TYPE",
+        "CODE_VALUE",
+        "CODE_LABEL",
+    }
+)
+# columnar inputs instead of a workbook (one table per sheet)
+TABLE_SUFFIXES = (".csv", ".parquet", ".feather", ".arrow")
+# bump when the Parquet sidecar of a workbook changes
+SHEET_CACHE_VERSION = 2
+
+
+"""
+ConversionError is the base class of all errors raised by the conversion.
+"""
+class ConversionError(Exception):
+    pass
+
+
+"""
+WorkbookError is raised if the workbook or its sheets cannot be read.
+"""
+class WorkbookError(ConversionError):
+    pass
+
+
+"""
+MetadataError is raised if the metadata lack a required column.
+"""
+class MetadataError(ConversionError):
+    pass
+
+
+"""
+ConversionOptions bundles the optional settings of a conversion.
+"""
+class ConversionOptions:
+    def __init__(
+        self,
+        pretty_print=True,
+        streaming=False,
+        jobs=1,
+        engine=None,
+        reader="pandas",
+        max_items=MAX_ITEMS,
+        max_bytes=None,
+        incremental=False,
+        creation_datetime=None,
+        metrics=None,
+        output_dir=OUTPUT_DIR,
+        compress=None,
+        cache=False,
+        emitter="lxml",
+        pipeline=False,
+        pipeline_depth=PIPELINE_DEPTH,
+        alias_profile="full",
+        group_aliases=False,
+    ):
+        """
+        :param pretty_print: Indent the XML output (bool)
+        :param streaming: Write every ODM incrementally instead of building the whole tree (bool)
+        :param jobs: Number of processes writing Study Event ODMs in parallel (int)
+        :param engine: pandas Excel engine, e.g. "openpyxl" or "calamine" (str)
+        :param reader: "pandas" or "openpyxl" to read the rows without pandas (str)
+        :param max_items: Maximum number of items of each ODM file (int)
+        :param max_bytes: Maximum estimated size of each ODM file, replaces max_items (int)
+        :param incremental: Only rebuild ODM files whose content hash changed (bool)
+        :param creation_datetime: Fixed CreationDateTime instead of now (str)
+        :param metrics: Collects timings and counters of the conversion (Metrics)
+        :param output_dir: Folder of the ODM files (Path)
+        :param compress: None, "gzip" (.xml.gz files) or "zip" (one archive) (str)
+        :param cache: Keep the parsed sheets of a workbook in a Parquet sidecar (bool)
+        :param emitter: "lxml" or "template" to render the XML from string templates (str)
+        :param pipeline: Build, serialize and write the ODMs in overlapping threads (bool)
+        :param pipeline_depth: Maximum number of ODMs waiting between two stages (int)
+        :param alias_profile: "full", "essential", "none", a column or the columns written as Alias (str or tuple)
+        :param group_aliases: Write aliases that are the same for all items of a Study Event once (bool)
+        """
+        self.pretty_print = pretty_print
+        self.streaming = streaming
+        self.jobs = jobs
+        self.engine = engine
+        self.reader = reader
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.incremental = incremental
+        self.creation_datetime = creation_datetime
+        self.metrics = metrics
+        self.output_dir = Path(output_dir)
+        self.compress = compress
+        self.cache = cache
+        self.emitter = emitter
+        self.pipeline = pipeline
+        self.pipeline_depth = pipeline_depth
+        if isinstance(alias_profile, str):
+            # a single column is a whitelist of one column, not a substring
+            if alias_profile not in ALIAS_PROFILES:
+                alias_profile = (alias_profile,)
+        else:
+            alias_profile = tuple(alias_profile)
+        self.alias_profile = alias_profile
+        self.group_aliases = group_aliases
+
+
+def _max_rss(who=None):
+    # peak resident set size in bytes (ru_maxrss is in KiB on Linux, in bytes on macOS)
+    if resource is None:
+        return 0
+    max_rss = resource.getrusage(resource.RUSAGE_SELF if who is None else who).ru_maxrss
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+"""
+Metrics collects the instrumentation of a conversion: the wall time and the
+growth of the peak RSS of every phase (phases nest, so their times are
+inclusive), counters (rows, CodeLists, elements, ...) and one entry per
+ODM file. With trace_memory the peak of the Python allocations is traced
+with tracemalloc as well (slower, lxml allocations are not included).
+Phases of worker processes (--jobs) are merged, their times add up.
+Thread-safe, e.g. for the stages of --pipeline.
+"""
+class Metrics:
+    def __init__(self, trace_memory=False):
+        """
+        :param trace_memory: Also trace the Python peak memory with tracemalloc (bool)
+        """
+        self.trace_memory = trace_memory
+        self.phases = {}
+        self.counters = {}
+        self.files = []
+        # throughput and utilisation of the stages of --pipeline
+        self.pipeline = None
+        self.error = None
+        self._lock = threading.RLock()
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def __getstate__(self):
+        # locks cannot be pickled (worker processes of --jobs)
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+
+    def reset(self):
+        with self._lock:
+            self.phases = {}
+            self.counters = {}
+            self.files = []
+            self.pipeline = None
+
+    @contextmanager
+    def phase(self, name):
+        start_rss = _max_rss()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            rss_growth = _max_rss() - start_rss
+            with self._lock:
+                entry = self.phases.setdefault(
+                    name, {"calls": 0, "seconds": 0.0, "rss_growth_bytes": 0}
+                )
+                entry["calls"] += 1
+                entry["seconds"] += seconds
+                entry["rss_growth_bytes"] += rss_growth
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def add_file(self, file_name, bytes_written, elements, seconds, skipped=False):
+        """
+        :param file_name: Name of the ODM file (str)
+        :param bytes_written: Size of the file, 0 if skipped (int)
+        :param elements: Number of MetaDataVersion children per tag (dict)
+        :param seconds: Time to build and write the file (float)
+        :param skipped: The file was unchanged and not rewritten (bool)
+        """
+        with self._lock:
+            self.files.append(
+                {
+                    "file": file_name,
+                    "bytes": bytes_written,
+                    "items": elements.get("ItemDef", 0),
+                    "elements": elements,
+                    "seconds": seconds,
+                    "skipped": skipped,
+                }
+            )
+            self.count("files_skipped" if skipped else "files_written")
+            self.count("bytes_written", bytes_written)
+            for tag, number in elements.items():
+                self.count(f"elements_{tag}", number)
+
+    def merge(self, snapshot):
+        """
+        Add the phases, counters and files of another Metrics (e.g. of a worker).
+        :param snapshot: Result of Metrics.to_dict (dict)
+        """
+        with self._lock:
+            for name, values in snapshot["phases"].items():
+                entry = self.phases.setdefault(
+                    name, {"calls": 0, "seconds": 0.0, "rss_growth_bytes": 0}
+                )
+                for field, value in values.items():
+                    entry[field] += value
+            for name, value in snapshot["counters"].items():
+                self.count(name, value)
+            self.files.extend(snapshot["files"])
+
+    def to_dict(self):
+        with self._lock:
+            phases = copy.deepcopy(self.phases)
+            counters = dict(self.counters)
+            files = list(self.files)
+        return {
+            "phases": phases,
+            "counters": counters,
+            "files": files,
+            "pipeline": self.pipeline,
+            "max_rss_bytes": _max_rss(),
+            "max_rss_children_bytes": _max_rss(
+                resource.RUSAGE_CHILDREN if resource is not None else None
+            ),
+            "traced_peak_bytes": (
+                tracemalloc.get_traced_memory()[1] if tracemalloc.is_tracing() else None
+            ),
+            "error": self.error,
+        }
+
+    def summary(self):
+        report = self.to_dict()
+        lines = ["Profile:", f"  {'phase':<28} {'calls':>7} {'seconds':>10} {'RSS growth':>12}"]
+        for name, values in report["phases"].items():
+            lines.append(
+                f"  {name:<28} {values['calls']:>7} {values['seconds']:>9.3f}s "
+                f"{values['rss_growth_bytes'] / 2**20:>8.1f} MiB"
+            )
+        lines.append("  counters:")
+        for name, value in report["counters"].items():
+            lines.append(f"    {name:<26} {value:>12}")
+        lines.append("  files:")
+        for entry in report["files"]:
+            lines.append(
+                f"    {entry['file']:<40} {entry['bytes'] / 2**20:>8.2f} MiB "
+                f"{entry['items']:>7} items {entry['seconds']:>8.3f}s"
+                + (" (unchanged)" if entry["skipped"] else "")
+            )
+        if report["pipeline"]:
+            pipeline = report["pipeline"]
+            lines.append(
+                f"  pipeline: {pipeline['files']} files in {pipeline['wall_seconds']:.3f}s, "
+                f"{pipeline['files_per_second']:.1f} files/s, "
+                f"{pipeline['mib_per_second']:.1f} MiB/s (depth {pipeline['depth']})"
+            )
+            for name, stage in pipeline["stages"].items():
+                lines.append(
+                    f"    {name:<12} {stage['utilisation']:>6.1%} busy "
+                    f"{stage['busy_seconds']:>8.3f}s, waiting for input "
+                    f"{stage['starved_seconds']:>8.3f}s, blocked {stage['blocked_seconds']:>8.3f}s"
+                )
+        memory = f"  peak RSS {report['max_rss_bytes'] / 2**20:.1f} MiB"
+        if report["max_rss_children_bytes"]:
+            memory += f", workers {report['max_rss_children_bytes'] / 2**20:.1f} MiB"
+        if report["traced_peak_bytes"] is not None:
+            memory += f", traced Python peak {report['traced_peak_bytes'] / 2**20:.1f} MiB"
+        lines.append(memory)
+        if report["error"]:
+            lines.append(f"  error: {report['error']}")
+        return "\n".join(lines)
+
+
+def metrics_phase(metrics, name):
+    # a timed phase, or nothing if the conversion is not instrumented
+    return metrics.phase(name) if metrics is not None else nullcontext()
+
 
 """
 Codelist represents the number for the OID, the list of names which
@@ -37,6 +401,151 @@ class CodeList:
         self.names.append(name)
 
 
+"""
+CodeListRegistry interns CodeLists by a canonical fingerprint of their content
+(codelist_en, codelist_de) and indexes them by number and by the varnames that
+use them, so deduplication and lookups are O(1) instead of a scan over all
+CodeLists. It also caches the DataType computed by check_datatype.
+"""
+class CodeListRegistry:
+    def __init__(self):
+        # all codelists in creation order (number = position + 1)
+        self.codelists = []
+        self._by_fingerprint = {}
+        self._by_number = {}
+        # raw varname -> first CodeList using it
+        self._by_name = {}
+        # str(varname) -> last CodeList using it
+        self._by_varname = {}
+        self._datatypes = {}
+        # (id(en), id(de)) of FrozenCodeLists -> (en, de, CodeList)
+        self._by_identity = {}
+        # str(varname) -> (base number, missing sheet, final CodeListOID)
+        # and str(varname) -> final CodeListOID, see index_refs
+        self.refs = None
+        self.final_oids = None
+
+    def __iter__(self):
+        return iter(self.codelists)
+
+    def __len__(self):
+        return len(self.codelists)
+
+    def __getstate__(self):
+        # ids are only valid in this process
+        state = self.__dict__.copy()
+        state["_by_identity"] = {}
+        return state
+
+    @staticmethod
+    def fingerprint(codelist_en, codelist_de):
+        """
+        Canonical, order-independent key of a codelist (same semantics as
+        comparing the dictionaries with ==).
+        :param codelist_en: A dictionary with the English codelist (dict)
+        :param codelist_de: A dictionary with the German codelist (dict)
+        """
+        return (frozenset(codelist_en.items()), frozenset(codelist_de.items()))
+
+    def _index_name(self, codelist, name):
+        first = self._by_name.get(name)
+        if first is None or codelist.number < first.number:
+            self._by_name[name] = codelist
+        varname = str(name)
+        last = self._by_varname.get(varname)
+        if last is None or codelist.number > last.number:
+            self._by_varname[varname] = codelist
+
+    def _remember_identity(self, codelist_en, codelist_de, codelist):
+        # only immutable codelists can be recognized by identity
+        if isinstance(codelist_en, FrozenCodeList) and isinstance(codelist_de, FrozenCodeList):
+            self._by_identity[(id(codelist_en), id(codelist_de))] = (
+                codelist_en,
+                codelist_de,
+                codelist,
+            )
+
+    def find(self, codelist_en, codelist_de):
+        """
+        Return the first CodeList with exactly this content or None.
+        Shared FrozenCodeLists (see ValueLabelsCache) are found by identity.
+        """
+        entry = self._by_identity.get((id(codelist_en), id(codelist_de)))
+        if entry is not None and entry[0] is codelist_en and entry[1] is codelist_de:
+            return entry[2]
+        codelist = self._by_fingerprint.get(self.fingerprint(codelist_en, codelist_de))
+        if codelist is not None:
+            self._remember_identity(codelist_en, codelist_de, codelist)
+        return codelist
+
+    def add(self, name, codelist_en, codelist_de):
+        """
+        Append a new CodeList (without deduplication) and return it.
+        :param name: A varname that uses this codelist
+        """
+        codelist = CodeList(len(self.codelists) + 1, name, codelist_en, codelist_de)
+        self.codelists.append(codelist)
+        self._by_number[codelist.number] = codelist
+        first = self._by_fingerprint.setdefault(
+            self.fingerprint(codelist.codelist_en, codelist.codelist_de), codelist
+        )
+        self._remember_identity(codelist_en, codelist_de, first)
+        self._index_name(codelist, name)
+        self.refs = self.final_oids = None
+        return codelist
+
+    def add_name(self, codelist, name):
+        """
+        Link another varname to an existing CodeList.
+        """
+        codelist.add_name(name)
+        self._index_name(codelist, name)
+        self.refs = self.final_oids = None
+
+    def get(self, number):
+        return self._by_number.get(number)
+
+    def has_name(self, name):
+        return name in self._by_name
+
+    def first_with_name(self, name):
+        """
+        First CodeList (by number) whose names contain name.
+        """
+        return self._by_name.get(name)
+
+    def for_varname(self, varname):
+        """
+        Last CodeList (by number) used by str(varname).
+        """
+        return self._by_varname.get(str(varname))
+
+    def index_refs(self, missing_map):
+        """
+        Index every varname once after the ingestion: its base CodeList, its
+        missing sheet and the final CodeListOID of that combination, so the
+        ODMs only look them up.
+        :param missing_map: varname -> missing_sheet_name (dict)
+        """
+        self.refs = {}
+        self.final_oids = {}
+        for varname, base in self._by_varname.items():
+            sheet = str(missing_map.get(varname)) if missing_map.get(varname) else None
+            oid, _ = _stable_combo_oid(base.number, sheet)
+            self.refs[varname] = (base.number, sheet, oid)
+            self.final_oids[varname] = oid
+
+    def datatype(self, codelist):
+        """
+        Cached check_datatype of a CodeList.
+        """
+        datatype = self._datatypes.get(codelist.number)
+        if datatype is None:
+            datatype = check_datatype(codelist)
+            self._datatypes[codelist.number] = datatype
+        return datatype
+
+
 """ 
 Extracts the number of the label of the sheet from a missing list.
 (Kept for compatibility; currently not used.)
@@ -49,21 +558,111 @@ def extract_number(missing_list_name):
 Check if the given codelist already exists.
 """
 def check_codelist(codelist_en, codelist_de, name, CodeLists):
-    # search for existing codelist with the exact codelist
-    for codelist in CodeLists:
-        if codelist.codelist_de == codelist_de and codelist.codelist_en == codelist_en:
-            # add name to the list of the codelist
-            codelist.add_name(name)
-            return True
+    # look up an existing codelist with the exact codelist
+    codelist = CodeLists.find(codelist_en, codelist_de)
+    if codelist is not None:
+        # add name to the list of the codelist
+        CodeLists.add_name(codelist, name)
+        return True
     # the codelist was not available
     return False
 
 
+"""
+FrozenCodeList is an immutable dict: a parsed VALUE_LABELS codelist that is
+shared by all rows with the same string (see ValueLabelsCache).
+"""
+class FrozenCodeList(dict):
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("FrozenCodeList is immutable")
+
+    __setitem__ = __delitem__ = __ior__ = _readonly
+    clear = pop = popitem = setdefault = update = _readonly
+
+    def __reduce__(self):
+        return (FrozenCodeList, (dict(self),))
+
+
+EMPTY_CODELIST = FrozenCodeList()
+
+
+"""
+ValueLabelsCache memoizes process_codelist by the raw VALUE_LABELS string in
+a bounded LRU cache. A scale repeated over thousands of variables
+("1=yes|2=no", Likert scales) is split once and all its rows share one
+FrozenCodeList, which the CodeListRegistry recognizes by identity.
+Thread-safe, the conversions of a server share it.
+"""
+class ValueLabelsCache:
+    def __init__(self, maxsize=VALUE_LABELS_CACHE_SIZE):
+        """
+        :param maxsize: Maximum number of cached strings (int)
+        """
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def parse(self, value):
+        """
+        process_codelist(value) as FrozenCodeList, cached for strings.
+        """
+        if not isinstance(value, str):
+            # NaN or a number: rare, not cached
+            return self._freeze(process_codelist(value))
+        with self._lock:
+            codelist = self._entries.get(value)
+            if codelist is not None:
+                self._entries.move_to_end(value)
+                self.hits += 1
+                return codelist
+            self.misses += 1
+        codelist = self._freeze(process_codelist(value))
+        with self._lock:
+            self._entries[value] = codelist
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return codelist
+
+    @staticmethod
+    def _freeze(codelist):
+        return FrozenCodeList(codelist) if codelist else EMPTY_CODELIST
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+
+# shared by all conversions of this process
+value_labels_cache = ValueLabelsCache()
+
+
+"""
+pd.isna for a single value without importing pandas: None, NaN, NaT
+and pd.NA are missing.
+"""
+def isna(value):
+    if value is None:
+        return True
+    try:
+        # NaN and NaT are not equal to themselves
+        return bool(value != value)
+    except (TypeError, ValueError):
+        # pd.NA has no truth value
+        return True
+
+
+def notna(value):
+    return not isna(value)
+
+
 """ 
 Split the inserts of the cell to have an array with numbers and strings.
 """
 def process_codelist(language):
-    if pd.notna(language):
+    if notna(language):
         CodeDict = {}
         # Split the string with "|"
         pairs = str(language).split("|")
@@ -154,7 +753,7 @@ def calculate_missinglists(metadata, df, all_sheets, list_ml, ml):
     # iteration over the sheets from the second sheet on
     for sheet_name, df in all_sheets.items():
         dictionary = dictionary_column_names(list(df.columns))
-        if sheet_name in list_ml and pd.notna(sheet_name):
+        if sheet_name in list_ml and notna(sheet_name):
             # add a codelist as missinglist
             codelist_element = ET.SubElement(
                 metadata,
@@ -181,7 +780,7 @@ def calculate_missinglists(metadata, df, all_sheets, list_ml, ml):
                 translated_text_en.text = code_label
                 # Alias
                 for context, number in dictionary.items():
-                    if pd.notna(line[number]):
+                    if notna(line[number]):
                         ET.SubElement(
                             codelist_item,
                             "Alias",
@@ -196,11 +795,238 @@ def calculate_missinglists(metadata, df, all_sheets, list_ml, ml):
             ml = ml + 1
 
 
+"""
+Whether a column is written as Alias under an alias profile: "full" (every
+column), "essential" (not the columns already in the ODM, see
+REDUNDANT_ALIAS_COLUMNS), "none" or a whitelist of column names.
+"""
+def alias_allowed(alias_profile, column):
+    if alias_profile == "full":
+        return True
+    if alias_profile == "none":
+        return False
+    if alias_profile == "essential":
+        return column not in REDUNDANT_ALIAS_COLUMNS
+    if isinstance(alias_profile, str):
+        return column == alias_profile
+    return column in alias_profile
+
+
+"""
+The columns of dictionary that are written as Alias, without the constant
+ones (see group_constant_aliases).
+"""
+def alias_columns(dictionary, alias_profile="full", constants=()):
+    return {
+        context: number
+        for context, number in dictionary.items()
+        if alias_allowed(alias_profile, context) and context not in constants
+    }
+
+
+"""
+The alias columns with the same value in every item of a Study Event, as
+{column: value}, which --group-aliases writes once in the StudyEventDef.
+"""
+def group_constant_aliases(group, dictionary):
+    constants = None
+    for _, lines in group.items():
+        for line in lines:
+            if constants is None:
+                constants = {}
+                for context, number in dictionary.items():
+                    value = extract_from_line(line, number)
+                    if notna(value):
+                        constants[context] = str(value)
+                continue
+            for context in list(constants):
+                value = extract_from_line(line, dictionary[context])
+                if isna(value) or str(value) != constants[context]:
+                    del constants[context]
+            if not constants:
+                return {}
+    return constants or {}
+
+
+"""
+MissingList is a missing-list sheet compiled once for the whole conversion:
+one CodeListItem per distinct CODE_VALUE (Decode, all columns as Alias and
+Alias ORIGIN_CODELIST), the set of codes and whether any code is not an
+integer. Union CodeLists append copies of the prebuilt CodeListItems. The
+alias profile filters the column aliases; ORIGIN_CODELIST tells which sheet
+a code comes from, it is part of the CodeList and written under every
+profile.
+"""
+class MissingList:
+    def __init__(self, sheet, mdf):
+        """
+        :param sheet: Name of the missing-list sheet (str)
+        :param mdf: The sheet (DataFrame)
+        """
+        self.sheet = sheet
+        # (code, label, aliases) of the first row of every code
+        self.rows = []
+        self.codes = set()
+        self.non_integer = False
+        # prebuilt CodeListItem elements per alias profile (not pickled, rebuilt on demand)
+        self._items = {}
+        # CodeListItems rendered by the template emitter, per indentation
+        self._rendered = {}
+
+        mcols = {c: i for i, c in enumerate(mdf.columns)}
+        col_code = mcols.get("CODE_VALUE")
+        col_label = mcols.get("CODE_LABEL")
+        for mrow in mdf.values:
+            code = None if col_code is None else mrow[col_code]
+            if isna(code):
+                continue
+            code = str(code)
+            try:
+                int(code)
+            except (TypeError, ValueError):
+                self.non_integer = True
+
+            if code in self.codes:
+                continue  # skip duplicates
+            self.codes.add(code)
+
+            txt = None if col_label is None else mrow[col_label]
+            label = str(txt) if notna(txt) else "Missing/Reason"
+            # all columns as alias, then mark origin sheet
+            aliases = [
+                (str(cname), str(mrow[cidx]))
+                for cname, cidx in mcols.items()
+                if notna(mrow[cidx])
+            ]
+            aliases.append(("ORIGIN_CODELIST", str(sheet)))
+            self.rows.append((code, label, aliases))
+
+    @staticmethod
+    def _aliases(aliases, alias_profile):
+        return [
+            (context, alias)
+            for context, alias in aliases
+            if context == "ORIGIN_CODELIST" or alias_allowed(alias_profile, context)
+        ]
+
+    def items(self, alias_profile="full"):
+        """
+        List of (code, CodeListItem element), built once per process.
+        """
+        items = self._items.get(alias_profile)
+        if items is None:
+            # stored only when complete, other threads may read it at once
+            items = []
+            for code, label, aliases in self.rows:
+                item_el = ET.Element("CodeListItem", CodedValue=code)
+                dec = ET.SubElement(item_el, "Decode")
+                t_en = ET.SubElement(
+                    dec, "TranslatedText",
+                    attrib={"{http://www.w3.org/XML/1998/namespace}lang": "en"}
+                )
+                t_en.text = label
+                for context, alias in self._aliases(aliases, alias_profile):
+                    ET.SubElement(item_el, "Alias", Context=context, Name=alias)
+                items.append((code, item_el))
+            self._items[alias_profile] = items
+        return items
+
+    def rendered_items(self, nl, alias_profile="full"):
+        """
+        List of (code, CodeListItem as text) for the template emitter.
+        """
+        rendered = self._rendered.get((nl, alias_profile))
+        if rendered is None:
+            rendered = self._rendered[(nl, alias_profile)] = [
+                (
+                    code,
+                    render_missing_item(
+                        code, label, self._aliases(aliases, alias_profile), nl
+                    ),
+                )
+                for code, label, aliases in self.rows
+            ]
+        return rendered
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_items"] = {}
+        state["_rendered"] = {}
+        return state
+
+
+"""
+MissingListCache keeps the compiled MissingLists (with their prebuilt
+CodeListItems) in a bounded LRU cache, keyed by the sheet name and a hash
+of its content, so conversions of the same process (e.g. the requests of a
+server) compile a missing-list sheet once. Thread-safe.
+"""
+class MissingListCache:
+    def __init__(self, maxsize=MISSING_LIST_CACHE_SIZE):
+        """
+        :param maxsize: Maximum number of cached missing lists (int)
+        """
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def content_key(sheet, mdf):
+        digest = hashlib.sha256()
+        digest.update(repr((sheet, [str(column) for column in mdf.columns])).encode("utf-8"))
+        for row in mdf.values:
+            digest.update(repr(list(row)).encode("utf-8"))
+        return digest.hexdigest()
+
+    def get(self, sheet, mdf):
+        """
+        MissingList(sheet, mdf), cached by content.
+        """
+        key = self.content_key(sheet, mdf)
+        with self._lock:
+            missing_list = self._entries.get(key)
+            if missing_list is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return missing_list
+            self.misses += 1
+        missing_list = MissingList(sheet, mdf)
+        with self._lock:
+            self._entries[key] = missing_list
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return missing_list
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+
+# shared by all conversions of this process
+missing_list_cache = MissingListCache()
+
+
+"""
+Compile every missing-list sheet that is referenced by a varname.
+"""
+def compile_missing_lists(all_sheets, missing_map):
+    return {
+        sheet: missing_list_cache.get(sheet, all_sheets[sheet])
+        for sheet in dict.fromkeys(missing_map.values())
+        if sheet in all_sheets
+    }
+
+
+@lru_cache(maxsize=65536)
 def _stable_combo_oid(base_number: int, sheet: str | None) -> tuple[str, str]:
     """
     Build a stable, deterministic OID/Name for a (base, sheet) combination.
     - No missing sheet: OID = CL.<base>
     - With missing sheet: OID = CL.<base>__M_<sha10>
+    Memoized, the sha256 of a combination is computed once.
     """
     if not sheet:
         return (f"CL.{base_number}", f"CL.{base_number}")
@@ -211,36 +1037,30 @@ def _stable_combo_oid(base_number: int, sheet: str | None) -> tuple[str, str]:
 # Two-phase approach (compute mapping, then emit codelists)
 ################
 
-def compute_final_ref_map(CodeLists, group, varname_number, all_sheets, missing_map):
+def compute_final_ref_map(CodeLists, group, varname_number, missing_lists, missing_map):
     """
-    Phase 1 (no writing): compute for each varname the final CodeListOID based on
-    (base CodeList.number, missing sheet). Returns:
-      - final_ref_map: dict varname -> CodeListOID
-      - combos_used:   set of (base.number, sheet_or_None) actually needed
+    Phase 1 (no writing): the final CodeListOID of each varname based on
+    (base CodeList.number, missing sheet) comes from the index of all
+    varnames (CodeListRegistry.index_refs, built once). Returns:
+      - final_ref_map: dict varname -> CodeListOID (of all varnames)
+      - combos_used:   set of (base.number, sheet_or_None) needed by the group
     """
-    final_ref_map = {}
+    if CodeLists.refs is None:
+        CodeLists.index_refs(missing_map)
+    refs = CodeLists.refs
     combos_used = set()
 
-    # Map varname -> base CodeList
-    varname_to_base = {}
-    for cl in CodeLists:
-        for n in cl.names:
-            varname_to_base[str(n)] = cl
-
     for _, lines in group.items():
         for row in lines:
-            varname = str(row[varname_number])
-            base = varname_to_base.get(varname)
-            if not base:
-                continue
-            sheet = str(missing_map.get(varname)) if missing_map.get(varname) else None
-            oid, _ = _stable_combo_oid(base.number, sheet)
-            final_ref_map[varname] = oid
-            combos_used.add((base.number, sheet))
-    return final_ref_map, combos_used
+            ref = refs.get(str(row[varname_number]))
+            if ref is not None:
+                combos_used.add(ref[:2])
+    return CodeLists.final_oids, combos_used
 
 
-def emit_union_codelists(CodeLists, combos_used, metadata, all_sheets, missing_map):
+def emit_union_codelists(
+    CodeLists, combos_used, metadata, missing_lists, missing_map, alias_profile="full"
+):
     """
     Phase 2 (writing): emit exactly one CodeList per needed (base.number, sheet) combo.
     - Base codes are emitted first (DE + optional EN decode).
@@ -248,96 +1068,78 @@ def emit_union_codelists(CodeLists, combos_used, metadata, all_sheets, missing_m
       and add Alias Context="ORIGIN_CODELIST" Name="<sheet>".
     - Final DataType is promoted to 'string' if any missing CODE_VALUE is non-integer.
     """
-    # Build lookup: base.number -> CodeList object
-    base_by_number = {cl.number: cl for cl in CodeLists}
+    for base_number, sheet in sorted(combos_used, key=lambda x: (x[0], str(x[1]))):
+        emit_union_codelist(
+            CodeLists, base_number, sheet, metadata, missing_lists, alias_profile
+        )
 
-    def _promote_dtype(a: str, b: str) -> str:
-        # simple dominance: presence of 'string' yields 'string', else 'integer'
-        return "string" if (a == "string" or b == "string") else "integer"
 
-    for base_number, sheet in sorted(combos_used, key=lambda x: (x[0], str(x[1]))):
-        base = base_by_number.get(base_number)
-        if base is None:
-            continue
+def _promote_dtype(a: str, b: str) -> str:
+    # simple dominance: presence of 'string' yields 'string', else 'integer'
+    return "string" if (a == "string" or b == "string") else "integer"
 
-        union_dtype = check_datatype(base)
-        oid, name = _stable_combo_oid(base_number, sheet)
-        cl_el = ET.SubElement(
-            metadata, "CodeList",
-            OID=oid, Name=name, DataType=union_dtype
-        )
-        used = set()
 
-        # 1) Emit base codes
-        if len(base.codelist_de) > 0:
-            for k, v in base.codelist_de.items():
-                item_el = ET.SubElement(cl_el, "CodeListItem", CodedValue=str(k))
-                dec = ET.SubElement(item_el, "Decode")
-                t_de = ET.SubElement(
-                    dec, "TranslatedText",
-                    attrib={"{http://www.w3.org/XML/1998/namespace}lang": "de"}
-                )
-                t_de.text = v
-                if k in base.codelist_en:
-                    t_en = ET.SubElement(
-                        dec, "TranslatedText",
-                        attrib={"{http://www.w3.org/XML/1998/namespace}lang": "en"}
-                    )
-                    t_en.text = base.codelist_en[k]
-                used.add(str(k))
-        elif len(base.codelist_en) > 0:
-            for k, v in base.codelist_en.items():
-                item_el = ET.SubElement(cl_el, "CodeListItem", CodedValue=str(k))
-                dec = ET.SubElement(item_el, "Decode")
+def emit_union_codelist(
+    CodeLists, base_number, sheet, metadata, missing_lists, alias_profile="full"
+):
+    """
+    Emit the union CodeList of one (base.number, sheet) combo (see emit_union_codelists).
+    """
+    base = CodeLists.get(base_number)
+    if base is None:
+        return
+
+    union_dtype = CodeLists.datatype(base)
+    oid, name = _stable_combo_oid(base_number, sheet)
+    cl_el = ET.SubElement(
+        metadata, "CodeList",
+        OID=oid, Name=name, DataType=union_dtype
+    )
+    used = set()
+
+    # 1) Emit base codes
+    if len(base.codelist_de) > 0:
+        for k, v in base.codelist_de.items():
+            item_el = ET.SubElement(cl_el, "CodeListItem", CodedValue=str(k))
+            dec = ET.SubElement(item_el, "Decode")
+            t_de = ET.SubElement(
+                dec, "TranslatedText",
+                attrib={"{http://www.w3.org/XML/1998/namespace}lang": "de"}
+            )
+            t_de.text = v
+            if k in base.codelist_en:
                 t_en = ET.SubElement(
                     dec, "TranslatedText",
                     attrib={"{http://www.w3.org/XML/1998/namespace}lang": "en"}
                 )
-                t_en.text = v
-                used.add(str(k))
-        # else: empty base list is allowed
-
-        # 2) Append missing codes if a sheet is specified
-        if sheet:
-            if sheet in all_sheets:
-                mdf = all_sheets[sheet]
-                mcols = {c: i for i, c in enumerate(mdf.columns)}
-                col_code = mcols.get("CODE_VALUE")
-                col_label = mcols.get("CODE_LABEL")
-
-                for _, mrow in mdf.iterrows():
-                    code = None if col_code is None else mrow.iloc[col_code]
-                    if pd.isna(code):
-                        continue
-                    code = str(code)
-                    # Promote dtype if missing code is not integer
-                    try:
-                        int(code)
-                    except (TypeError, ValueError):
-                        union_dtype = _promote_dtype(union_dtype, "string")
-
-                    if code in used:
-                        continue  # skip duplicates
-
-                    item_el = ET.SubElement(cl_el, "CodeListItem", CodedValue=code)
-                    dec = ET.SubElement(item_el, "Decode")
-                    txt = None if col_label is None else mrow.iloc[col_label]
-                    t_en = ET.SubElement(
-                        dec, "TranslatedText",
-                        attrib={"{http://www.w3.org/XML/1998/namespace}lang": "en"}
-                    )
-                    t_en.text = str(txt) if pd.notna(txt) else "Missing/Reason"
+                t_en.text = base.codelist_en[k]
+            used.add(str(k))
+    elif len(base.codelist_en) > 0:
+        for k, v in base.codelist_en.items():
+            item_el = ET.SubElement(cl_el, "CodeListItem", CodedValue=str(k))
+            dec = ET.SubElement(item_el, "Decode")
+            t_en = ET.SubElement(
+                dec, "TranslatedText",
+                attrib={"{http://www.w3.org/XML/1998/namespace}lang": "en"}
+            )
+            t_en.text = v
+            used.add(str(k))
+    # else: empty base list is allowed
 
-                    # Add all columns as alias, then mark origin sheet
-                    for cname, cidx in mcols.items():
-                        v = mrow.iloc[cidx]
-                        if pd.notna(v):
-                            ET.SubElement(item_el, "Alias", Context=str(cname), Name=str(v))
-                    ET.SubElement(item_el, "Alias", Context="ORIGIN_CODELIST", Name=str(sheet))
-                    used.add(code)
+    # 2) Append missing codes if a sheet is specified
+    if sheet:
+        missing_list = missing_lists.get(sheet)
+        if missing_list is not None:
+            # Promote dtype if a missing code is not integer
+            if missing_list.non_integer:
+                union_dtype = _promote_dtype(union_dtype, "string")
+            for code, item_el in missing_list.items(alias_profile):
+                if code in used:
+                    continue  # skip duplicates
+                cl_el.append(copy.deepcopy(item_el))
 
-        # Persist final datatype (may have been promoted)
-        cl_el.set("DataType", union_dtype)
+    # Persist final datatype (may have been promoted)
+    cl_el.set("DataType", union_dtype)
 
 ###########
 # Itemdef
@@ -371,7 +1173,9 @@ Example (kept from your original comment, adapted to English heading):
     <Alias Context="GROUP_VAR_DEVICE" Name="GROUP_VAR_DEVICE" />
 </ItemDef>
 """
-def calculate_itemdef(metadata, line, count_id, CodeLists, dictionary, final_ref_map):
+def calculate_itemdef(
+    metadata, line, count_id, CodeLists, dictionary, final_ref_map, aliases=None
+):
     # variables named
     # varname
     varname_number = 0
@@ -430,16 +1234,16 @@ def calculate_itemdef(metadata, line, count_id, CodeLists, dictionary, final_ref
         )
 
     # description in the item as note and note_de
-    if pd.notna(note_de) or pd.notna(note):
+    if notna(note_de) or notna(note):
         description = ET.SubElement(itemdef, "Description")
-        if pd.notna(note_de):
+        if notna(note_de):
             translatedtext = ET.SubElement(
                 description,
                 "TranslatedText",
                 attrib={"{http://www.w3.org/XML/1998/namespace}lang": "de"},
             )
             translatedtext.text = str(note_de)
-        if pd.notna(note):
+        if notna(note):
             translatedtext = ET.SubElement(
                 description,
                 "TranslatedText",
@@ -448,16 +1252,16 @@ def calculate_itemdef(metadata, line, count_id, CodeLists, dictionary, final_ref
             translatedtext.text = str(note)
 
     # question in the item
-    if pd.notna(label) or pd.notna(label_de):
+    if notna(label) or notna(label_de):
         question = ET.SubElement(itemdef, "Question")
-        if pd.notna(label_de):
+        if notna(label_de):
             translatedtext = ET.SubElement(
                 question,
                 "TranslatedText",
                 attrib={"{http://www.w3.org/XML/1998/namespace}lang": "de"},
             )
             translatedtext.text = str(label_de)
-        if pd.notna(label):
+        if notna(label):
             translatedtext = ET.SubElement(
                 question,
                 "TranslatedText",
@@ -487,18 +1291,17 @@ def calculate_itemdef(metadata, line, count_id, CodeLists, dictionary, final_ref
         )
     else:
         # Fallback legacy behavior
-        for codelist in CodeLists:
-            # match the name in the codelist to add the reference
-            if varname in codelist.names:
-                ET.SubElement(
-                    itemdef, "CodeListRef", CodeListOID="CL." + str(codelist.number)
-                )
-                break
+        # match the name in the codelist to add the reference
+        codelist = CodeLists.first_with_name(varname)
+        if codelist is not None:
+            ET.SubElement(
+                itemdef, "CodeListRef", CodeListOID="CL." + str(codelist.number)
+            )
 
-    # Alias (all columns in the source line)
-    for context, number in dictionary.items():
+    # Alias (all columns in the source line, or those of the alias profile)
+    for context, number in (dictionary if aliases is None else aliases).items():
         val = extract_from_line(line, number)
-        if pd.notna(val):
+        if notna(val):
             ET.SubElement(
                 itemdef, "Alias", Context=str(context), Name=str(val)
             )
@@ -581,7 +1384,7 @@ Example:
 # start calculating the odm
 def calculate_odm(
     df,
-    all_sheets,
+    missing_lists,
     file_name,
     varname_groups,
     CodeLists,
@@ -589,381 +1392,3417 @@ def calculate_odm(
     varname_number,
     first_sheet_name,
     missing_map,
+    options=None,
 ):
+    options = options or ConversionOptions()
     # Study name
     name = file_name.split(".")[0]
-    # separator
-    separator = "---"
+
+    """ XML """
+    # Output Directory
+    output_dir = options.output_dir
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    # everything except the Study Event itself is the same for all ODMs
+    shared = {
+        "output_dir": output_dir,
+        "name": name,
+        "first_sheet_name": first_sheet_name,
+        "CodeLists": CodeLists,
+        "dictionary_names": dictionary_names,
+        "varname_number": varname_number,
+        "missing_lists": missing_lists,
+        "missing_map": missing_map,
+        "options": options,
+        "previous": {},
+    }
+
+    # content hashes of the last run (only changed Study Events are rebuilt)
+    manifest_path = output_dir.parent / f"{output_dir.name}.manifest.json"
+    if options.incremental:
+        manifest = read_manifest(manifest_path)
+        shared["previous"] = manifest["studies"].get(name, {})
 
     """ Study Events """
-    # go through all study events
-    for key, group in varname_groups.items():
+    if options.compress == "zip":
+        # all Study Events go into one archive, one after another
+        written = write_study_event_archive(varname_groups, **shared)
+    elif options.pipeline:
+        written = write_study_events_pipeline(varname_groups, **shared)
+    elif options.jobs > 1 and len(varname_groups) > 1:
+        from concurrent.futures import ProcessPoolExecutor
 
-        """ Root-Element """
-        odm = ET.Element(
-            "ODM",
-            nsmap={
-                None: "http://www.cdisc.org/ns/odm/v1.3",
-                "ns2": "http://www.w3.org/2000/09/xmldsig#",
-            },
-            FileType="Snapshot",
-            FileOID="Project " + str(name),
-            CreationDateTime=datetime.now().isoformat(),
-            ODMVersion="1.3.2",
-            SourceSystem="OpenEDC",
-        )
+        # the shared state is sent once per worker, only the groups per task
+        with ProcessPoolExecutor(
+            max_workers=min(options.jobs, len(varname_groups)),
+            initializer=_init_worker,
+            initargs=(shared,),
+        ) as executor:
+            futures = [
+                executor.submit(_write_study_event_worker, key, group)
+                for key, group in varname_groups.items()
+            ]
+            written = []
+            for future in futures:
+                result, snapshot = future.result()
+                written.append(result)
+                if snapshot is not None:
+                    options.metrics.merge(snapshot)
+    else:
+        # go through all study events
+        written = [
+            write_study_event(key, group, **shared)
+            for key, group in varname_groups.items()
+        ]
 
-        """ Study """
-        study = ET.SubElement(odm, "Study", OID=name)
+    if options.incremental:
+        manifest["studies"][name] = dict(written)
+        write_manifest(manifest_path, manifest)
+    return [file_name for file_name, _ in written]
 
-        """ Global Variables """
-        global_variables = ET.SubElement(study, "GlobalVariables")
-        # StudyName, StudyDescription and ProtocolName
-        ET.SubElement(global_variables, "StudyName").text = (
-            "Study " + name + "_" + str(key)
-        )
-        ET.SubElement(global_variables, "StudyDescription").text = (
-            "This example study aims at providing an overview of the capabilities of OpenEDC."
-        )
-        # Use file base name and first sheet for traceability, but without column names.
-        ET.SubElement(global_variables, "ProtocolName").text = f"{name}---{first_sheet_name}"
 
-        """ Metadata, Study Event, Form, Item Group """
-        metadata = ET.SubElement(
-            study, "MetaDataVersion", OID="MDV.1", Name="MetaDataVersion"
-        )
-        protocol = ET.SubElement(metadata, "Protocol")
+"""
+Creates and writes the ODM of one Study Event. In incremental mode the file
+is only written if the content hash differs from the previous run.
+Returns (file name, content hash or None).
+"""
+def write_study_event(
+    key,
+    group,
+    output_dir,
+    name,
+    first_sheet_name,
+    CodeLists,
+    dictionary_names,
+    varname_number,
+    missing_lists,
+    missing_map,
+    options,
+    previous,
+):
+    metrics = options.metrics
+    start = time.perf_counter()
+    # create the name for the xml
+    whole_name = output_dir / f"Study_{name}_{key}.xml"
+    if options.compress == "gzip":
+        whole_name = whole_name.with_name(whole_name.name + ".gz")
 
-        # create studyevents and forms
-        count_f = 1
-        # get all studyevents with formrefs
-        ET.SubElement(protocol, "StudyEventRef", StudyEventOID="SE.1", Mandatory="No")
-        StudyEvent = ET.SubElement(
-            metadata,
-            "StudyEventDef",
-            OID="SE.1",
-            Name=key,
-            Repeating="No",
-            Type="Unscheduled",
-        )
-        for _, _ in group.items():
-            ET.SubElement(
-                StudyEvent, "FormRef", FormOID="F." + str(count_f), Mandatory="No"
-            )
-            count_f += 1
-        # get all formdefs with itemgrouprefs
-        count_f = 1
-        for key_segment, _ in group.items():
-            formdef = ET.SubElement(
-                metadata,
-                "FormDef",
-                OID="F." + str(count_f),
-                Name=key_segment,
-                Repeating="No",
+    digest = None
+    if options.incremental:
+        with metrics_phase(metrics, "study_event_digest"):
+            digest = study_event_digest(
+                key,
+                group,
+                name,
+                first_sheet_name,
+                CodeLists,
+                dictionary_names,
+                varname_number,
+                missing_lists,
+                missing_map,
+                options,
             )
-            ET.SubElement(
-                formdef,
-                "ItemGroupRef",
-                ItemGroupOID="IG." + str(count_f),
-                Mandatory="No",
-            )
-            count_f += 1
+        if previous.get(whole_name.name) == digest and whole_name.exists():
+            # unchanged since the last run
+            if metrics is not None:
+                metrics.add_file(whole_name.name, 0, {}, time.perf_counter() - start, True)
+            return whole_name.name, digest
 
-        # create itemgroups with refs
-        calculate_itemgroups_event(metadata, group)
-
-        """ Phase 1: compute final mapping (no writing) """
-        final_ref_map, combos_used = compute_final_ref_map(
-            CodeLists, group, varname_number, all_sheets, missing_map
+    with open_odm_file(whole_name, options.compress) as xml_file:
+        element_counts = write_odm(
+            xml_file,
+            key,
+            group,
+            name,
+            first_sheet_name,
+            CodeLists,
+            dictionary_names,
+            varname_number,
+            missing_lists,
+            missing_map,
+            options,
         )
+    if metrics is not None:
+        metrics.add_file(
+            whole_name.name,
+            whole_name.stat().st_size,
+            element_counts,
+            time.perf_counter() - start,
+        )
+    return whole_name.name, digest
 
-        """ Items (ItemDef*) — MUST appear before CodeList* """
-        count_id = 1
-        for _, values in group.items():
-            for line in values:
-                calculate_itemdef(metadata, line, count_id, CodeLists, dictionary_names, final_ref_map)
-                count_id += 1
-
-        """ Phase 2: emit CodeLists (CodeList*) after ItemDefs """
-        emit_union_codelists(CodeLists, combos_used, metadata, all_sheets, missing_map)
 
-        """ XML """
-        # Output Directory
-        output_dir = Path("../output")
-        output_dir.mkdir(parents=True, exist_ok=True)
+"""
+Open an ODM file for writing, with compress="gzip" as gzip stream: the ODM
+is compressed while it is serialized, nothing uncompressed hits the disk.
+The gzip header has no name and time, so the same ODM gives the same file.
+"""
+@contextmanager
+def open_odm_file(path, compress=None):
+    with open(path, "wb") as raw_file:
+        if compress == "gzip":
+            with gzip.GzipFile(
+                filename="", mode="wb", fileobj=raw_file, compresslevel=6, mtime=0
+            ) as gzip_file:
+                yield gzip_file
+        else:
+            yield raw_file
+
+
+"""
+Writes the ODMs of all Study Events as entries of one zip archive
+Study_<name>.zip, each compressed while it is serialized. The archive is
+built next to the old one and replaces it at the end. Returns the
+(entry name, None) pairs, entries are never skipped by --incremental.
+"""
+def write_study_event_archive(
+    varname_groups,
+    output_dir,
+    name,
+    first_sheet_name,
+    CodeLists,
+    dictionary_names,
+    varname_number,
+    missing_lists,
+    missing_map,
+    options,
+    previous,
+):
+    metrics = options.metrics
+    archive_path = output_dir / f"Study_{name}.zip"
+    tmp_path = archive_path.with_name(archive_path.name + ".tmp")
+    date_time = archive_date_time(options.creation_datetime)
+
+    written = []
+    with zipfile.ZipFile(tmp_path, "w", zipfile.ZIP_DEFLATED) as archive:
+        for key, group in varname_groups.items():
+            start = time.perf_counter()
+            info = zipfile.ZipInfo(f"Study_{name}_{key}.xml", date_time=date_time)
+            info.compress_type = zipfile.ZIP_DEFLATED
+            with archive.open(info, "w", force_zip64=True) as xml_file:
+                element_counts = write_odm(
+                    xml_file,
+                    key,
+                    group,
+                    name,
+                    first_sheet_name,
+                    CodeLists,
+                    dictionary_names,
+                    varname_number,
+                    missing_lists,
+                    missing_map,
+                    options,
+                )
+            if metrics is not None:
+                metrics.add_file(
+                    info.filename,
+                    archive.getinfo(info.filename).compress_size,
+                    element_counts,
+                    time.perf_counter() - start,
+                )
+            written.append((info.filename, None))
+    os.replace(tmp_path, archive_path)
+    return written
+
+
+"""
+PipelineStage is a thread of write_study_events_pipeline: it takes the
+Study Events from its input queue, processes them and puts the results into
+the next queue. It measures the time it works, waits for input (starved)
+and waits for space in the next queue (blocked by backpressure). After an
+error it only drains its input, so the stages before it never block.
+"""
+class PipelineStage(threading.Thread):
+    def __init__(self, name, work, inbox, outbox, errors):
+        """
+        :param name: Name of the stage (str)
+        :param work: Processes one Study Event, returns the input of the next stage (callable)
+        :param inbox: Input queue, None ends the stage (queue.Queue)
+        :param outbox: Queue of the next stage or None for the last stage (queue.Queue)
+        :param errors: Errors of all stages (list)
+        """
+        super().__init__(name=f"pipeline-{name}", daemon=True)
+        self.stage = name
+        self.work = work
+        self.inbox = inbox
+        self.outbox = outbox
+        self.errors = errors
+        self.items = 0
+        self.busy_seconds = 0.0
+        self.starved_seconds = 0.0
+        self.blocked_seconds = 0.0
+
+    def run(self):
+        while True:
+            start = time.perf_counter()
+            item = self.inbox.get()
+            self.starved_seconds += time.perf_counter() - start
+            if item is None:
+                break
+            if self.errors:
+                continue
+            start = time.perf_counter()
+            try:
+                result = self.work(item)
+            except Exception as e:
+                self.errors.append(e)
+                continue
+            finally:
+                self.busy_seconds += time.perf_counter() - start
+            self.items += 1
+            if self.outbox is not None:
+                start = time.perf_counter()
+                self.outbox.put(result)
+                self.blocked_seconds += time.perf_counter() - start
+        if self.outbox is not None:
+            self.outbox.put(None)
+
+    def report(self, wall_seconds):
+        return {
+            "items": self.items,
+            "busy_seconds": self.busy_seconds,
+            "starved_seconds": self.starved_seconds,
+            "blocked_seconds": self.blocked_seconds,
+            "utilisation": self.busy_seconds / wall_seconds if wall_seconds else 0.0,
+        }
+
+
+"""
+Writes the ODMs of all Study Events in three overlapping stages: this thread
+builds the trees (ItemDefs, CodeLists, ...), a serializer thread turns them
+into bytes and a writer thread writes (and compresses) the files, while the
+next Study Event is already built. The template emitter passes every ODM
+through the stages in batches of fragments (see template_batches) instead.
+The bounded queues between the stages (options.pipeline_depth) apply
+backpressure, at most that many trees, batches or byte strings wait at a
+time. lxml serializes and zlib compresses without the GIL, so the stages
+really run in parallel. Returns the same as write_study_event per Study
+Event; --jobs and --stream are not used.
+"""
+def write_study_events_pipeline(
+    varname_groups,
+    output_dir,
+    name,
+    first_sheet_name,
+    CodeLists,
+    dictionary_names,
+    varname_number,
+    missing_lists,
+    missing_map,
+    options,
+    previous,
+):
+    import queue
+    from contextlib import ExitStack
+
+    metrics = options.metrics
+    depth = max(1, options.pipeline_depth)
+    built = queue.Queue(maxsize=depth)
+    serialized = queue.Queue(maxsize=depth)
+    errors = []
+    written = [None] * len(varname_groups)
+    bytes_written = []
+    skipped = []
+    # the file that is being written: number -> (ExitStack, file)
+    open_files = {}
+
+    # every item is (number, key, whole_name, digest, document or bytes,
+    # element_counts, start, last part of the ODM)
+    def _serialize(item):
+        number, key, whole_name, digest, document, element_counts, start, last = item
+        if document is None:
+            return item
+        with metrics_phase(metrics, "serialization"):
+            if options.emitter == "template":
+                xml_bytes = "".join(document).encode("utf-8")
+            else:
+                xml_bytes = ET.tostring(
+                    document,
+                    encoding="utf-8",
+                    xml_declaration=True,
+                    pretty_print=options.pretty_print,
+                )
+        return number, key, whole_name, digest, xml_bytes, element_counts, start, last
+
+    def _write(item):
+        number, key, whole_name, digest, xml_bytes, element_counts, start, last = item
+        written[number] = (whole_name.name, digest)
+        if xml_bytes is None:
+            # unchanged since the last run
+            skipped.append(whole_name.name)
+            if metrics is not None:
+                metrics.add_file(whole_name.name, 0, {}, time.perf_counter() - start, True)
+            return
+        with metrics_phase(metrics, "write"):
+            if number not in open_files:
+                stack = ExitStack()
+                open_files[number] = (
+                    stack,
+                    stack.enter_context(open_odm_file(whole_name, options.compress)),
+                )
+            open_files[number][1].write(xml_bytes)
+            if not last:
+                return
+            open_files.pop(number)[0].close()
+        if metrics is not None:
+            bytes_written.append(whole_name.stat().st_size)
+            metrics.add_file(
+                whole_name.name,
+                bytes_written[-1],
+                element_counts,
+                time.perf_counter() - start,
+            )
+
+    serializer = PipelineStage("serialize", _serialize, built, serialized, errors)
+    writer = PipelineStage("write", _write, serialized, None, errors)
+    serializer.start()
+    writer.start()
+
+    """ Stage 1: build the trees """
+    wall_start = time.perf_counter()
+    build = {"items": 0, "busy_seconds": 0.0, "starved_seconds": 0.0, "blocked_seconds": 0.0}
+
+    def _put(item):
+        put_start = time.perf_counter()
+        built.put(item)
+        blocked = time.perf_counter() - put_start
+        build["blocked_seconds"] += blocked
+        build["items"] += 1
+        return blocked
+
+    try:
+        for number, (key, group) in enumerate(varname_groups.items()):
+            if errors:
+                break
+            start = time.perf_counter()
+            whole_name = output_dir / f"Study_{name}_{key}.xml"
+            if options.compress == "gzip":
+                whole_name = whole_name.with_name(whole_name.name + ".gz")
+            digest = document = metadata = None
+            element_counts = {}
+            if options.incremental:
+                with metrics_phase(metrics, "study_event_digest"):
+                    digest = study_event_digest(
+                        key,
+                        group,
+                        name,
+                        first_sheet_name,
+                        CodeLists,
+                        dictionary_names,
+                        varname_number,
+                        missing_lists,
+                        missing_map,
+                        options,
+                    )
+            if not (
+                options.incremental
+                and previous.get(whole_name.name) == digest
+                and whole_name.exists()
+            ):
+                if options.emitter == "template":
+                    fragments = render_metadata_fragments(
+                        key,
+                        group,
+                        CodeLists,
+                        dictionary_names,
+                        varname_number,
+                        missing_lists,
+                        missing_map,
+                        options.pretty_print,
+                        metrics,
+                        options.alias_profile,
+                        options.group_aliases,
+                    )
+                    if metrics is not None:
+                        fragments = _count_fragments(fragments, element_counts)
+                    # rendered batch by batch while the stages take them
+                    documents = template_batches(
+                        name,
+                        key,
+                        first_sheet_name,
+                        fragments,
+                        options.pretty_print,
+                        options.creation_datetime,
+                    )
+                else:
+                    elements = calculate_metadata_elements(
+                        key,
+                        group,
+                        CodeLists,
+                        dictionary_names,
+                        varname_number,
+                        missing_lists,
+                        missing_map,
+                        metrics,
+                        options.alias_profile,
+                        options.group_aliases,
+                    )
+                    if metrics is not None:
+                        elements = _count_elements(elements, element_counts)
+                    document, metadata = calculate_odm_root(
+                        name, key, first_sheet_name, options.creation_datetime
+                    )
+                    for element in elements:
+                        metadata.append(element)
+                    documents = [document]
+            else:
+                documents = [None]
+
+            blocked = 0.0
+            documents = iter(documents)
+            document = next(documents)
+            for following in documents:
+                blocked += _put(
+                    (number, key, whole_name, digest, document, element_counts, start, False)
+                )
+                document = following
+            blocked += _put(
+                (number, key, whole_name, digest, document, element_counts, start, True)
+            )
+            build["busy_seconds"] += time.perf_counter() - start - blocked
+            # only the queues keep trees alive
+            document = documents = metadata = None
+    finally:
+        built.put(None)
+        serializer.join()
+        writer.join()
+        # files left open by an error
+        for stack, _ in open_files.values():
+            stack.close()
+    if errors:
+        raise errors[0]
+
+    if metrics is not None:
+        wall_seconds = time.perf_counter() - wall_start
+        build["utilisation"] = build["busy_seconds"] / wall_seconds if wall_seconds else 0.0
+        metrics.pipeline = {
+            "depth": depth,
+            "files": len(bytes_written),
+            "skipped": len(skipped),
+            "bytes": sum(bytes_written),
+            "wall_seconds": wall_seconds,
+            "files_per_second": len(bytes_written) / wall_seconds if wall_seconds else 0.0,
+            "mib_per_second": (
+                sum(bytes_written) / 2**20 / wall_seconds if wall_seconds else 0.0
+            ),
+            "stages": {
+                "build": build,
+                "serialize": serializer.report(wall_seconds),
+                "write": writer.report(wall_seconds),
+            },
+        }
+    return written
+
+
+def archive_date_time(creation_datetime=None):
+    # the time of the zip entries follows a fixed CreationDateTime
+    if creation_datetime:
+        try:
+            return datetime.fromisoformat(creation_datetime).timetuple()[:6]
+        except ValueError:
+            pass
+    return time.localtime()[:6]
+
+
+"""
+Writes the ODM of one Study Event to a binary file object, either streamed
+or built as a whole tree. Returns the number of MetaDataVersion children
+per tag (only counted if the conversion is instrumented).
+"""
+def write_odm(
+    xml_file,
+    key,
+    group,
+    name,
+    first_sheet_name,
+    CodeLists,
+    dictionary_names,
+    varname_number,
+    missing_lists,
+    missing_map,
+    options,
+):
+    metrics = options.metrics
+    # all children of MetaDataVersion, built one at a time
+    elements = calculate_metadata_elements(
+        key,
+        group,
+        CodeLists,
+        dictionary_names,
+        varname_number,
+        missing_lists,
+        missing_map,
+        metrics,
+        options.alias_profile,
+        options.group_aliases,
+    )
+    element_counts = {}
+    if metrics is not None:
+        elements = _count_elements(elements, element_counts)
+
+    if options.emitter == "template":
+        fragments = render_metadata_fragments(
+            key,
+            group,
+            CodeLists,
+            dictionary_names,
+            varname_number,
+            missing_lists,
+            missing_map,
+            options.pretty_print,
+            metrics,
+            options.alias_profile,
+            options.group_aliases,
+        )
+        if metrics is not None:
+            fragments = _count_fragments(fragments, element_counts)
+        write_odm_template(
+            xml_file,
+            name,
+            key,
+            first_sheet_name,
+            fragments,
+            options.pretty_print,
+            options.creation_datetime,
+            metrics,
+        )
+    elif options.streaming:
+        write_odm_stream(
+            xml_file,
+            name,
+            key,
+            first_sheet_name,
+            elements,
+            options.pretty_print,
+            options.creation_datetime,
+            metrics,
+        )
+    else:
+        odm, metadata = calculate_odm_root(
+            name, key, first_sheet_name, options.creation_datetime
+        )
+        for element in elements:
+            metadata.append(element)
+        # create the xml (with indentations)
+        with metrics_phase(metrics, "serialization"):
+            xml_bytes = ET.tostring(
+                odm,
+                encoding="utf-8",
+                xml_declaration=True,
+                pretty_print=options.pretty_print,
+            )
+            xml_file.write(xml_bytes)
+    return element_counts
+
+
+def _count_elements(elements, counts):
+    # count the MetaDataVersion children per tag while they pass through
+    for element in elements:
+        counts[element.tag] = counts.get(element.tag, 0) + 1
+        yield element
+
+
+def _count_fragments(fragments, counts):
+    # the same for the (tag, text) fragments of the template emitter
+    for tag, text in fragments:
+        counts[tag] = counts.get(tag, 0) + 1
+        yield tag, text
+
+
+# state shared by all Study Events, set once in every worker process
+_worker_shared = {}
+
+
+def _init_worker(shared):
+    _worker_shared.update(shared)
+
+
+def _write_study_event_worker(key, group):
+    # returns the metrics of this task, so the parent can merge them
+    metrics = _worker_shared["options"].metrics
+    if metrics is None:
+        return write_study_event(key, group, **_worker_shared), None
+    metrics.reset()
+    result = write_study_event(key, group, **_worker_shared)
+    return result, metrics.to_dict()
+
+
+"""
+Content hash of everything the ODM of one Study Event is built from: its
+rows and Forms, the columns, the CodeLists and missing lists it references
+and the options that change the output. CreationDateTime only counts if it
+is fixed with --creation-datetime.
+"""
+def study_event_digest(
+    key,
+    group,
+    name,
+    first_sheet_name,
+    CodeLists,
+    dictionary_names,
+    varname_number,
+    missing_lists,
+    missing_map,
+    options,
+):
+    digest = hashlib.sha256()
+
+    def _update(value):
+        digest.update(repr(value).encode("utf-8"))
+        digest.update(b"\0")
+
+    _update(
+        (
+            MANIFEST_VERSION,
+            name,
+            str(key),
+            first_sheet_name,
+            options.pretty_print,
+            options.creation_datetime,
+        )
+    )
+    _update(list(dictionary_names.items()))
+    if options.alias_profile != "full" or options.group_aliases:
+        # only then, manifests of earlier versions stay valid
+        _update((options.alias_profile, options.group_aliases))
+    for study_segment, lines in group.items():
+        _update(study_segment)
+        for line in lines:
+            _update(list(line))
+    _, combos_used = compute_final_ref_map(
+        CodeLists, group, varname_number, missing_lists, missing_map
+    )
+    for base_number, sheet in sorted(combos_used, key=lambda x: (x[0], str(x[1]))):
+        base = CodeLists.get(base_number)
+        _update(
+            (
+                base_number,
+                sheet,
+                list(base.codelist_de.items()),
+                list(base.codelist_en.items()),
+            )
+        )
+        missing_list = missing_lists.get(sheet) if sheet else None
+        if missing_list is not None:
+            _update((missing_list.non_integer, missing_list.rows))
+    return digest.hexdigest()
+
+
+"""
+Read the manifest of content hashes ({"studies": {name: {file: hash}}}).
+A missing, unreadable or outdated manifest means everything is rebuilt.
+"""
+def read_manifest(manifest_path):
+    try:
+        with open(manifest_path, encoding="utf-8") as manifest_file:
+            manifest = json.load(manifest_file)
+        if manifest.get("version") == MANIFEST_VERSION:
+            return manifest
+    except (OSError, ValueError, AttributeError):
+        pass
+    return {"version": MANIFEST_VERSION, "studies": {}}
+
+
+def write_manifest(manifest_path, manifest):
+    # replace atomically, an interrupted run must not leave a broken manifest
+    tmp_path = manifest_path.with_name(manifest_path.name + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as manifest_file:
+        json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+
+
+""" Root-Element """
+def calculate_odm_attributes(name, creation_datetime=None):
+    return {
+        "FileType": "Snapshot",
+        "FileOID": "Project " + str(name),
+        "CreationDateTime": creation_datetime or datetime.now().isoformat(),
+        "ODMVersion": "1.3.2",
+        "SourceSystem": "OpenEDC",
+    }
+
+
+""" Global Variables """
+def calculate_global_variables(name, key, first_sheet_name):
+    global_variables = ET.Element("GlobalVariables")
+    # StudyName, StudyDescription and ProtocolName
+    ET.SubElement(global_variables, "StudyName").text = (
+        "Study " + name + "_" + str(key)
+    )
+    ET.SubElement(global_variables, "StudyDescription").text = (
+        "This example study aims at providing an overview of the capabilities of OpenEDC."
+    )
+    # Use file base name and first sheet for traceability, but without column names.
+    ET.SubElement(global_variables, "ProtocolName").text = f"{name}---{first_sheet_name}"
+    return global_variables
+
+
+"""
+Creates the ODM tree down to an empty MetaDataVersion (see calculate_odm).
+"""
+def calculate_odm_root(name, key, first_sheet_name, creation_datetime=None):
+    odm = ET.Element(
+        "ODM", nsmap=ODM_NSMAP, **calculate_odm_attributes(name, creation_datetime)
+    )
+    study = ET.SubElement(odm, "Study", OID=name)
+    study.append(calculate_global_variables(name, key, first_sheet_name))
+    metadata = ET.SubElement(study, "MetaDataVersion", **METADATA_ATTRIBUTES)
+    return odm, metadata
+
+
+"""
+Yields the children of MetaDataVersion of one Study Event in document order:
+Protocol, StudyEventDef, FormDef*, ItemGroupDef*, ItemDef*, CodeList*.
+Every element is built on its own and detached before it is yielded,
+so the caller decides whether to keep it in a tree or write and drop it.
+The Alias elements follow alias_profile; with group_aliases the aliases
+that are the same for all items are written once in the StudyEventDef.
+"""
+def calculate_metadata_elements(
+    key,
+    group,
+    CodeLists,
+    dictionary_names,
+    varname_number,
+    missing_lists,
+    missing_map,
+    metrics=None,
+    alias_profile="full",
+    group_aliases=False,
+):
+    scratch = ET.Element("MetaDataVersion")
+    aliases = alias_columns(dictionary_names, alias_profile)
+    constants = group_constant_aliases(group, aliases) if group_aliases else {}
+    if constants:
+        aliases = alias_columns(aliases, "full", constants)
+
+    def _detach():
+        for element in list(scratch):
+            scratch.remove(element)
+            yield element
+
+    """ Metadata, Study Event, Form, Item Group """
+    protocol = ET.SubElement(scratch, "Protocol")
+
+    # create studyevents and forms
+    count_f = 1
+    # get all studyevents with formrefs
+    ET.SubElement(protocol, "StudyEventRef", StudyEventOID="SE.1", Mandatory="No")
+    StudyEvent = ET.SubElement(
+        scratch,
+        "StudyEventDef",
+        OID="SE.1",
+        Name=key,
+        Repeating="No",
+        Type="Unscheduled",
+    )
+    for _, _ in group.items():
+        ET.SubElement(
+            StudyEvent, "FormRef", FormOID="F." + str(count_f), Mandatory="No"
+        )
+        count_f += 1
+    for context, value in constants.items():
+        ET.SubElement(StudyEvent, "Alias", Context=str(context), Name=value)
+    yield from _detach()
+    # get all formdefs with itemgrouprefs
+    count_f = 1
+    for key_segment, _ in group.items():
+        formdef = ET.SubElement(
+            scratch,
+            "FormDef",
+            OID="F." + str(count_f),
+            Name=key_segment,
+            Repeating="No",
+        )
+        ET.SubElement(
+            formdef,
+            "ItemGroupRef",
+            ItemGroupOID="IG." + str(count_f),
+            Mandatory="No",
+        )
+        count_f += 1
+        yield from _detach()
+
+    # create itemgroups with refs
+    with metrics_phase(metrics, "calculate_itemgroups_event"):
+        calculate_itemgroups_event(scratch, group)
+    yield from _detach()
+
+    """ Phase 1: compute final mapping (no writing) """
+    with metrics_phase(metrics, "compute_final_ref_map"):
+        final_ref_map, combos_used = compute_final_ref_map(
+            CodeLists, group, varname_number, missing_lists, missing_map
+        )
+
+    """ Items (ItemDef*) — MUST appear before CodeList* """
+    count_id = 1
+    for _, values in group.items():
+        for line in values:
+            with metrics_phase(metrics, "calculate_itemdef"):
+                calculate_itemdef(
+                    scratch,
+                    line,
+                    count_id,
+                    CodeLists,
+                    dictionary_names,
+                    final_ref_map,
+                    aliases,
+                )
+            count_id += 1
+            yield from _detach()
+
+    """ Phase 2: emit CodeLists (CodeList*) after ItemDefs """
+    for base_number, sheet in sorted(combos_used, key=lambda x: (x[0], str(x[1]))):
+        with metrics_phase(metrics, "emit_union_codelists"):
+            emit_union_codelist(
+                CodeLists, base_number, sheet, scratch, missing_lists, alias_profile
+            )
+        yield from _detach()
+
+
+"""
+Writes one ODM incrementally with lxml.etree.xmlfile: the root, Study and
+MetaDataVersion are opened as streaming elements and every MetaDataVersion
+child is serialized and released as soon as it is produced, so memory does
+not grow with the number of items. The bytes equal ET.tostring of the tree.
+"""
+def write_odm_stream(
+    xml_file,
+    name,
+    key,
+    first_sheet_name,
+    elements,
+    pretty_print=True,
+    creation_datetime=None,
+    metrics=None,
+):
+
+    def _indent(xf, level):
+        if pretty_print:
+            xf.write("\n" + "  " * level)
+
+    def _write(xf, element, level):
+        _indent(xf, level)
+        if pretty_print:
+            ET.indent(element, space="  ", level=level)
+        xf.write(element)
+
+    xml_file.write(b"<?xml version='1.0' encoding='utf-8'?>\n")
+    with ET.xmlfile(xml_file, encoding="utf-8") as xf:
+        with xf.element(
+            "ODM", calculate_odm_attributes(name, creation_datetime), nsmap=ODM_NSMAP
+        ):
+            _indent(xf, 1)
+            with xf.element("Study", OID=name):
+                _write(xf, calculate_global_variables(name, key, first_sheet_name), 2)
+                _indent(xf, 2)
+                with xf.element("MetaDataVersion", METADATA_ATTRIBUTES):
+                    for element in elements:
+                        with metrics_phase(metrics, "serialization"):
+                            _write(xf, element, 3)
+                    _indent(xf, 2)
+                _indent(xf, 1)
+            _indent(xf, 0)
+    if pretty_print:
+        xml_file.write(b"\n")
+
+
+"""
+Template emitter (--emitter template): renders the MetaDataVersion children
+from precompiled string templates instead of lxml elements and writes the
+same bytes as ET.tostring. Text and attribute values are escaped like
+libxml2 does; strings lxml would reject raise the same ValueError.
+"""
+_TEXT_ESCAPES = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;", "\r": "&#13;"})
+_ATTRIBUTE_ESCAPES = str.maketrans(
+    {
+        "&": "&amp;",
+        "<": "&lt;",
+        ">": "&gt;",
+        '"': "&quot;",
+        "\n": "&#10;",
+        "\t": "&#9;",
+        "\r": "&#13;",
+    }
+)
+_TEXT_SPECIAL = re.compile("[&<>\r\x00-\x08\x0b\x0c\x0e-\x1f]")
+_ATTRIBUTE_SPECIAL = re.compile('[&<>"\n\t\r\x00-\x08\x0b\x0c\x0e-\x1f]')
+_XML_INCOMPATIBLE = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f]")
+# number of fragments joined into one write
+TEMPLATE_WRITE_FRAGMENTS = 256
+
+
+def _check_xml_compatible(value):
+    if _XML_INCOMPATIBLE.search(value):
+        raise ValueError(
+            "All strings must be XML compatible: Unicode or ASCII, "
+            "no NULL bytes or control characters"
+        )
+
+
+def escape_text(value):
+    if _TEXT_SPECIAL.search(value) is None:
+        return value
+    _check_xml_compatible(value)
+    return value.translate(_TEXT_ESCAPES)
+
+
+def escape_attribute(value):
+    if _ATTRIBUTE_SPECIAL.search(value) is None:
+        return value
+    _check_xml_compatible(value)
+    return value.translate(_ATTRIBUTE_ESCAPES)
+
+
+"""
+Line breaks with indentation per level (empty without pretty_print).
+"""
+@lru_cache(maxsize=2)
+def template_indents(pretty_print):
+    return tuple(("\n" + "  " * level) if pretty_print else "" for level in range(8))
+
+
+def _translated_text(nl, lang, text):
+    return f'{nl}<TranslatedText xml:lang="{lang}">{escape_text(text)}</TranslatedText>'
+
+
+"""
+Template of the CodeListItem of a missing-list row (see MissingList.items).
+"""
+def render_missing_item(code, label, aliases, nl):
+    parts = [
+        f'{nl[4]}<CodeListItem CodedValue="{escape_attribute(code)}">',
+        f"{nl[5]}<Decode>",
+        _translated_text(nl[6], "en", label),
+        f"{nl[5]}</Decode>",
+    ]
+    for context, alias in aliases:
+        parts.append(
+            f'{nl[5]}<Alias Context="{escape_attribute(context)}" '
+            f'Name="{escape_attribute(alias)}"/>'
+        )
+    parts.append(f"{nl[4]}</CodeListItem>")
+    return "".join(parts)
+
+
+"""
+ItemDef as text, the template version of calculate_itemdef. alias_templates
+are the (column, start of the Alias tag) pairs of all columns.
+"""
+def render_itemdef(line, count_id, CodeLists, dictionary, final_ref_map, alias_templates, nl):
+    varname_number = dictionary.get("VARNAMES", dictionary.get("VAR_NAMES", None))
+    varname = extract_from_line(line, varname_number)
+    label = extract_from_line(line, dictionary.get("LABEL", None))
+    label_de = extract_from_line(line, dictionary.get("LABEL_DE", None))
+    note = extract_from_line(line, dictionary.get("NOTE", None))
+    note_de = extract_from_line(line, dictionary.get("NOTE_DE", None))
+    data_type = extract_from_line(line, dictionary.get("DATA_TYPE", None))
+    if data_type not in {
+        "integer",
+        "float",
+        "double",
+        "date",
+        "time",
+        "datetime",
+        "string",
+        "boolean",
+    }:
+        data_type = "string"
+
+    parts = [
+        f'<ItemDef OID="I.{count_id}" Name="{escape_attribute(str(varname))}" '
+        f'DataType="{data_type}">'
+    ]
+    # description in the item as note and note_de
+    if notna(note_de) or notna(note):
+        parts.append(f"{nl[4]}<Description>")
+        if notna(note_de):
+            parts.append(_translated_text(nl[5], "de", str(note_de)))
+        if notna(note):
+            parts.append(_translated_text(nl[5], "en", str(note)))
+        parts.append(f"{nl[4]}</Description>")
+    # question in the item
+    parts.append(f"{nl[4]}<Question>")
+    if notna(label) or notna(label_de):
+        if notna(label_de):
+            parts.append(_translated_text(nl[5], "de", str(label_de)))
+        if notna(label):
+            parts.append(_translated_text(nl[5], "en", str(label)))
+    else:
+        parts.append(_translated_text(nl[5], "de", "None"))
+        parts.append(_translated_text(nl[5], "en", "None"))
+    parts.append(f"{nl[4]}</Question>")
+
+    # CodeListRef: per-(base,missing) final OID
+    final_oid = final_ref_map.get(str(varname))
+    if not final_oid:
+        codelist = CodeLists.first_with_name(varname)
+        if codelist is not None:
+            final_oid = "CL." + str(codelist.number)
+    if final_oid:
+        parts.append(f'{nl[4]}<CodeListRef CodeListOID="{escape_attribute(final_oid)}"/>')
+
+    # Alias (all columns in the source line)
+    for number, alias_start in alias_templates:
+        val = extract_from_line(line, number)
+        if notna(val):
+            parts.append(f'{alias_start}{escape_attribute(str(val))}"/>')
+    parts.append(f"{nl[3]}</ItemDef>")
+    return "".join(parts)
+
+
+"""
+Union CodeList as text, the template version of emit_union_codelist.
+"""
+def render_union_codelist(
+    CodeLists, base_number, sheet, missing_lists, nl, alias_profile="full"
+):
+    base = CodeLists.get(base_number)
+    if base is None:
+        return None
+
+    union_dtype = CodeLists.datatype(base)
+    oid, name = _stable_combo_oid(base_number, sheet)
+    parts = []
+    used = set()
+
+    # 1) base codes
+    if len(base.codelist_de) > 0:
+        for k, v in base.codelist_de.items():
+            parts.append(f'{nl[4]}<CodeListItem CodedValue="{escape_attribute(str(k))}">')
+            parts.append(f"{nl[5]}<Decode>")
+            parts.append(_translated_text(nl[6], "de", v))
+            if k in base.codelist_en:
+                parts.append(_translated_text(nl[6], "en", base.codelist_en[k]))
+            parts.append(f"{nl[5]}</Decode>{nl[4]}</CodeListItem>")
+            used.add(str(k))
+    elif len(base.codelist_en) > 0:
+        for k, v in base.codelist_en.items():
+            parts.append(f'{nl[4]}<CodeListItem CodedValue="{escape_attribute(str(k))}">')
+            parts.append(f"{nl[5]}<Decode>")
+            parts.append(_translated_text(nl[6], "en", v))
+            parts.append(f"{nl[5]}</Decode>{nl[4]}</CodeListItem>")
+            used.add(str(k))
+
+    # 2) missing codes
+    if sheet:
+        missing_list = missing_lists.get(sheet)
+        if missing_list is not None:
+            if missing_list.non_integer:
+                union_dtype = _promote_dtype(union_dtype, "string")
+            for code, item in missing_list.rendered_items(nl, alias_profile):
+                if code not in used:
+                    parts.append(item)
+
+    start = (
+        f'<CodeList OID="{escape_attribute(oid)}" Name="{escape_attribute(name)}" '
+        f'DataType="{union_dtype}"'
+    )
+    if not parts:
+        return start + "/>"
+    return start + ">" + "".join(parts) + f"{nl[3]}</CodeList>"
+
+
+"""
+Yields the children of MetaDataVersion of one Study Event as (tag, text)
+fragments in the order of calculate_metadata_elements, indented for level 3.
+"""
+def render_metadata_fragments(
+    key,
+    group,
+    CodeLists,
+    dictionary_names,
+    varname_number,
+    missing_lists,
+    missing_map,
+    pretty_print=True,
+    metrics=None,
+    alias_profile="full",
+    group_aliases=False,
+):
+    nl = template_indents(pretty_print)
+    key_attribute = escape_attribute(key)
+    aliases = alias_columns(dictionary_names, alias_profile)
+    constants = group_constant_aliases(group, aliases) if group_aliases else {}
+    if constants:
+        aliases = alias_columns(aliases, "full", constants)
+
+    """ Metadata, Study Event, Form, Item Group """
+    yield "Protocol", (
+        f'<Protocol>{nl[4]}<StudyEventRef StudyEventOID="SE.1" Mandatory="No"/>'
+        f"{nl[3]}</Protocol>"
+    )
+    start = f'<StudyEventDef OID="SE.1" Name="{key_attribute}" Repeating="No" Type="Unscheduled"'
+    if group or constants:
+        form_refs = "".join(
+            f'{nl[4]}<FormRef FormOID="F.{count_f}" Mandatory="No"/>'
+            for count_f in range(1, len(group) + 1)
+        ) + "".join(
+            f'{nl[4]}<Alias Context="{escape_attribute(str(context))}" '
+            f'Name="{escape_attribute(value)}"/>'
+            for context, value in constants.items()
+        )
+        yield "StudyEventDef", f"{start}>{form_refs}{nl[3]}</StudyEventDef>"
+    else:
+        yield "StudyEventDef", start + "/>"
+    for count_f, key_segment in enumerate(group, 1):
+        yield "FormDef", (
+            f'<FormDef OID="F.{count_f}" Name="{escape_attribute(key_segment)}" Repeating="No">'
+            f'{nl[4]}<ItemGroupRef ItemGroupOID="IG.{count_f}" Mandatory="No"/>'
+            f"{nl[3]}</FormDef>"
+        )
+
+    with metrics_phase(metrics, "calculate_itemgroups_event"):
+        itemgroups = []
+        count_id = 1
+        for count_ig, (key_segment, values) in enumerate(group.items(), 1):
+            text = escape_text("Item Group " + str(key_segment))
+            parts = [
+                f'<ItemGroupDef OID="IG.{count_ig}" Name="{escape_attribute(str(key_segment))}" '
+                f'Repeating="No">{nl[4]}<Description>',
+                f'{nl[5]}<TranslatedText xml:lang="de">{text}</TranslatedText>',
+                f'{nl[5]}<TranslatedText xml:lang="en">{text}</TranslatedText>',
+                f"{nl[4]}</Description>",
+            ]
+            for _line in values:
+                parts.append(f'{nl[4]}<ItemRef ItemOID="I.{count_id}" Mandatory="No"/>')
+                count_id += 1
+            parts.append(f"{nl[3]}</ItemGroupDef>")
+            itemgroups.append("".join(parts))
+    for text in itemgroups:
+        yield "ItemGroupDef", text
+
+    """ Phase 1: compute final mapping (no writing) """
+    with metrics_phase(metrics, "compute_final_ref_map"):
+        final_ref_map, combos_used = compute_final_ref_map(
+            CodeLists, group, varname_number, missing_lists, missing_map
+        )
+
+    """ Items (ItemDef*) — MUST appear before CodeList* """
+    alias_templates = [
+        (number, f'{nl[4]}<Alias Context="{escape_attribute(str(context))}" Name="')
+        for context, number in aliases.items()
+    ]
+    count_id = 1
+    for _, values in group.items():
+        for line in values:
+            with metrics_phase(metrics, "calculate_itemdef"):
+                text = render_itemdef(
+                    line,
+                    count_id,
+                    CodeLists,
+                    dictionary_names,
+                    final_ref_map,
+                    alias_templates,
+                    nl,
+                )
+            count_id += 1
+            yield "ItemDef", text
+
+    """ Phase 2: emit CodeLists (CodeList*) after ItemDefs """
+    for base_number, sheet in sorted(combos_used, key=lambda x: (x[0], str(x[1]))):
+        with metrics_phase(metrics, "emit_union_codelists"):
+            text = render_union_codelist(
+                CodeLists, base_number, sheet, missing_lists, nl, alias_profile
+            )
+        if text is not None:
+            yield "CodeList", text
+
+
+"""
+Yields one ODM from the fragments of render_metadata_fragments as lists of
+texts of up to TEMPLATE_WRITE_FRAGMENTS fragments, the first with the head
+and the last with the end of the document. Joined, they equal ET.tostring
+of the lxml tree.
+"""
+def template_batches(
+    name,
+    key,
+    first_sheet_name,
+    fragments,
+    pretty_print=True,
+    creation_datetime=None,
+):
+    nl = template_indents(pretty_print)
+    namespaces = "".join(
+        f' xmlns="{escape_attribute(uri)}"' if prefix is None
+        else f' xmlns:{prefix}="{escape_attribute(uri)}"'
+        for prefix, uri in ODM_NSMAP.items()
+    )
+    attributes = "".join(
+        f' {attribute}="{escape_attribute(value)}"'
+        for attribute, value in calculate_odm_attributes(name, creation_datetime).items()
+    )
+    metadata_attributes = "".join(
+        f' {attribute}="{escape_attribute(value)}"'
+        for attribute, value in METADATA_ATTRIBUTES.items()
+    )
+    study_name = escape_text("Study " + name + "_" + str(key))
+    protocol_name = escape_text(f"{name}---{first_sheet_name}")
+    head = (
+        "<?xml version='1.0' encoding='utf-8'?>\n"
+        f"<ODM{namespaces}{attributes}>"
+        f'{nl[1]}<Study OID="{escape_attribute(name)}">'
+        f"{nl[2]}<GlobalVariables>"
+        f"{nl[3]}<StudyName>{study_name}</StudyName>"
+        f"{nl[3]}<StudyDescription>This example study aims at providing an overview "
+        "of the capabilities of OpenEDC.</StudyDescription>"
+        f"{nl[3]}<ProtocolName>{protocol_name}</ProtocolName>"
+        f"{nl[2]}</GlobalVariables>"
+        f"{nl[2]}<MetaDataVersion{metadata_attributes}>"
+    )
+
+    batch = [head]
+    for _, text in fragments:
+        batch.append(nl[3])
+        batch.append(text)
+        if len(batch) >= 2 * TEMPLATE_WRITE_FRAGMENTS:
+            yield batch
+            batch = []
+    batch.append(f"{nl[2]}</MetaDataVersion>{nl[1]}</Study>{nl[0]}</ODM>")
+    if pretty_print:
+        batch.append("\n")
+    yield batch
+
+
+"""
+Writes one ODM from the fragments of render_metadata_fragments. The
+fragments are written in batches, memory does not grow with the number of
+items (like --stream). The bytes equal ET.tostring of the lxml tree.
+"""
+def write_odm_template(
+    xml_file,
+    name,
+    key,
+    first_sheet_name,
+    fragments,
+    pretty_print=True,
+    creation_datetime=None,
+    metrics=None,
+):
+    for batch in template_batches(
+        name, key, first_sheet_name, fragments, pretty_print, creation_datetime
+    ):
+        with metrics_phase(metrics, "serialization"):
+            xml_file.write("".join(batch).encode("utf-8"))
+
+
+"""
+HierarchyNode is a node of the prefix trie over the HIERARCHY paths
+("SHIP|SHIP0|a|b" -> ("SHIP", "SHIP0", "a", "b")) of one Study Event.
+It totals the weight (items or estimated bytes) and the CodeLists of its
+whole subtree and keeps the weights of the items whose path ends here.
+"""
+class HierarchyNode:
+    def __init__(self, path):
+        """
+        :param path: The HIERARCHY parts leading to this node (tuple)
+        """
+        self.path = path
+        self.children = {}
+        self.weight = 0
+        self.combos = set()
+        # (weight, combo) of the items whose path ends here
+        self.own = []
+        # Study Event of the whole subtree, if it fits
+        self.key = None
+        # Study Event of every own item, if the subtree does not fit
+        self.own_keys = None
+        self.own_chunked = False
+
+    def child(self, part):
+        node = self.children.get(part)
+        if node is None:
+            node = HierarchyNode(self.path + (part,))
+            self.children[part] = node
+        return node
+
+
+"""
+SizeEstimator estimates the serialized size of an item (ItemDef and ItemRef)
+and of the union CodeLists it pulls in, for splitting by bytes (--max-bytes).
+CodeLists are counted once per ODM file, however many items use them; the
+rest of the file is a fixed FILE allowance, so Study Events with many Forms
+can come out a little bigger than the limit.
+"""
+class SizeEstimator:
+    # approximate bytes of the markup around the values (pretty printed)
+    ITEM = 170
+    ITEMREF = 50
+    TRANSLATED_TEXT = 60
+    ALIAS = 38
+    CODELIST = 90
+    CODELISTITEM = 100
+    # ODM header, GlobalVariables, StudyEventDef and one FormDef/ItemGroupDef
+    FILE = 1500
+
+    def __init__(self, CodeLists, dictionary_names, varname_number, missing_lists, missing_map):
+        self.CodeLists = CodeLists
+        self.dictionary_names = dictionary_names
+        self.varname_number = varname_number
+        self.missing_lists = missing_lists
+        self.missing_map = missing_map
+        self._codelists = {}
+        # columns that are written as TranslatedText in addition to their Alias
+        self._texts = [
+            dictionary_names[column]
+            for column in ("NOTE", "NOTE_DE", "LABEL", "LABEL_DE")
+            if column in dictionary_names
+        ]
+
+    def item(self, line):
+        """
+        Estimated bytes of one item and its (base.number, sheet) combo or None.
+        """
+        size = self.ITEM + self.ITEMREF
+        for context, number in self.dictionary_names.items():
+            value = line[number]
+            if notna(value):
+                size += self.ALIAS + len(context) + len(str(value))
+        for number in self._texts:
+            value = line[number]
+            if notna(value):
+                size += self.TRANSLATED_TEXT + len(str(value))
+        # same mapping as compute_final_ref_map
+        ref = self.CodeLists.refs.get(str(line[self.varname_number]))
+        if ref is None:
+            return size, None
+        return size, ref[:2]
+
+    def codelist(self, combo):
+        """
+        Estimated bytes of the union CodeList of a (base.number, sheet) combo.
+        """
+        size = self._codelists.get(combo)
+        if size is None:
+            base_number, sheet = combo
+            base = self.CodeLists.get(base_number)
+            size = self.CODELIST + 2 * len(str(base_number)) + len(str(sheet))
+            for codelist in (base.codelist_de, base.codelist_en):
+                for key, value in codelist.items():
+                    size += self.TRANSLATED_TEXT + len(str(key)) + len(str(value))
+            size += self.CODELISTITEM * len(base.codelist_de or base.codelist_en)
+            missing_list = self.missing_lists.get(sheet) if sheet else None
+            if missing_list is not None:
+                for code, label, aliases in missing_list.rows:
+                    size += self.CODELISTITEM + self.TRANSLATED_TEXT + len(code) + len(label)
+                    for context, alias in aliases:
+                        size += self.ALIAS + len(context) + len(alias)
+            self._codelists[combo] = size
+        return size
+
+
+"""
+Split the HIERARCHY value of a row into the parts of its trie path.
+"""
+def hierarchy_path(value):
+    if isna(value):
+        return ()
+    return tuple(str(value).split("|"))
+
+
+"""
+Split one Study Event that is bigger than limit along HIERARCHY.
+
+A trie over the HIERARCHY paths is built once and totals the weights
+bottom-up: one per item, or with an estimator the estimated bytes of the
+items plus the CodeLists they use. Going down from the root, every subtree
+that fits becomes a Study Event named after its path ("SHIP_SHIP0_a") with
+STUDY_SEGMENT as Form; subtrees that are too big are split further at any
+depth. Items ending at a node that is too big are chunked ("SHIP_SHIP0_0",
+with one Form named like the chunk). With an estimator, neighbouring
+subtrees that fit are also packed together into numbered Study Events
+("SHIP_SHIP0_1") as long as they stay under the limit. Numbered keys skip
+the ones in taken and are added to it as they are handed out. Items keep
+their order. Returns a list of (key, group).
+"""
+def split_group(
+    key, group, hierarchy_column, study_segment_column, limit, estimator=None, taken=None
+):
+    if taken is None:
+        taken = set()
+
+    def _item(item):
+        if estimator is None:
+            return 1, None
+        return estimator.item(item)
+
+    def _size(weight, combos):
+        if estimator is None:
+            return weight
+        return weight + sum(estimator.codelist(combo) for combo in combos)
+
+    """ Trie """
+    root = HierarchyNode(())
+    paths = {}
+    for _, items in group.items():
+        for item in items:
+            path = hierarchy_path(item[hierarchy_column])
+            paths[id(item)] = path
+            weight, combo = _item(item)
+            node = root
+            while True:
+                node.weight += weight
+                if combo is not None:
+                    node.combos.add(combo)
+                if len(node.path) == len(path):
+                    break
+                node = node.child(path[len(node.path)])
+            node.own.append((weight, combo))
+
+    if _size(root.weight, root.combos) <= limit:
+        return [(key, group)]
+
+    def _key(node):
+        if node is root:
+            # items without HIERARCHY
+            return ""
+        return "_".join(node.path)
+
+    """ Assign the Study Events, top-down """
+    def _assign(node):
+        number = 0
+
+        def _numbered():
+            nonlocal number
+            numbered = f"{_key(node) or key}_{number}"
+            while numbered in taken:
+                number += 1
+                numbered = f"{_key(node) or key}_{number}"
+            number += 1
+            taken.add(numbered)
+            return numbered
+
+        # own items first, then the subtrees (None marks the own items)
+        parts = ([None] if node.own else []) + list(node.children.values())
+        bins = []
+        for part in parts:
+            if part is None:
+                weight = sum(w for w, _ in node.own)
+                combos = {c for _, c in node.own if c is not None}
+            else:
+                weight, combos = part.weight, part.combos
+            if _size(weight, combos) > limit:
+                if part is not None:
+                    _assign(part)
+                    continue
+                # chunk the own items
+                node.own_chunked = True
+                node.own_keys = []
+                chunk_key, chunk_weight, chunk_combos = None, 0, set()
+                for w, c in node.own:
+                    combo = {c} if c is not None else set()
+                    if chunk_key is None or _size(chunk_weight + w, chunk_combos | combo) > limit:
+                        chunk_key, chunk_weight, chunk_combos = _numbered(), 0, set()
+                    chunk_weight += w
+                    chunk_combos |= combo
+                    node.own_keys.append(chunk_key)
+                continue
+            if (
+                estimator is not None
+                and bins
+                and _size(bins[-1][1] + weight, bins[-1][2] | combos) <= limit
+            ):
+                bins[-1][0].append(part)
+                bins[-1][1] += weight
+                bins[-1][2] |= combos
+            else:
+                bins.append([[part], weight, set(combos)])
+
+        for bin_parts, _, _ in bins:
+            if len(bin_parts) > 1:
+                bin_key = _numbered()
+            elif bin_parts[0] is None:
+                bin_key = _key(node)
+            else:
+                bin_key = _key(bin_parts[0])
+            for part in bin_parts:
+                if part is None:
+                    node.own_keys = [bin_key] * len(node.own)
+                else:
+                    part.key = bin_key
+
+    _assign(root)
+
+    """ Walk every item down to its Study Event """
+    own_positions = {}
+    new_groups = {}
+    for _, items in group.items():
+        for item in items:
+            study_segment = ""
+            if study_segment_column is not None and notna(item[study_segment_column]):
+                study_segment = item[study_segment_column]
+            path = paths[id(item)]
+            node = root
+            while node.key is None and len(node.path) < len(path):
+                node = node.children[path[len(node.path)]]
+            if node.key is not None:
+                studyevent = node.key
+            else:
+                position = own_positions.get(id(node), 0)
+                own_positions[id(node)] = position + 1
+                studyevent = node.own_keys[position]
+                if node.own_chunked:
+                    study_segment = studyevent
+            new_groups.setdefault(studyevent, {}).setdefault(study_segment, []).append(item)
+    return list(new_groups.items())
+
+
+"""
+Split all Study Events that are bigger than limit (see split_group).
+A part whose key already exists is merged into that Study Event; merged
+Study Events that are bigger than limit together are split once more.
+Their parts get keys that no other Study Event has (numbered if needed),
+so nothing is merged a second time.
+"""
+def split_groups(
+    varname_groups, hierarchy_column, study_segment_column, limit, estimator=None
+):
+    parts = []
+    for key, group in varname_groups.items():
+        length = sum(len(items) for items in group.values())
+        if estimator is not None or length > limit:
+            parts.extend(
+                split_group(
+                    key, group, hierarchy_column, study_segment_column, limit, estimator
+                )
+            )
+        else:
+            parts.append((key, group))
+
+    merged = {}
+    joined = {}
+    for studyevent, new_group in parts:
+        if studyevent in joined:
+            merged[studyevent] = True
+        target = joined.setdefault(studyevent, {})
+        for study_segment, items in new_group.items():
+            target.setdefault(study_segment, []).extend(items)
+
+    taken = {studyevent for studyevent in joined if studyevent not in merged}
+    result = {}
+    for studyevent, group in joined.items():
+        if studyevent not in merged:
+            result[studyevent] = group
+            continue
+        new_parts = split_group(
+            studyevent,
+            group,
+            hierarchy_column,
+            study_segment_column,
+            limit,
+            estimator,
+            taken,
+        )
+        # a single part fits (or cannot be split any further)
+        if len(new_parts) == 1:
+            new_parts = [(studyevent, group)]
+        for new_key, new_group in new_parts:
+            # numbered keys are fresh, a path key may belong to another one
+            if new_key in result or (new_key in joined and new_key not in merged):
+                number = 0
+                while f"{new_key}_{number}" in taken:
+                    number += 1
+                new_key = f"{new_key}_{number}"
+            taken.add(new_key)
+            result[new_key] = new_group
+    return result
+
+
+"""
+Compute the StudyEvent and Form key of every row, column by column:
+HIERARCHY "a|b|c" becomes "a_a_b_c", overridden by DCE (StudyEvent)
+and STUDY_SEGMENT (Form) where these are set.
+"""
+def compute_group_keys(df):
+    hierarchy = df["HIERARCHY"].astype(object).map(str)
+    hierarchy_key = (
+        hierarchy.str.split("|", n=1).str[0]
+        + "_"
+        + hierarchy.str.replace("|", "_", regex=False)
+    ).to_numpy(dtype=object)
+
+    def _override(column_name):
+        if column_name not in df.columns:
+            return hierarchy_key
+        values = df[column_name].to_numpy(dtype=object)
+        return np.where(pd.notna(values), values, hierarchy_key)
+
+    return _override("DCE"), _override("STUDY_SEGMENT")
+
+
+"""
+ItemTable keeps the first sheet column by column: numeric columns as numpy
+arrays (unboxed), all others as lists of the values of the DataFrame. Its
+rows are ItemRows, a row index into the table, so a grouped row costs one
+small object instead of a list with a boxed value per column. A row reads
+the same values (and types) as row.tolist() of df.values.
+"""
+class ItemTable:
+    def __init__(self, df):
+        """
+        :param df: The first sheet (DataFrame)
+        """
+        self.columns = []
+        for number in range(df.shape[1]):
+            series = df.iloc[:, number]
+            if series.dtype.kind in "biuf":
+                self.columns.append(series.to_numpy())
+            else:
+                self.columns.append(series.to_numpy(dtype=object).tolist())
+        self._length = len(df)
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, index):
+        return ItemRow(self, int(index))
+
+    def column(self, number):
+        """
+        All values of a column as list.
+        """
+        column = self.columns[number]
+        return column if isinstance(column, list) else column.tolist()
+
+    def value(self, number, index):
+        column = self.columns[number]
+        if isinstance(column, list):
+            return column[index]
+        # numpy scalar -> Python value, like df.values
+        return column[index].item()
+
+
+"""
+ItemRow is one row of an ItemTable. It is read like the row list it
+replaces (row[column number], iteration, len) and pickles as that list, so
+worker processes do not receive the whole table with every row.
+"""
+class ItemRow:
+    __slots__ = ("table", "index")
+
+    def __init__(self, table, index):
+        """
+        :param table: The table of the row (ItemTable)
+        :param index: Row number in the table (int)
+        """
+        self.table = table
+        self.index = index
+
+    def __getitem__(self, number):
+        return self.table.value(number, self.index)
+
+    def __len__(self):
+        return len(self.table.columns)
+
+    def __iter__(self):
+        for number in range(len(self.table.columns)):
+            yield self.table.value(number, self.index)
+
+    def tolist(self):
+        return list(self)
+
+    def __reduce__(self):
+        return (list, (self.tolist(),))
+
+
+"""
+Group all rows in a 2D-dictionary StudyEvent -> Form -> list of rows.
+Keys and rows keep the order of their first appearance in the sheet.
+"""
+def group_rows(df, rows):
+    varname_groups = {}
+    if len(rows) == 0:
+        return varname_groups
+    studyevents, study_segments = compute_group_keys(df)
+    # number the (studyevent, study_segment) pairs by first appearance
+    group_ids = (
+        pd.Series(np.arange(len(rows)))
+        .groupby([studyevents, study_segments], sort=False, dropna=False)
+        .ngroup()
+        .to_numpy()
+    )
+    order = np.argsort(group_ids, kind="stable")
+    boundaries = np.flatnonzero(np.diff(group_ids[order])) + 1
+    for positions in np.split(order, boundaries):
+        first = positions[0]
+        group = varname_groups.setdefault(studyevents[first], {})
+        group[study_segments[first]] = [rows[i] for i in positions]
+    return varname_groups
+
+
+"""
+group_rows for the rows of a SheetRows, without pandas and numpy: the same
+keys (DCE/STUDY_SEGMENT or the HIERARCHY) in the same order.
+"""
+def group_sheet_rows(rows, dictionary_names):
+    varname_groups = {}
+    hierarchy_idx = dictionary_names["HIERARCHY"] if rows else None
+    dce_idx = dictionary_names.get("DCE", None)
+    study_segment_idx = dictionary_names.get("STUDY_SEGMENT", None)
+    for row in rows:
+        hierarchy = str(row[hierarchy_idx])
+        hierarchy_key = hierarchy.split("|", 1)[0] + "_" + hierarchy.replace("|", "_")
+        studyevent = study_segment = hierarchy_key
+        if dce_idx is not None and notna(row[dce_idx]):
+            studyevent = row[dce_idx]
+        if study_segment_idx is not None and notna(row[study_segment_idx]):
+            study_segment = row[study_segment_idx]
+        varname_groups.setdefault(studyevent, {}).setdefault(study_segment, []).append(row)
+    return varname_groups
+
+
+"""
+Sort all lines and columns in a 2D-dictionary.
+First dictionary is the character before the dot in VARNAMES (s2.sdlkhre -> s2) => StudyEvent
+Second dictionary is based on the entries in the column STUDY_SEGMENT => Form
+"""
+def sort_all_lines_and_columns(
+    df, first_sheet_name, all_sheets, file_name, force_single_odm, options=None
+):
+    options = options or ConversionOptions()
+    with metrics_phase(options.metrics, "ingest_metadata"):
+        (
+            varname_groups,
+            CodeLists,
+            dictionary_names,
+            varname_number,
+            missing_map,
+            missing_lists,
+        ) = ingest_metadata(df, all_sheets, force_single_odm, options)
+
+    """ For each Study Event create an ODM """
+    with metrics_phase(options.metrics, "calculate_odm"):
+        calculate_odm(
+            df,
+            missing_lists,
+            file_name,
+            varname_groups,
+            CodeLists,
+            dictionary_names,
+            varname_number,
+            first_sheet_name,
+            missing_map,
+            options,
+        )
+
+
+"""
+Ingest the first sheet: group the rows into Study Events and Forms, collect
+the CodeLists and missing lists and split Study Events that are too big.
+Returns (varname_groups, CodeLists, dictionary_names, varname_number,
+missing_map, missing_lists).
+"""
+def ingest_metadata(df, all_sheets, force_single_odm, options=None):
+    options = options or ConversionOptions()
+    metrics = options.metrics
+    missing_map = {}  # varname -> missing_sheet_name
+
+    # Build a dictionary of the column names with their column number
+    column_names = list(df.columns)
+    dictionary_names = dictionary_column_names(column_names)
+    if len(df) > 0 and "HIERARCHY" not in dictionary_names:
+        raise MetadataError("The first sheet has no column HIERARCHY")
+
+    """ Variables """
+    # save all the codelists with important information (numbered, unique)
+    CodeLists = CodeListRegistry()
+
+    """ Process """
+    # extract the varname number
+    varname_number = 0
+    try:
+        varname_number = dictionary_names["VARNAMES"]
+    except KeyError:
+        varname_number = dictionary_names.get("VAR_NAMES", None)
+    if varname_number is None:
+        varname_number = 0
+
+    """Varname/Study Event (2D Dictionary)"""
+    # the same values (and types) as row.tolist() of df.iterrows()
+    with metrics_phase(metrics, "group_rows"):
+        if isinstance(df, SheetRows):
+            table = df.values
+            varname_groups = group_sheet_rows(table, dictionary_names)
+        else:
+            # rows are indices into the columns, not lists
+            table = ItemTable(df)
+            varname_groups = group_rows(df, table)
+
+    """ Value Labels/Codelist """
+    def _column(idx):
+        if idx is None:
+            return [None] * len(table)
+        if isinstance(df, SheetRows):
+            return [row[idx] for row in table]
+        return table.column(idx)
+
+    # go through the relevant columns of all rows in the xlsx
+    value_labels_rows = deduplicated = 0
+    cache_stats = value_labels_cache.stats()
+    missing_cache_stats = missing_list_cache.stats()
+    with metrics_phase(metrics, "codelists"):
+        for varname, value_labels, value_labels_de, missing_table_list_val in zip(
+            _column(varname_number) if len(column_names) > 0 else [],
+            _column(dictionary_names.get("VALUE_LABELS", None)),
+            _column(dictionary_names.get("VALUE_LABELS_DE", None)),
+            _column(dictionary_names.get("MISSING_LIST_TABLE", None)),
+        ):
+            # first go through the process that splits the string into key-value-pairs
+            # it returns a dictionary
+            english = {}
+            german = {}
+            try:
+                english = (
+                    value_labels_cache.parse(value_labels) if value_labels is not None else {}
+                )
+            except Exception:
+                english = {}
+            try:
+                german = (
+                    value_labels_cache.parse(value_labels_de)
+                    if value_labels_de is not None
+                    else {}
+                )
+            except Exception:
+                german = {}
+
+            # Codelists
+            if len(english) > 0 or len(german) > 0:
+                value_labels_rows += 1
+                # just add the codelist if there isn't an exact codelist yet
+                if check_codelist(english, german, varname, CodeLists):
+                    deduplicated += 1
+                else:
+                    # of course only append existing codelists (not nulls)
+                    if notna(english) or notna(german):
+                        CodeLists.add(varname, english, german)
+
+            # Missing list name per varname
+            if notna(missing_table_list_val):
+                # get varname (already available)
+                missing_map[str(varname)] = str(missing_table_list_val)
+                # Ensure there is a base CodeList for this varname even if VALUE_LABELS are empty.
+                # This allows emitting a CodeList that consists solely of missing codes.
+                varname_str = str(varname)
+                if not CodeLists.has_name(varname_str):
+                    CodeLists.add(varname_str, {}, {})
+
+    # every missing list is compiled once for all ODMs
+    with metrics_phase(metrics, "compile_missing_lists"):
+        missing_lists = compile_missing_lists(all_sheets, missing_map)
+    # the final CodeListOID of every varname, for all ODMs
+    with metrics_phase(metrics, "index_refs"):
+        CodeLists.index_refs(missing_map)
+
+    if not force_single_odm:  # write in more than one ODM if needed
+        limit, estimator = options.max_items, None
+        if options.max_bytes:
+            # split by the estimated size of the ODM files instead
+            limit = options.max_bytes - SizeEstimator.FILE
+            estimator = SizeEstimator(
+                CodeLists, dictionary_names, varname_number, missing_lists, missing_map
+            )
+        with metrics_phase(metrics, "split_groups"):
+            varname_groups = split_groups(
+                varname_groups,
+                dictionary_names["HIERARCHY"],
+                dictionary_names.get("STUDY_SEGMENT", None),
+                limit,
+                estimator,
+            )
+
+    if metrics is not None:
+        metrics.count("rows", len(table))
+        metrics.count("value_labels_rows", value_labels_rows)
+        metrics.count("codelists", len(CodeLists))
+        metrics.count("codelists_deduplicated", deduplicated)
+        for name, value in value_labels_cache.stats().items():
+            metrics.count(f"value_labels_cache_{name}", value - cache_stats[name])
+        metrics.count("missing_lists", len(missing_lists))
+        for name, value in missing_list_cache.stats().items():
+            metrics.count(f"missing_list_cache_{name}", value - missing_cache_stats[name])
+        metrics.count("study_events", len(varname_groups))
+
+    return (
+        varname_groups,
+        CodeLists,
+        dictionary_names,
+        varname_number,
+        missing_map,
+        missing_lists,
+    )
+
+
+"""
+Read the first sheet and only those other sheets that are referenced as
+missing lists in its MISSING_LIST_TABLE column; all other sheets of the
+workbook are never parsed.
+"""
+def read_sheets(file_path, engine=None):
+    with pd.ExcelFile(file_path, engine=engine) as workbook:
+        # take the first sheet
+        first_sheet_name = workbook.sheet_names[0]
+        first_sheet_df = workbook.parse(first_sheet_name)
+        # names of the missing lists in use
+        referenced = set()
+        if "MISSING_LIST_TABLE" in first_sheet_df.columns:
+            referenced = {
+                str(value)
+                for value in first_sheet_df["MISSING_LIST_TABLE"].dropna().unique()
+            }
+        # take the other sheets
+        remaining_sheets_dict = {
+            name: workbook.parse(name)
+            for name in workbook.sheet_names[1:]
+            if str(name) in referenced
+        }
+    return first_sheet_name, first_sheet_df, remaining_sheets_dict
+
+
+# strings that pandas.read_excel reads as NaN
+NA_VALUES = frozenset(
+    {
+        "", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan",
+        "1.#IND", "1.#QNAN", "<NA>", "N/A", "NA", "NULL", "NaN", "None", "n/a",
+        "nan", "null",
+    }
+)
+
+
+"""
+SheetRows is a sheet read without pandas (see read_sheets_rows): the column
+names and the rows as lists, with the values converted like
+pandas.read_excel does. It has the columns, values and len() used of a
+DataFrame.
+"""
+class SheetRows:
+    def __init__(self, columns, rows):
+        """
+        :param columns: The column names (list)
+        :param rows: The rows, each a list of values (list)
+        """
+        self.columns = columns
+        self.values = rows
+
+    def __len__(self):
+        return len(self.values)
+
+
+def _convert_cell(value):
+    # like pandas: whole numbers are int, empty cells and NA strings missing
+    if value is None or (isinstance(value, str) and value in NA_VALUES):
+        return None
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+def _to_number(value):
+    # the number of a cell for a numeric column, or None
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, (int, float)):
+        return value
+    if isinstance(value, str):
+        text = value.strip()
+        try:
+            return int(text) if text.lstrip("+-").isdigit() else float(text)
+        except ValueError:
+            return None
+    return None
+
+
+"""
+Convert the cells of one column like the parser of pandas.read_excel: if all
+values are numbers (or numeric strings) the column is numeric, and float as
+soon as a value is float or missing; otherwise the values stay as they are.
+Missing values are NaN.
+"""
+def _convert_column(cells):
+    nan = float("nan")
+    numbers = [None if value is None else _to_number(value) for value in cells]
+    numeric = any(value is not None for value in cells) and all(
+        number is not None
+        for value, number in zip(cells, numbers)
+        if value is not None
+    )
+    if not numeric:
+        return [nan if value is None else value for value in cells]
+    if all(isinstance(value, bool) for value in cells):
+        return cells
+    if any(number is None or isinstance(number, float) for number in numbers):
+        return [nan if number is None else float(number) for number in numbers]
+    return numbers
+
+
+def _column_names(header, width):
+    # like pandas: "Unnamed: <n>" for empty names, A, A.1, A.2 for duplicates
+    names = []
+    for number in range(width):
+        name = header[number] if number < len(header) else None
+        if name is None or name == "":
+            name = f"Unnamed: {number}"
+        elif isinstance(name, float) and name.is_integer():
+            name = int(name)
+        names.append(name)
+    existing = set(names)
+    used, counts = set(), {}
+    for number, name in enumerate(names):
+        if name in used:
+            count = counts.get(name, 1)
+            while f"{name}.{count}" in existing or f"{name}.{count}" in used:
+                count += 1
+            counts[name] = count + 1
+            names[number] = f"{name}.{count}"
+        used.add(names[number])
+    return names
+
+
+"""
+Read one worksheet of openpyxl into a SheetRows like pandas.read_excel:
+the first row is the header, trailing empty rows are dropped.
+"""
+def _sheet_rows(worksheet):
+    raw_rows = []
+    for row in worksheet.iter_rows(values_only=True):
+        row = list(row)
+        while row and (row[-1] is None or row[-1] == ""):
+            row.pop()
+        raw_rows.append(row)
+    if not raw_rows:
+        return SheetRows([], [])
+    while len(raw_rows) > 1 and not raw_rows[-1]:
+        raw_rows.pop()
+    header = raw_rows[0]
+    rows = [[_convert_cell(value) for value in row] for row in raw_rows[1:]]
+    width = max([len(header)] + [len(row) for row in rows])
+    columns = _column_names(header, width)
+
+    cells = [row + [None] * (width - len(row)) for row in rows]
+    converted = [_convert_column(list(column)) for column in zip(*cells)]
+    return SheetRows(columns, [list(row) for row in zip(*converted)])
+
+
+"""
+read_sheets without pandas: the rows are read directly with openpyxl.
+"""
+def read_sheets_rows(file_path):
+    import openpyxl
+
+    workbook = openpyxl.load_workbook(
+        file_path, read_only=True, data_only=True, keep_links=False
+    )
+    try:
+        first_sheet_name = workbook.sheetnames[0]
+        first_sheet_df = _sheet_rows(workbook[first_sheet_name])
+        # names of the missing lists in use
+        referenced = set()
+        if "MISSING_LIST_TABLE" in first_sheet_df.columns:
+            idx = first_sheet_df.columns.index("MISSING_LIST_TABLE")
+            referenced = {
+                str(row[idx]) for row in first_sheet_df.values if notna(row[idx])
+            }
+        remaining_sheets_dict = {
+            name: _sheet_rows(workbook[name])
+            for name in workbook.sheetnames[1:]
+            if str(name) in referenced
+        }
+    finally:
+        workbook.close()
+    return first_sheet_name, first_sheet_df, remaining_sheets_dict
+
+
+"""
+Read one table of a columnar input: CSV, Parquet or Arrow/Feather. Arrow
+files are memory-mapped instead of being read into memory first.
+"""
+def read_table(path):
+    suffix = Path(path).suffix.lower()
+    if suffix == ".csv":
+        return pd.read_csv(path)
+    if suffix == ".parquet":
+        return pd.read_parquet(path)
+    from pyarrow import feather
+
+    return feather.read_table(str(path), memory_map=True).to_pandas()
+
+
+"""
+Read columnar metadata in the layout of a workbook: the main table is the
+given file (or, for a directory, the table named like the directory) and
+the missing lists are the tables next to it named like the entries of
+MISSING_LIST_TABLE, e.g. items.csv with MISSING_1.csv.
+Returns (first_sheet_name, first_sheet_df, remaining_sheets_dict).
+"""
+def read_tables(path):
+    path = Path(path)
+    main = path
+    if path.is_dir():
+        candidates = [path / f"{path.name}{suffix}" for suffix in TABLE_SUFFIXES]
+        main = next((candidate for candidate in candidates if candidate.is_file()), None)
+        if main is None:
+            raise FileNotFoundError(
+                f"No main table {path.name}.csv, .parquet, .feather or .arrow in {path}"
+            )
+    first_sheet_name = main.stem
+    first_sheet_df = read_table(main)
+    # names of the missing lists in use
+    referenced = []
+    if "MISSING_LIST_TABLE" in first_sheet_df.columns:
+        referenced = [
+            str(value)
+            for value in first_sheet_df["MISSING_LIST_TABLE"].dropna().unique()
+        ]
+    remaining_sheets_dict = {}
+    for name in referenced:
+        # the format of the main table first
+        for suffix in dict.fromkeys((main.suffix,) + TABLE_SUFFIXES):
+            table_path = main.parent / f"{name}{suffix}"
+            if table_path.is_file():
+                remaining_sheets_dict[name] = read_table(table_path)
+                break
+    return first_sheet_name, first_sheet_df, remaining_sheets_dict
+
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as source_file:
+        for chunk in iter(lambda: source_file.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# the Python types the cache restores from str() of a value, by type name
+CACHE_TYPES = {
+    "str": str,
+    "int": int,
+    "float": float,
+    "bool": lambda value: value == "True",
+    "datetime": datetime.fromisoformat,
+    "Timestamp": lambda value: pd.Timestamp(value),
+}
+
+
+class _Uncacheable(Exception):
+    pass
+
+
+def _type_tag(value):
+    tag = type(value).__name__
+    if tag not in CACHE_TYPES:
+        raise _Uncacheable(tag)
+    return tag
+
+
+def _parquet_frame(df):
+    # Parquet needs string column names and one type per column: the
+    # columns are stored by position ("c0", ...) and the values of mixed
+    # object columns as str() with their type in a companion column ("t0");
+    # returns the frame and the [type tag, str] of every column name
+    columns = [(_type_tag(column), str(column)) for column in df.columns]
+    stored = {}
+    for number, column in enumerate(df.columns):
+        series = df[column]
+        if series.dtype == object and pd.api.types.infer_dtype(
+            series, skipna=True
+        ) not in ("string", "empty"):
+            values = series.tolist()
+            stored[f"t{number}"] = [
+                _type_tag(value) if notna(value) else None for value in values
+            ]
+            series = [str(value) if notna(value) else None for value in values]
+        stored[f"c{number}"] = series
+    return pd.DataFrame(stored, index=df.index).reset_index(drop=True), columns
+
+
+def _cached_frame(df, columns):
+    # Parquet stores NaN of object columns as null, which is read back as
+    # None; read_excel gives NaN for empty cells ("nan" in keys, not "None")
+    restored = {}
+    for number, (tag, name) in enumerate(columns):
+        series = df[f"c{number}"]
+        if f"t{number}" in df.columns:
+            series = pd.Series(
+                [
+                    CACHE_TYPES[value_tag](value) if value_tag is not None else np.nan
+                    for value_tag, value in zip(df[f"t{number}"], series)
+                ],
+                dtype=object,
+            )
+        elif series.dtype == object:
+            series = series.where(series.notna(), np.nan)
+        restored[CACHE_TYPES[tag](name)] = series
+    return pd.DataFrame(restored)
+
+
+"""
+read_sheets with a Parquet sidecar cache: the parsed sheets are stored in
+the folder .<workbook>.cache next to the workbook and reused as long as the
+workbook content (sha256) and the engine are the same, so re-runs on an
+unchanged workbook do not parse the XLSX at all. The run that fills the
+cache also continues with the cached tables, so every run sees the same
+values; a workbook with values the cache cannot restore (see CACHE_TYPES)
+is not cached.
+"""
+def read_sheets_cached(file_path, engine=None):
+    file_path = Path(file_path)
+    cache_dir = file_path.with_name(f".{file_path.name}.cache")
+    index_path = cache_dir / "index.json"
+    key = {
+        "version": SHEET_CACHE_VERSION,
+        "sha256": _file_sha256(file_path),
+        "engine": engine,
+    }
+
+    def _read_cache():
+        with open(index_path, encoding="utf-8") as index_file:
+            index = json.load(index_file)
+        if index.get("key") != key:
+            return None
+        sheets = {
+            sheet: _cached_frame(pd.read_parquet(cache_dir / parquet_file), columns)
+            for sheet, parquet_file, columns in index["sheets"]
+        }
+        first_sheet_name = index["sheets"][0][0]
+        first_sheet_df = sheets.pop(first_sheet_name)
+        return first_sheet_name, first_sheet_df, sheets
+
+    try:
+        cached = _read_cache()
+        if cached is not None:
+            return cached
+    except (OSError, ValueError, KeyError, IndexError):
+        pass
+
+    first_sheet_name, first_sheet_df, remaining_sheets_dict = read_sheets(file_path, engine)
+    sheets = [(first_sheet_name, first_sheet_df)] + list(remaining_sheets_dict.items())
+    try:
+        frames = [_parquet_frame(df) for _, df in sheets]
+    except _Uncacheable:
+        return first_sheet_name, first_sheet_df, remaining_sheets_dict
+    cache_dir.mkdir(exist_ok=True)
+    index = {"key": key, "sheets": []}
+    for number, ((sheet, _), (frame, columns)) in enumerate(zip(sheets, frames)):
+        parquet_file = f"{number}.parquet"
+        frame.to_parquet(cache_dir / parquet_file, index=False)
+        index["sheets"].append((sheet, parquet_file, columns))
+    # the index is written last, it makes the cache valid
+    tmp_path = index_path.with_name(index_path.name + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as index_file:
+        json.dump(index, index_file, indent=2)
+    os.replace(tmp_path, index_path)
+    return _read_cache()
+
+
+"""
+Read the metadata from a path: a workbook (with the pandas reader, the
+openpyxl rows reader or the Parquet sidecar cache) or columnar tables
+(CSV, Parquet, Arrow/Feather or a directory of them). File-like objects
+are read as workbook.
+"""
+def read_workbook(file_path, engine=None, reader="pandas", cache=False):
+    if isinstance(file_path, (str, os.PathLike)):
+        path = Path(file_path)
+        if path.is_dir() or path.suffix.lower() in TABLE_SUFFIXES:
+            return read_tables(path)
+    if reader == "openpyxl":
+        if cache:
+            raise ValueError("The cache needs the pandas reader, not openpyxl")
+        return read_sheets_rows(file_path)
+    if cache and isinstance(file_path, (str, os.PathLike)):
+        return read_sheets_cached(file_path, engine)
+    return read_sheets(file_path, engine)
+
+
+"""
+Load the metadata from a workbook (path or binary file-like object) or from
+a dict {sheet name: DataFrame} whose first entry is the first sheet.
+Returns (first_sheet_name, first_sheet_df, remaining_sheets_dict).
+"""
+def load_metadata(source, engine=None, reader="pandas", cache=False):
+    if isinstance(source, dict):
+        if not source:
+            raise WorkbookError("No sheets given")
+        sheets = iter(source.items())
+        first_sheet_name, first_sheet_df = next(sheets)
+        return first_sheet_name, first_sheet_df, dict(sheets)
+    try:
+        return read_workbook(source, engine, reader, cache)
+    except Exception as e:
+        raise WorkbookError(f"Error while reading the workbook: {e}") from e
+
+
+"""
+Load and ingest the metadata for the library API. The study name defaults
+to the file name of a workbook path.
+"""
+def _prepare_conversion(source, name, force_single_odm, options):
+    if name is None:
+        if not isinstance(source, (str, os.PathLike)):
+            raise ConversionError("A study name is needed for this source")
+        name = os.path.basename(source).split(".")[0]
+    first_sheet_name, df, all_sheets = load_metadata(
+        source, options.engine, options.reader, options.cache
+    )
+    try:
+        (
+            varname_groups,
+            CodeLists,
+            dictionary_names,
+            varname_number,
+            missing_map,
+            missing_lists,
+        ) = ingest_metadata(df, all_sheets, force_single_odm, options)
+    except ConversionError:
+        raise
+    except Exception as e:
+        raise MetadataError(f"Error while processing the metadata: {e}") from e
+    state = {
+        "name": name,
+        "first_sheet_name": first_sheet_name,
+        "CodeLists": CodeLists,
+        "dictionary_names": dictionary_names,
+        "varname_number": varname_number,
+        "missing_lists": missing_lists,
+        "missing_map": missing_map,
+        "options": options,
+    }
+    return varname_groups, state
+
+
+"""
+Convert metadata to ODM in memory, without touching the disk: yields
+(file name, ODM bytes) for every Study Event, one at a time. The source is
+a workbook path, a binary file-like object or a dict of DataFrames (see
+load_metadata). Errors are raised as ConversionError. The ODMs are built
+one after another (jobs and incremental are not used).
+
+for file_name, xml_bytes in convert(open("x0.xlsx", "rb"), name="x0"):
+    ...
+"""
+def convert(source, name=None, force_single_odm=False, options=None):
+    options = options or ConversionOptions()
+    varname_groups, state = _prepare_conversion(source, name, force_single_odm, options)
+    for key, group in varname_groups.items():
+        buffer = io.BytesIO()
+        _write_to(buffer, key, group, state)
+        yield f"Study_{state['name']}_{key}.xml", buffer.getvalue()
+
+
+"""
+Convert metadata to ODM and write every Study Event to a sink: a callable
+that takes the file name and returns a writable binary file object (used
+as context manager). With options.streaming the ODM goes straight into it.
+Returns the file names in the order they were written.
+"""
+def convert_to(source, sink, name=None, force_single_odm=False, options=None):
+    options = options or ConversionOptions()
+    varname_groups, state = _prepare_conversion(source, name, force_single_odm, options)
+    written = []
+    for key, group in varname_groups.items():
+        file_name = f"Study_{state['name']}_{key}.xml"
+        with sink(file_name) as xml_file:
+            _write_to(xml_file, key, group, state)
+        written.append(file_name)
+    return written
+
+
+def _write_to(xml_file, key, group, state):
+    metrics = state["options"].metrics
+    start = time.perf_counter()
+    try:
+        element_counts = write_odm(xml_file, key, group, **state)
+    except ConversionError:
+        raise
+    except Exception as e:
+        raise ConversionError(f"Error while writing the Study Event {key}: {e}") from e
+    if metrics is not None:
+        try:
+            bytes_written = xml_file.tell()
+        except (AttributeError, OSError):
+            # e.g. a pipe or socket
+            bytes_written = 0
+        metrics.add_file(
+            f"Study_{state['name']}_{key}.xml",
+            bytes_written,
+            element_counts,
+            time.perf_counter() - start,
+        )
+
+
+"""
+Convert one workbook into options.output_dir like the CLI, but raise
+ConversionError instead of printing it. Returns the written file names.
+"""
+def convert_file(file_path, force_single_odm=False, options=None):
+    options = options or ConversionOptions()
+    varname_groups, state = _prepare_conversion(file_path, None, force_single_odm, options)
+    return calculate_odm(
+        None,
+        state["missing_lists"],
+        state["name"],
+        varname_groups,
+        state["CodeLists"],
+        state["dictionary_names"],
+        state["varname_number"],
+        state["first_sheet_name"],
+        state["missing_map"],
+        options,
+    )
+
+
+""" Delta """
+
+def _fingerprint(value):
+    return hashlib.blake2b(repr(value).encode("utf-8"), digest_size=16).hexdigest()
+
+
+"""
+Index of the definitions of one metadata version for --diff, built with
+hashes only: a fingerprint per VAR_NAMES (all its columns and the content of
+its CodeList), per union CodeList (codes and order of the base CodeList,
+DataType and the content of its missing list) and per missing-list sheet
+(its rows). Returns (index, {CodeList fingerprint: (base number, sheet)});
+the index is plain JSON and can be stored instead of the old workbook.
+"""
+def index_definitions(
+    name, varname_groups, CodeLists, dictionary_names, varname_number, missing_lists, missing_map
+):
+    if CodeLists.refs is None:
+        CodeLists.index_refs(missing_map)
+    missing_fingerprints = {
+        sheet: _fingerprint((missing_list.non_integer, missing_list.rows))
+        for sheet, missing_list in missing_lists.items()
+    }
+    columns = sorted(dictionary_names.items())
+
+    codelists = {}
+    combos = {}
+    by_combo = {}
+
+    def _codelist(combo):
+        fingerprint = by_combo.get(combo)
+        if fingerprint is None:
+            base_number, sheet = combo
+            base = CodeLists.get(base_number)
+            datatype = CodeLists.datatype(base)
+            missing_list = missing_lists.get(sheet) if sheet else None
+            if missing_list is not None and missing_list.non_integer:
+                datatype = _promote_dtype(datatype, "string")
+            fingerprint = by_combo[combo] = _fingerprint(
+                (
+                    list(base.codelist_de.items()),
+                    list(base.codelist_en.items()),
+                    datatype,
+                    missing_fingerprints.get(sheet) if sheet else None,
+                )
+            )
+            codelists[fingerprint] = [datatype, sheet]
+            combos[fingerprint] = combo
+        return fingerprint
+
+    items = {}
+    data_types = {
+        "integer",
+        "float",
+        "double",
+        "date",
+        "time",
+        "datetime",
+        "string",
+        "boolean",
+    }
+    data_type_number = dictionary_names.get("DATA_TYPE")
+    # rows of an ItemTable as tuples, built column by column
+    table_rows = {}
+    for _, group in varname_groups.items():
+        for _, lines in group.items():
+            for line in lines:
+                if isinstance(line, ItemRow):
+                    rows = table_rows.get(id(line.table))
+                    if rows is None:
+                        table = line.table
+                        rows = table_rows[id(table)] = list(
+                            zip(*(table.column(number) for number in range(len(table.columns))))
+                        )
+                    line = rows[line.index]
+                varname = str(line[varname_number])
+                ref = CodeLists.refs.get(varname)
+                codelist = _codelist(ref[:2]) if ref is not None else None
+                values = "\x1f".join(
+                    f"{column}\x1e{line[number]}"
+                    for column, number in columns
+                    if notna(line[number])
+                )
+                data_type = extract_from_line(line, data_type_number)
+                items[varname] = [
+                    hashlib.blake2b(
+                        f"{values}\x1d{codelist}".encode("utf-8"), digest_size=16
+                    ).hexdigest(),
+                    codelist,
+                    data_type if data_type in data_types else "string",
+                ]
+
+    index = {
+        "version": DEFINITIONS_VERSION,
+        "name": name,
+        "items": items,
+        "codelists": codelists,
+        "missing_lists": missing_fingerprints,
+    }
+    return index, combos
+
+
+"""
+Definition index without any definitions: a diff against it inserts every
+ItemDef and CodeList, the first upload of a study in the OIDs of --diff.
+"""
+def empty_definitions(name):
+    return {
+        "version": DEFINITIONS_VERSION,
+        "name": name,
+        "items": {},
+        "codelists": {},
+        "missing_lists": {},
+    }
+
+
+"""
+Read a definition index written by --diff (Study_<name>.definitions.json).
+"""
+def read_definitions(path):
+    try:
+        with open(path, encoding="utf-8") as index_file:
+            index = json.load(index_file)
+    except (OSError, ValueError) as e:
+        raise WorkbookError(f"Error while reading the definitions {path}: {e}") from e
+    if not isinstance(index, dict) or index.get("version") != DEFINITIONS_VERSION:
+        raise WorkbookError(f"{path} is no definition index of version {DEFINITIONS_VERSION}")
+    return index
+
+
+"""
+Compare two definition indexes by their keys and fingerprints (dictionary
+lookups only). Items are matched by VAR_NAMES, CodeLists by fingerprint
+(a changed CodeList is a removed and an added one) and missing lists by
+sheet name. Returns {kind: {"added": [...], "changed": [...], "removed": [...]}}.
+"""
+def diff_definitions(old, new):
+    diff = {}
+    for kind in ("items", "codelists", "missing_lists"):
+        old_entries, new_entries = old[kind], new[kind]
+        added, changed = [], []
+        for key, entry in new_entries.items():
+            old_entry = old_entries.get(key)
+            if old_entry is None:
+                added.append(key)
+            elif old_entry != entry:
+                changed.append(key)
+        removed = [key for key in old_entries if key not in new_entries]
+        diff[kind] = {"added": added, "changed": changed, "removed": removed}
+    return diff
+
+
+"""
+Creates the Transactional ODM of a diff: only the added, changed and removed
+ItemDefs and CodeLists, each marked with <Alias Context="TransactionType"
+Name="Insert|Update|Remove"/>. Every CodeList referenced by a written ItemDef
+is written as well, unchanged ones with Name="Context". The OIDs do not
+depend on the position of a variable: ItemDef I.<VAR_NAMES>, CodeList
+CL.<fingerprint>. They differ from the OIDs of the Snapshot files (I.<n>,
+CL.<n>__M_<hash>), so the first upload is a diff against empty_definitions.
+Removed definitions only carry OID, Name and DataType.
+"""
+def calculate_delta_odm(
+    name,
+    first_sheet_name,
+    varname_groups,
+    CodeLists,
+    dictionary_names,
+    varname_number,
+    missing_lists,
+    old,
+    new,
+    combos,
+    diff,
+    creation_datetime=None,
+    alias_profile="full",
+):
+    odm, metadata = calculate_odm_root(name, "delta", first_sheet_name, creation_datetime)
+    aliases = alias_columns(dictionary_names, alias_profile)
+    odm.set("FileType", "Transactional")
+
+    def _transaction(element, transaction_type):
+        ET.SubElement(element, "Alias", Context="TransactionType", Name=transaction_type)
+
+    def _codelist_oid(fingerprint):
+        return "CL." + fingerprint[:12]
+
+    transactions = {varname: "Insert" for varname in diff["items"]["added"]}
+    transactions.update({varname: "Update" for varname in diff["items"]["changed"]})
+    final_ref_map = {
+        varname: _codelist_oid(entry[1])
+        for varname, entry in new["items"].items()
+        if varname in transactions and entry[1] is not None
+    }
+
+    """ Items (ItemDef*) """
+    for _, group in varname_groups.items():
+        for _, lines in group.items():
+            for line in lines:
+                varname = str(line[varname_number])
+                transaction_type = transactions.pop(varname, None)
+                if transaction_type is None:
+                    continue
+                calculate_itemdef(
+                    metadata, line, varname, CodeLists, dictionary_names, final_ref_map, aliases
+                )
+                _transaction(metadata[-1], transaction_type)
+    for varname in diff["items"]["removed"]:
+        itemdef = ET.SubElement(
+            metadata,
+            "ItemDef",
+            OID="I." + varname,
+            Name=varname,
+            DataType=old["items"][varname][2],
+        )
+        _transaction(itemdef, "Remove")
 
-        # create the name for the xml
-        whole_name = output_dir / f"Study_{name}_{key}.xml"
-        # create the xml with indentations
-        xml_bytes = ET.tostring(
-            odm, encoding="utf-8", xml_declaration=True, pretty_print=True
+    """ CodeLists (CodeList*) """
+    codelist_transactions = {fingerprint: "Insert" for fingerprint in diff["codelists"]["added"]}
+    codelist_transactions.update(
+        {fingerprint: "Update" for fingerprint in diff["codelists"]["changed"]}
+    )
+    # the written ItemDefs need their CodeLists, even the unchanged ones
+    for fingerprint in dict.fromkeys(
+        new["items"][varname][1]
+        for transaction_type in ("added", "changed")
+        for varname in diff["items"][transaction_type]
+    ):
+        if fingerprint is not None:
+            codelist_transactions.setdefault(fingerprint, "Context")
+    for fingerprint, transaction_type in codelist_transactions.items():
+        base_number, sheet = combos[fingerprint]
+        emit_union_codelist(
+            CodeLists, base_number, sheet, metadata, missing_lists, alias_profile
         )
-        with open(whole_name, "wb") as xml_file:
-            xml_file.write(xml_bytes)
+        codelist = metadata[-1]
+        codelist.set("OID", _codelist_oid(fingerprint))
+        codelist.set("Name", _codelist_oid(fingerprint))
+        _transaction(codelist, transaction_type)
+    for fingerprint in diff["codelists"]["removed"]:
+        datatype, _ = old["codelists"][fingerprint]
+        codelist = ET.SubElement(
+            metadata,
+            "CodeList",
+            OID=_codelist_oid(fingerprint),
+            Name=_codelist_oid(fingerprint),
+            DataType=datatype,
+        )
+        _transaction(codelist, "Remove")
+    return odm
 
 
 """
-Sort all lines and columns in a 2D-dictionary along HIERARCHY column.
+Compare a new metadata version with an old one (a workbook or tables like
+the new one, the definition index of an earlier --diff, or None for the
+first upload, see empty_definitions) and write the
+Transactional ODM Study_<name>_delta.xml with only the differences plus
+the definition index of the new version, Study_<name>.definitions.json,
+into options.output_dir. Returns the diff with its counts.
 """
-def sort_new_hierarchy(
-    varname_groups, list_keys, study_segment_column, hierarchy_column, hierarchy
-):
-    # go through all listed keys which have too many items
-    for key in list_keys:
-        # save the dictionary and delete the previous one
-        dictionary = varname_groups[key]
-        del varname_groups[key]
-        # new sort of the dictionary
-        for _, group in dictionary.items():
-            for item in group:
-                studyevent = ""
-                if pd.notna(item[hierarchy_column]):
-                    studyevent = item[hierarchy_column]
-                    parts = item[hierarchy_column].split("|")
-                    # calculate the new key
-                    if len(parts) > hierarchy:
-                        save = ""
-                        count = 0
-                        for item_string in parts:
-                            save = save + item_string + "_"
-                            if count == hierarchy:
-                                break
-                            count += 1
-                        studyevent = save[:-1]
-                study_segment = ""
-                if pd.notna(item[study_segment_column]):
-                    study_segment = item[study_segment_column]
-
-                # 2D dictionary for studyevent and formdef
-                if studyevent not in varname_groups:
-                    varname_groups[studyevent] = {}
-                if study_segment not in varname_groups[studyevent]:
-                    varname_groups[studyevent][study_segment] = []
-
-                # add the whole line as a list to the key itemgroup
-                varname_groups[studyevent][study_segment].append(item)
+def convert_diff(old_source, new_source, name=None, options=None):
+    options = options or ConversionOptions()
+    metrics = options.metrics
+    # the Study Events are not written, so they are not split either
+    varname_groups, state = _prepare_conversion(new_source, name, True, options)
+    name = state["name"]
+    with metrics_phase(metrics, "index_definitions"):
+        new, combos = index_definitions(
+            name,
+            varname_groups,
+            state["CodeLists"],
+            state["dictionary_names"],
+            state["varname_number"],
+            state["missing_lists"],
+            state["missing_map"],
+        )
 
-    return varname_groups
+    if old_source is None:
+        old = empty_definitions(name)
+    elif isinstance(old_source, (str, os.PathLike)) and str(old_source).endswith(".json"):
+        old = read_definitions(old_source)
+    else:
+        old_groups, old_state = _prepare_conversion(old_source, name, True, options)
+        with metrics_phase(metrics, "index_definitions"):
+            old, _ = index_definitions(
+                name,
+                old_groups,
+                old_state["CodeLists"],
+                old_state["dictionary_names"],
+                old_state["varname_number"],
+                old_state["missing_lists"],
+                old_state["missing_map"],
+            )
+        del old_groups, old_state
+
+    with metrics_phase(metrics, "diff_definitions"):
+        diff = diff_definitions(old, new)
+
+    output_dir = options.output_dir
+    output_dir.mkdir(parents=True, exist_ok=True)
+    delta_path = output_dir / f"Study_{name}_delta.xml"
+    with metrics_phase(metrics, "write_delta"):
+        odm = calculate_delta_odm(
+            name,
+            state["first_sheet_name"],
+            varname_groups,
+            state["CodeLists"],
+            state["dictionary_names"],
+            state["varname_number"],
+            state["missing_lists"],
+            old,
+            new,
+            combos,
+            diff,
+            options.creation_datetime,
+            options.alias_profile,
+        )
+        with open(delta_path, "wb") as xml_file:
+            xml_file.write(
+                ET.tostring(
+                    odm,
+                    encoding="utf-8",
+                    xml_declaration=True,
+                    pretty_print=options.pretty_print,
+                )
+            )
+    index_path = output_dir / f"Study_{name}.definitions.json"
+    tmp_path = index_path.with_name(index_path.name + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as index_file:
+        json.dump(new, index_file)
+    os.replace(tmp_path, index_path)
+
+    counts = {
+        kind: {change: len(keys) for change, keys in changes.items()}
+        for kind, changes in diff.items()
+    }
+    if metrics is not None:
+        for kind, changes in counts.items():
+            for change, number in changes.items():
+                metrics.count(f"diff_{kind}_{change}", number)
+    return {
+        "delta": str(delta_path),
+        "definitions": str(index_path),
+        "counts": counts,
+        "diff": diff,
+    }
 
 
+""" Sharding """
+
 """
-Sort all lines and columns in a 2D-dictionary along HIERARCHY column (chunking).
+Content hash of the source of a plan: the workbook or main table, for a
+directory of tables all tables in it. Raises WorkbookError if it cannot be
+read.
 """
-def sort_new_hierarchy2(
-    varname_groups, list_keys, study_segment_column, hierarchy_column, hierarchy
-):
-    # go through all listed keys which have too many items
-    for key in list_keys:
-        # save the dictionary and delete the previous one
-        dictionary = varname_groups[key]
-        del varname_groups[key]
-        # count the item per xml
-        count = 0
-        count_keys = 0
-        # new sort of the dictionary
-        for _, group in dictionary.items():
-            for item in group:
-                if count >= 4500:
-                    count = 0
-                # if count 0 calculate a new study_segment key
-                if count == 0:
-                    studyevent = str(key) + "_" + str(count_keys)
-                    study_segment = str(key) + "_" + str(count_keys)
-                    count_keys += 1
-
-                # 2D dictionary for studyevent and formdef
-                if studyevent not in varname_groups:
-                    varname_groups[studyevent] = {}
-                if study_segment not in varname_groups[studyevent]:
-                    varname_groups[studyevent][study_segment] = []
-
-                # add the whole line as a list to the key itemgroup
-                varname_groups[studyevent][study_segment].append(item)
+def source_sha256(path):
+    path = Path(path)
+    try:
+        if not path.is_dir():
+            return _file_sha256(path)
+        digest = hashlib.sha256()
+        for table_path in sorted(path.iterdir()):
+            if table_path.suffix.lower() in TABLE_SUFFIXES and table_path.is_file():
+                digest.update(f"{table_path.name}\0{_file_sha256(table_path)}\0".encode("utf-8"))
+        return digest.hexdigest()
+    except OSError as e:
+        raise WorkbookError(f"Error while reading the source {path}: {e}") from e
 
-                count += 1
 
-    return varname_groups
+"""
+Fingerprint of the global CodeList numbering (the CodeListOIDs of all ODMs)
+and of the missing lists. Every shard ingests the same source the same way,
+so this only differs if the source or the code is not the planned one.
+"""
+def codelist_assignment(CodeLists, missing_lists):
+    digest = hashlib.sha256()
+    for codelist in CodeLists:
+        digest.update(
+            repr(
+                (
+                    codelist.number,
+                    list(codelist.codelist_en.items()),
+                    list(codelist.codelist_de.items()),
+                )
+            ).encode("utf-8")
+        )
+    for sheet, missing_list in missing_lists.items():
+        digest.update(repr((sheet, missing_list.rows)).encode("utf-8"))
+    return {"codelists": len(CodeLists), "sha256": digest.hexdigest()}
 
 
 """
-Sort all lines and columns in a 2D-dictionary.
-First dictionary is the character before the dot in VARNAMES (s2.sdlkhre -> s2) => StudyEvent
-Second dictionary is based on the entries in the column STUDY_SEGMENT => Form
+Plan a sharded conversion of a workbook or tables on shared storage: the
+Study Event split, the file names, the global CodeList assignment and the
+content hash of every ODM (see study_event_digest), together with the
+options that change the bytes of the files. Without a fixed CreationDateTime
+the time of the planning is fixed, so all shards write the same one.
+Returns the plan, a plain JSON dictionary.
 """
-def sort_all_lines_and_columns(df, first_sheet_name, all_sheets, file_name, force_single_odm):
-    # file_name
-    name = file_name.split(".")[0]
-    missing_map = {}  # varname -> missing_sheet_name
+def plan_conversion(source, name=None, force_single_odm=False, options=None):
+    # own options, the fixed CreationDateTime must not change the caller's
+    options = copy.copy(options or ConversionOptions())
+    metrics = options.metrics
+    if not isinstance(source, (str, os.PathLike)):
+        raise ConversionError("A plan needs the path of the source on shared storage")
+    if options.compress == "zip":
+        raise ConversionError("Shards write single files, a plan cannot use zip")
+    if options.creation_datetime is None:
+        options.creation_datetime = datetime.now().isoformat()
+    with metrics_phase(metrics, "source_sha256"):
+        sha256 = source_sha256(source)
+    varname_groups, state = _prepare_conversion(source, name, force_single_odm, options)
+    suffix = ".xml.gz" if options.compress == "gzip" else ".xml"
+    study_events = []
+    with metrics_phase(metrics, "study_event_digest"):
+        for key, group in varname_groups.items():
+            study_events.append(
+                {
+                    "key": str(key),
+                    "file": f"Study_{state['name']}_{key}{suffix}",
+                    "items": sum(len(lines) for lines in group.values()),
+                    "digest": study_event_digest(key, group, **state),
+                }
+            )
+    return {
+        "version": PLAN_VERSION,
+        "name": state["name"],
+        "source": str(source),
+        "source_sha256": sha256,
+        "force_single_odm": force_single_odm,
+        "options": {option: getattr(options, option) for option in PLAN_OPTIONS},
+        "codelists": codelist_assignment(state["CodeLists"], state["missing_lists"]),
+        "study_events": study_events,
+    }
 
-    # Build a dictionary of the column names with their column number
-    column_names = list(df.columns)
-    dictionary_names = dictionary_column_names(column_names)
 
-    """ Variables """
-    # count the codelists, they are unique
-    count_cl = 1
-    # in this dictionary save all lines in 2D
-    varname_groups = {}
-    # save all the codelists with important information
-    CodeLists = []
+def write_plan(plan_path, plan):
+    # replace atomically, shards may already be waiting for the plan
+    plan_path = Path(plan_path)
+    tmp_path = plan_path.with_name(plan_path.name + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as plan_file:
+        json.dump(plan, plan_file, indent=2, sort_keys=True)
+    os.replace(tmp_path, plan_path)
 
-    """ Process """
-    # go through all rows in the xlsx
-    for _, row in df.iterrows():
-        """Varname/Study Event (2D Dictionary)"""
-        # extract the varname number
-        varname_number = 0
+
+def read_plan(plan_path):
+    try:
+        with open(plan_path, encoding="utf-8") as plan_file:
+            plan = json.load(plan_file)
+    except (OSError, ValueError) as e:
+        raise WorkbookError(f"Error while reading the plan {plan_path}: {e}") from e
+    if not isinstance(plan, dict) or plan.get("version") != PLAN_VERSION:
+        raise WorkbookError(f"{plan_path} is no plan of version {PLAN_VERSION}")
+    return plan
+
+
+"""
+Parse "i/N" of --shard: the i-th (1 to N) of N shards.
+"""
+def parse_shard(value):
+    try:
+        index, count = (int(part) for part in str(value).split("/"))
+    except ValueError:
+        raise ValueError(f"{value} is no shard i/N") from None
+    if not 1 <= index <= count:
+        raise ValueError(f"Shard {value}: i must be between 1 and N")
+    return index, count
+
+
+"""
+Distribute the Study Events of a plan over count shards: the biggest first,
+each to the shard with the fewest items so far (ties to the lower shard).
+Only depends on the plan, so every shard computes the same distribution.
+Returns the shard (1 to count) of every Study Event.
+"""
+def shard_assignment(study_events, count):
+    loads = [0] * count
+    shards = [None] * len(study_events)
+    for position in sorted(
+        range(len(study_events)), key=lambda i: (-study_events[i]["items"], i)
+    ):
+        shard = min(range(count), key=lambda i: (loads[i], i))
+        loads[shard] += study_events[position]["items"]
+        shards[position] = shard + 1
+    return shards
+
+
+"""
+Write the ODM files of one shard of a plan. The source (default: the one of
+the plan) must be unchanged, the options of the plan replace the ones that
+change the bytes. The split and the CodeList assignment are checked against
+the plan, so the files of all shards together are the same as the ones of a
+single run. Returns the written file names.
+"""
+def convert_shard(plan, index, count, source=None, options=None):
+    # own options, the ones of the plan must not change the caller's
+    options = copy.copy(options or ConversionOptions())
+    metrics = options.metrics
+    if options.incremental or plan["options"]["compress"] == "zip":
+        raise ConversionError("--shard writes single files, without --incremental and zip")
+    for option, value in plan["options"].items():
+        setattr(options, option, tuple(value) if isinstance(value, list) else value)
+    source = source or plan["source"]
+    with metrics_phase(metrics, "source_sha256"):
+        changed = source_sha256(source) != plan["source_sha256"]
+    if changed:
+        raise WorkbookError(f"{source} is not the planned source or changed since the plan")
+
+    varname_groups, state = _prepare_conversion(
+        source, plan["name"], plan["force_single_odm"], options
+    )
+    study_events = plan["study_events"]
+    if [str(key) for key in varname_groups] != [entry["key"] for entry in study_events]:
+        raise MetadataError("The Study Events differ from the plan")
+    if codelist_assignment(state["CodeLists"], state["missing_lists"]) != plan["codelists"]:
+        raise MetadataError("The CodeLists differ from the plan")
+
+    shards = shard_assignment(study_events, count)
+    selected = {}
+    with metrics_phase(metrics, "study_event_digest"):
+        for (key, group), entry, shard in zip(varname_groups.items(), study_events, shards):
+            if shard != index:
+                continue
+            if study_event_digest(key, group, **state) != entry["digest"]:
+                raise MetadataError(f"The Study Event {key} differs from the plan")
+            selected[key] = group
+    del varname_groups
+    return calculate_odm(
+        None,
+        state["missing_lists"],
+        state["name"],
+        selected,
+        state["CodeLists"],
+        state["dictionary_names"],
+        state["varname_number"],
+        state["first_sheet_name"],
+        state["missing_map"],
+        options,
+    )
+
+
+WORKBOOK_SUFFIXES = (".xlsx", ".xlsm", ".xls", ".ods")
+
+
+"""
+Expand the input of the batch mode: a directory (all workbooks in it), a
+glob pattern or a list file with one workbook path per line (relative
+paths are relative to the list file, empty lines and # comments are
+skipped). Returns the paths in a stable order.
+"""
+def collect_workbooks(spec):
+    path = Path(spec)
+    if path.is_dir():
+        return sorted(
+            entry
+            for entry in path.iterdir()
+            if entry.suffix.lower() in WORKBOOK_SUFFIXES
+            # lock files of open workbooks
+            and not entry.name.startswith("~$")
+        )
+    if any(char in str(spec) for char in "*?["):
+        return [Path(match) for match in sorted(glob.glob(str(spec), recursive=True))]
+    if path.is_file() and path.suffix.lower() not in WORKBOOK_SUFFIXES:
+        workbooks = []
+        with open(path, encoding="utf-8") as list_file:
+            for line in list_file:
+                line = line.strip()
+                if line and not line.startswith("#"):
+                    workbooks.append(path.parent / line)
+        return workbooks
+    raise ConversionError(f"No directory, glob or list file: {spec}")
+
+
+"""
+Convert one workbook of a batch into its own folder. Never raises: the
+result records the status, time, number of files and the error.
+"""
+def convert_batch_item(file_path, output_dir, force_single_odm, options):
+    start = time.perf_counter()
+    result = {"file": str(file_path), "output_dir": str(output_dir)}
+    # every workbook has its own folder and metrics, its Study Events are
+    # written serially because the workbooks already run in parallel
+    item_options = copy.copy(options)
+    item_options.output_dir = output_dir
+    item_options.jobs = 1
+    if options.metrics is not None:
+        item_options.metrics = Metrics(trace_memory=options.metrics.trace_memory)
+    try:
+        files = convert_file(file_path, force_single_odm, item_options)
+        result.update(status="ok", files=len(files), error=None)
+    except Exception as e:
+        result.update(status="failed", files=0, error=f"{type(e).__name__}: {e}")
+    result["seconds"] = time.perf_counter() - start
+    if item_options.metrics is not None:
+        result["metrics"] = item_options.metrics.to_dict()
+    return result
+
+
+"""
+Batch mode: convert many workbooks with a pool of options.jobs processes,
+each study into its own subfolder of options.output_dir. Failing workbooks
+do not stop the batch. The summary of all workbooks is written to
+batch_summary.json in the output folder and returned.
+"""
+def convert_batch(spec, force_single_odm=False, options=None):
+    options = options or ConversionOptions()
+    start = time.perf_counter()
+    workbooks = collect_workbooks(spec)
+
+    # one subfolder per study (numbered if two workbooks have the same name)
+    output_dirs = []
+    used = set()
+    for file_path in workbooks:
+        folder = stem = Path(file_path).name.split(".")[0]
+        number = 1
+        while folder in used:
+            number += 1
+            folder = f"{stem}_{number}"
+        used.add(folder)
+        output_dirs.append(options.output_dir / folder)
+
+    tasks = list(zip(workbooks, output_dirs))
+    results = [None] * len(tasks)
+    if options.jobs > 1 and len(tasks) > 1:
+        from concurrent.futures import ProcessPoolExecutor, as_completed
+
+        with ProcessPoolExecutor(max_workers=min(options.jobs, len(tasks))) as executor:
+            futures = {
+                executor.submit(
+                    convert_batch_item, file_path, output_dir, force_single_odm, options
+                ): number
+                for number, (file_path, output_dir) in enumerate(tasks)
+            }
+            for future in as_completed(futures):
+                number = futures[future]
+                try:
+                    results[number] = future.result()
+                except Exception as e:
+                    # the worker process itself failed
+                    file_path, output_dir = tasks[number]
+                    results[number] = {
+                        "file": str(file_path),
+                        "output_dir": str(output_dir),
+                        "status": "failed",
+                        "files": 0,
+                        "error": f"{type(e).__name__}: {e}",
+                        "seconds": None,
+                    }
+                print(_batch_line(results[number]))
+    else:
+        for number, (file_path, output_dir) in enumerate(tasks):
+            results[number] = convert_batch_item(
+                file_path, output_dir, force_single_odm, options
+            )
+            print(_batch_line(results[number]))
+
+    summary = {
+        "workbooks": len(results),
+        "succeeded": sum(result["status"] == "ok" for result in results),
+        "failed": sum(result["status"] != "ok" for result in results),
+        "seconds": time.perf_counter() - start,
+        "results": results,
+    }
+    options.output_dir.mkdir(parents=True, exist_ok=True)
+    with open(options.output_dir / "batch_summary.json", "w", encoding="utf-8") as summary_file:
+        json.dump(summary, summary_file, indent=2)
+    return summary
+
+
+def _batch_line(result):
+    seconds = f"{result['seconds']:.2f}s" if result["seconds"] is not None else "-"
+    line = f"{result['status']:<7} {seconds:>9} {result['files']:>5} files  {result['file']}"
+    if result["error"]:
+        line += f"\n        {result['error']}"
+    return line
+
+
+""" Server """
+
+# study names of the server: safe in the Content-Disposition header and in file names
+STUDY_NAME = re.compile(r"[A-Za-z0-9_.-]{1,128}")
+
+
+"""
+QueueFullError is raised if the request queue of a ConversionServer is full.
+"""
+class QueueFullError(Exception):
+    pass
+
+
+"""
+ConversionServer runs the conversions of the serve mode on a bounded pool of
+worker threads: at most queue_size requests wait for a free worker, more are
+rejected. The libraries are imported once at the start and the caches of the
+process (VALUE_LABELS, missing lists) are shared by all requests.
+"""
+class ConversionServer:
+    def __init__(self, options=None, workers=1, queue_size=16, latency_window=1000):
+        """
+        :param options: Options of every conversion (ConversionOptions)
+        :param workers: Number of conversions running at the same time (int)
+        :param queue_size: Maximum number of requests waiting for a worker (int)
+        :param latency_window: Number of recent requests in the latency statistics (int)
+        """
+        from collections import deque
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.options = options or ConversionOptions()
+        self.workers = max(1, workers)
+        self.queue_size = max(0, queue_size)
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix="conversion"
+        )
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.running = 0
+        self.requests = 0
+        self.errors = 0
+        self.rejected = 0
+        self.latencies = deque(maxlen=latency_window)
+        self.started = time.time()
+
+    def warm_up(self):
+        """
+        Import the libraries of a conversion before the first request.
+        """
+        importlib.import_module("lxml.etree")
+        if self.options.reader == "pandas":
+            importlib.import_module("pandas")
+        engine = self.options.engine or "openpyxl"
         try:
-            varname_number = dictionary_names["VARNAMES"]
-        except KeyError:
-            varname_number = dictionary_names.get("VAR_NAMES", None)
-        if varname_number is None:
-            varname_number = 0
-        # extract the varname
-        varname = row.iloc[varname_number]
-        # extract form name, e.g. s2
-        # hierarchy and studyevent
-        save = list(str(row["HIERARCHY"]).split("|"))
-        string_save = save[0]
-        for i in save:
-            string_save = string_save + "_" + str(i)
-        studyevent = string_save
-        # dce
-        if pd.notna(row.get("DCE", None)):
-            studyevent = row["DCE"]
-        # hierarchy and study_segment
-        save = list(str(row["HIERARCHY"]).split("|"))
-        string_save = save[0]
-        for i in save:
-            string_save = string_save + "_" + str(i)
-        study_segment = string_save
-        # study_segment
-        if pd.notna(row.get("STUDY_SEGMENT", None)):
-            study_segment = row["STUDY_SEGMENT"]
-
-        # 2D dictionary for studyevent and formdef
-        if studyevent not in varname_groups:
-            varname_groups[studyevent] = {}
-        if study_segment not in varname_groups[studyevent]:
-            varname_groups[studyevent][study_segment] = []
-
-        # add the whole line as a list to the key itemgroup
-        varname_groups[studyevent][study_segment].append(row.tolist())
-
-        """ Value Labels/Codelist """
-        # first go through the process that splits the string into key-value-pairs
-        # it returns a dictionary
-        english = {}
-        german = {}
+            importlib.import_module({"calamine": "python_calamine"}.get(engine, engine))
+        except ImportError:
+            pass
+
+    def convert(self, body, name, force_single_odm=False):
+        """
+        Convert a workbook (bytes) and return all ODM files as zip archive (bytes).
+        Raises QueueFullError if no worker and no place in the queue is free.
+        """
+        if not STUDY_NAME.fullmatch(name):
+            raise ConversionError(f"Invalid study name {name!r}, allowed are A-Z a-z 0-9 _ . -")
+        with self._lock:
+            if self.queued + self.running >= self.workers + self.queue_size:
+                self.rejected += 1
+                raise QueueFullError(
+                    f"{self.queued} requests are waiting, try again later"
+                )
+            self.queued += 1
+        start = time.perf_counter()
+        ok = False
         try:
-            english = process_codelist(
-                row.iloc[dictionary_names.get("VALUE_LABELS", None)]
-            ) if dictionary_names.get("VALUE_LABELS", None) is not None else {}
-        except Exception:
-            english = {}
+            archive = self._executor.submit(
+                self._convert, body, name, force_single_odm
+            ).result()
+            ok = True
+            return archive
+        finally:
+            with self._lock:
+                self.requests += 1
+                if not ok:
+                    self.errors += 1
+                self.latencies.append(time.perf_counter() - start)
+
+    def _convert(self, body, name, force_single_odm):
+        with self._lock:
+            self.queued -= 1
+            self.running += 1
         try:
-            german = process_codelist(
-                row.iloc[dictionary_names.get("VALUE_LABELS_DE", None)]
-            ) if dictionary_names.get("VALUE_LABELS_DE", None) is not None else {}
-        except Exception:
-            german = {}
+            # own options, e.g. the metrics must not be shared
+            options = copy.copy(self.options)
+            options.metrics = None
+            date_time = archive_date_time(options.creation_datetime)
+            buffer = io.BytesIO()
+            with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as archive:
 
-        # Codelists
-        if len(english) > 0 or len(german) > 0:
-            # just add the codelist if there isn't an exact codelist yet
-            if not check_codelist(english, german, varname, CodeLists):
-                # of course only append existing codelists (not nulls)
-                if pd.notna(english) or pd.notna(german):
-                    CodeLists.append(CodeList(count_cl, varname, english, german))
-                    count_cl += 1
-        
-        # Missing list name per varname
-        idx = dictionary_names.get("MISSING_LIST_TABLE", None)
-        missing_table_list_val = row.iloc[idx] if idx is not None else None
-        if pd.notna(missing_table_list_val):
-            # get varname (already available)
-            missing_map[str(varname)] = str(missing_table_list_val)
-            # Ensure there is a base CodeList for this varname even if VALUE_LABELS are empty.
-            # This allows emitting a CodeList that consists solely of missing codes.
-            varname_str = str(varname)
-            has_base = any(varname_str in cl.names for cl in CodeLists)
-            if not has_base:
-                CodeLists.append(CodeList(count_cl, varname_str, {}, {}))
-                count_cl += 1
+                def _sink(file_name):
+                    info = zipfile.ZipInfo(file_name, date_time=date_time)
+                    info.compress_type = zipfile.ZIP_DEFLATED
+                    return archive.open(info, "w", force_zip64=True)
 
-    if not force_single_odm:  # write in more than one ODM if needed
-        break_boolean = False
-        # minimum of the hierarchy is 2 because 0 and 1 are SHIP and SHIPx (required)
-        h = 2
-        while not break_boolean:
-            b = False
-            # check the number of items and split by hierarchy
-            hierarchy = []
-            for key, group in varname_groups.items():
-                length = 0
-                for _, items in group.items():
-                    length = length + len(items)
-                    if length > 5700:
-                        b = True
-                        hierarchy.append(key)
-                        break
-            # new sort by hierarchy
-            if hierarchy:
-                if h == 2:
-                    varname_groups = sort_new_hierarchy(
-                        varname_groups,
-                        hierarchy,
-                        df.columns.get_loc("STUDY_SEGMENT"),
-                        df.columns.get_loc("HIERARCHY"),
-                        h,
-                    )
-                if h >= 3:
-                    varname_groups = sort_new_hierarchy2(
-                        varname_groups,
-                        hierarchy,
-                        df.columns.get_loc("STUDY_SEGMENT"),
-                        df.columns.get_loc("HIERARCHY"),
-                        h,
-                    )
-                h += 1
-            # check if the key had changed
-            if not b:
-                break_boolean = True
+                convert_to(io.BytesIO(body), _sink, name, force_single_odm, options)
+            return buffer.getvalue()
+        finally:
+            with self._lock:
+                self.running -= 1
+
+    def health(self):
+        return {
+            "status": "ok",
+            "workers": self.workers,
+            "queue_size": self.queue_size,
+            "uptime_seconds": time.time() - self.started,
+        }
+
+    def metrics(self):
+        with self._lock:
+            latencies = sorted(self.latencies)
+            report = {
+                "requests": self.requests,
+                "errors": self.errors,
+                "rejected": self.rejected,
+                "queue_depth": self.queued,
+                "running": self.running,
+                "workers": self.workers,
+                "queue_size": self.queue_size,
+            }
+
+        def _percentile(share):
+            return latencies[min(len(latencies) - 1, int(share * len(latencies)))]
+
+        report["latency_seconds"] = {
+            "count": len(latencies),
+            "mean": sum(latencies) / len(latencies) if latencies else None,
+            "p50": _percentile(0.5) if latencies else None,
+            "p95": _percentile(0.95) if latencies else None,
+            "max": latencies[-1] if latencies else None,
+        }
+        report["value_labels_cache"] = value_labels_cache.stats()
+        report["missing_list_cache"] = missing_list_cache.stats()
+        report["uptime_seconds"] = time.time() - self.started
+        return report
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+
+"""
+Creates the HTTP server of the serve mode (not started yet):
+
+POST /convert?name=x0&force_single_odm=1  body: the workbook -> zip of the ODM files
+GET  /health                              -> {"status": "ok", ...}
+GET  /metrics                             -> requests, latency, queue depth, caches
+
+Port 0 picks a free port (see server.server_address). The ConversionServer
+is server.conversions.
+"""
+def make_server(options=None, host="127.0.0.1", port=8000, workers=1, queue_size=16):
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from urllib.parse import parse_qs, urlsplit
+
+    conversions = ConversionServer(options, workers, queue_size)
+    conversions.warm_up()
+
+    class ConversionRequestHandler(BaseHTTPRequestHandler):
+        def _send(self, status, body, content_type="application/json", headers=()):
+            if isinstance(body, dict):
+                body = json.dumps(body, indent=2).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            for header, value in headers:
+                self.send_header(header, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            path = urlsplit(self.path).path
+            if path == "/health":
+                self._send(200, conversions.health())
+            elif path == "/metrics":
+                self._send(200, conversions.metrics())
+            else:
+                self._send(404, {"error": f"Unknown path {path}"})
+
+        def do_POST(self):
+            url = urlsplit(self.path)
+            if url.path != "/convert":
+                self._send(404, {"error": f"Unknown path {url.path}"})
+                return
+            query = parse_qs(url.query)
+            name = query.get("name", ["study"])[0]
+            force_single_odm = query.get("force_single_odm", ["0"])[0].lower() in (
+                "1",
+                "true",
+                "yes",
+            )
+            body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            if not STUDY_NAME.fullmatch(name):
+                # the name ends up in a header and in the names of the zip entries
+                self._send(
+                    400, {"error": f"Invalid name {name!r}, allowed are A-Z a-z 0-9 _ . -"}
+                )
+                return
+            try:
+                archive = conversions.convert(body, name, force_single_odm)
+            except QueueFullError as e:
+                self._send(503, {"error": str(e)}, headers=[("Retry-After", "1")])
+            except ConversionError as e:
+                self._send(422, {"error": str(e)})
+            except Exception as e:
+                self._send(500, {"error": f"{type(e).__name__}: {e}"})
+            else:
+                self._send(
+                    200,
+                    archive,
+                    "application/zip",
+                    [("Content-Disposition", f'attachment; filename="Study_{name}.zip"')],
+                )
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), ConversionRequestHandler)
+    server.daemon_threads = True
+    server.conversions = conversions
+    return server
 
-    """ For each Study Event create an ODM """
-    calculate_odm(
-        df,
-        all_sheets,
-        file_name,
-        varname_groups,
-        CodeLists,
-        dictionary_names,
-        varname_number,
-        first_sheet_name,
-        missing_map,
-    )
+
+"""
+Runs the serve mode until it is interrupted (Ctrl+C).
+"""
+def serve(options=None, host="127.0.0.1", port=8000, workers=1, queue_size=16):
+    server = make_server(options, host, port, workers, queue_size)
+    host, port = server.server_address[:2]
+    print(f"Serving on http://{host}:{port} (POST /convert, GET /health, GET /metrics)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.conversions.shutdown()
 
 
 """ 
 Extract sheets and names of the sheets.
 """
 # read the files
-def odm(file_path, file, force_single_odm):
-    # load all sheets
+def odm(file_path, file, force_single_odm, options=None):
+    options = options or ConversionOptions()
+    metrics = options.metrics
+    # load the first sheet and the missing lists
     try:
-        all_sheets = pd.read_excel(file_path, sheet_name=None)
-        # take the first sheet
-        first_sheet_name = list(all_sheets.keys())[0]
-        first_sheet_df = all_sheets[first_sheet_name]
-        # take the other sheets
-        remaining_sheets_dict = {
-            name: df for name, df in all_sheets.items() if name != first_sheet_name
-        }
-        # calculate the odm xml
-        sort_all_lines_and_columns(
-            first_sheet_df, first_sheet_name, remaining_sheets_dict, file, force_single_odm
-        )
+        with metrics_phase(metrics, "odm"):
+            with metrics_phase(metrics, "read_sheets"):
+                first_sheet_name, first_sheet_df, remaining_sheets_dict = read_workbook(
+                    file_path, options.engine, options.reader, options.cache
+                )
+            # calculate the odm xml
+            sort_all_lines_and_columns(
+                first_sheet_df,
+                first_sheet_name,
+                remaining_sheets_dict,
+                file,
+                force_single_odm,
+                options,
+            )
     except Exception as e:
+        if metrics is not None:
+            metrics.error = str(e)
         print(f"Error while reading the file {file}: {e}")
 
 
@@ -971,23 +4810,301 @@ def odm(file_path, file, force_single_odm):
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Convert XLSX → ODM")
 
-    parser.add_argument("file", help="Path to the XLSX file")
+    parser.add_argument(
+        "file",
+        nargs="?",
+        help="Path to the XLSX file, a CSV/Parquet/Feather main table or a directory "
+        "of tables (with --batch: a directory, glob or list file)"
+    )
+    parser.add_argument(
+        "--diff",
+        default=None,
+        help="Old version (workbook, tables or the Study_<name>.definitions.json of an "
+        "earlier --diff): write only the added, changed and removed definitions as "
+        "Transactional ODM; none inserts all definitions (first upload) (optional)"
+    )
+    parser.add_argument(
+        "--plan",
+        default=None,
+        help="Plan file of a sharded conversion: without --shard the Study Events, "
+        "CodeLists and options are planned and written to it, with --shard one "
+        "share of the ODM files of the plan is written (optional)"
+    )
+    parser.add_argument(
+        "--shard",
+        default=None,
+        help="i/N: write the i-th of N shares of the ODM files of --plan, "
+        "e.g. 2/4 (optional)"
+    )
+    parser.add_argument(
+        "--serve",
+        action="store_true",
+        help="Run a local HTTP server converting the workbooks POSTed to /convert "
+        "with --jobs worker threads (optional flag)"
+    )
+    parser.add_argument(
+        "--host", default="127.0.0.1", help="Host of --serve (default: 127.0.0.1)"
+    )
+    parser.add_argument(
+        "--port", type=int, default=8000, help="Port of --serve (default: 8000)"
+    )
+    parser.add_argument(
+        "--queue-size",
+        type=int,
+        default=16,
+        help="Requests of --serve waiting for a worker before new ones are "
+        "rejected with 503 (default: 16)"
+    )
+    parser.add_argument(
+        "--batch",
+        action="store_true",
+        help="Convert all workbooks of a directory, glob pattern or list file, each "
+        "into its own subfolder; --jobs workbooks run in parallel (optional flag)"
+    )
     parser.add_argument(
         "--force_single_odm",
         action="store_true",
         help="Write all items in just one ODM (optional flag)"
     )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Write the ODM files incrementally with constant memory (optional flag)"
+    )
+    parser.add_argument(
+        "--no-pretty",
+        action="store_true",
+        help="Write the XML without indentation (optional flag)"
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of processes writing the Study Event ODMs in parallel (default: 1)"
+    )
+    parser.add_argument(
+        "--engine",
+        choices=["openpyxl", "calamine", "odf", "xlrd", "pyxlsb"],
+        default=None,
+        help="Engine to read the workbook, e.g. calamine (python-calamine) is much faster "
+        "than the default openpyxl (optional)"
+    )
+    parser.add_argument(
+        "--reader",
+        choices=["pandas", "openpyxl"],
+        default="pandas",
+        help="Read the rows with pandas or directly with openpyxl, which does not "
+        "import pandas at all (default: pandas)"
+    )
+    parser.add_argument(
+        "--cache",
+        action="store_true",
+        help="Keep the parsed sheets of the workbook as Parquet in .<workbook>.cache "
+        "next to it and skip the XLSX parsing while the workbook is unchanged "
+        "(optional flag, needs pyarrow, not with --reader openpyxl)"
+    )
+    parser.add_argument(
+        "--emitter",
+        choices=["lxml", "template"],
+        default="lxml",
+        help="Build the XML with lxml elements or render it from string templates "
+        "(faster, same output; optional, default lxml)"
+    )
+    parser.add_argument(
+        "--aliases",
+        default="full",
+        help="Alias profile: full (every column), essential (not the columns that are "
+        "already in the ODM, like LABEL or VALUE_LABELS), none, or a comma-separated "
+        "list of columns; missing-list codes keep their ORIGIN_CODELIST (default: full)"
+    )
+    parser.add_argument(
+        "--group-aliases",
+        action="store_true",
+        help="Write aliases with the same value for all items of a Study Event once "
+        "in its StudyEventDef (optional flag)"
+    )
+    parser.add_argument(
+        "--pipeline",
+        action="store_true",
+        help="Build, serialize and write the ODM files in three overlapping threads "
+        "with bounded queues between them (optional flag, without --jobs)"
+    )
+    parser.add_argument(
+        "--pipeline-depth",
+        type=int,
+        default=PIPELINE_DEPTH,
+        help=f"Study Events waiting between two stages of --pipeline (default: {PIPELINE_DEPTH})"
+    )
+    parser.add_argument(
+        "--max-items",
+        type=int,
+        default=MAX_ITEMS,
+        help=f"Maximum number of items of each ODM file (default: {MAX_ITEMS})"
+    )
+    parser.add_argument(
+        "--max-bytes",
+        type=int,
+        default=None,
+        help="Maximum estimated size of each ODM file in bytes, "
+        "instead of --max-items; an estimate, not a hard cap (optional)"
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only rebuild ODM files whose content changed since the last run, "
+        "using a manifest next to the output folder (optional flag)"
+    )
+    parser.add_argument(
+        "--creation-datetime",
+        default=None,
+        help="Fixed CreationDateTime of the ODM files, e.g. 2024-01-01T00:00:00 "
+        "(default: now)"
+    )
+    parser.add_argument(
+        "--output-dir",
+        default=str(OUTPUT_DIR),
+        help=f"Folder of the ODM files (default: {OUTPUT_DIR})"
+    )
+    parser.add_argument(
+        "--compress",
+        choices=["gzip", "zip"],
+        default=None,
+        help="Write gzip-compressed .xml.gz files, or one zip archive with all ODM files "
+        "(built one after another, not with --jobs, --pipeline or --incremental) (optional)"
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Print the time and memory of every phase, counters and the size "
+        "of every ODM file (optional flag)"
+    )
+    parser.add_argument(
+        "--metrics-json",
+        default=None,
+        help="Write the profile as JSON to this path (optional)"
+    )
+    parser.add_argument(
+        "--trace-memory",
+        action="store_true",
+        help="Also trace the Python peak memory with tracemalloc, slower "
+        "(optional flag, with --profile or --metrics-json)"
+    )
 
     args = parser.parse_args()
+    if args.cache and args.reader == "openpyxl":
+        parser.error("--cache needs --reader pandas")
+    if args.compress == "zip":
+        # one archive, written one Study Event after another
+        if args.pipeline or args.incremental:
+            parser.error("--compress zip cannot be used with --pipeline or --incremental")
+        if args.jobs > 1 and not (args.batch or args.serve):
+            parser.error("--compress zip cannot be used with --jobs (except with --batch)")
 
     file_path = args.file
     force_single_odm = args.force_single_odm
+    options = ConversionOptions(
+        pretty_print=not args.no_pretty,
+        streaming=args.stream,
+        jobs=args.jobs,
+        engine=args.engine,
+        reader=args.reader,
+        cache=args.cache,
+        emitter=args.emitter,
+        pipeline=args.pipeline,
+        pipeline_depth=args.pipeline_depth,
+        alias_profile=(
+            args.aliases
+            if args.aliases in ALIAS_PROFILES
+            else tuple(column.strip() for column in args.aliases.split(",") if column.strip())
+        ),
+        group_aliases=args.group_aliases,
+        max_items=args.max_items,
+        max_bytes=args.max_bytes,
+        incremental=args.incremental,
+        creation_datetime=args.creation_datetime,
+        output_dir=args.output_dir,
+        compress=args.compress,
+    )
+    if args.profile or args.metrics_json:
+        options.metrics = Metrics(trace_memory=args.trace_memory)
 
-    if len(sys.argv) < 2:
+    if args.serve:
+        serve(options, args.host, args.port, args.jobs, args.queue_size)
+    elif args.shard:
+        if not args.plan:
+            parser.error("--shard needs --plan")
+        try:
+            index, count = parse_shard(args.shard)
+        except ValueError as e:
+            parser.error(str(e))
+        try:
+            written = convert_shard(read_plan(args.plan), index, count, file_path, options)
+        except ConversionError as e:
+            print(e)
+            sys.exit(1)
+        print(f"Shard {index}/{count}: {len(written)} ODM files")
+        if args.profile:
+            print(options.metrics.summary())
+        if args.metrics_json:
+            with open(args.metrics_json, "w", encoding="utf-8") as metrics_file:
+                json.dump(options.metrics.to_dict(), metrics_file, indent=2)
+    elif file_path is None:
         print("Please add a path to the xlsx file.")
+    elif args.diff:
+        try:
+            result = convert_diff(
+                None if args.diff == "none" else args.diff, file_path, options=options
+            )
+        except ConversionError as e:
+            print(e)
+            sys.exit(1)
+        for kind, changes in result["counts"].items():
+            print(
+                f"{kind}: {changes['added']} added, {changes['changed']} changed, "
+                f"{changes['removed']} removed"
+            )
+        print(f"{result['delta']}, definitions in {result['definitions']}")
+        if args.profile:
+            print(options.metrics.summary())
+        if args.metrics_json:
+            with open(args.metrics_json, "w", encoding="utf-8") as metrics_file:
+                json.dump(options.metrics.to_dict(), metrics_file, indent=2)
+    elif args.plan:
+        try:
+            plan = plan_conversion(file_path, force_single_odm=force_single_odm, options=options)
+        except ConversionError as e:
+            print(e)
+            sys.exit(1)
+        write_plan(args.plan, plan)
+        print(f"{len(plan['study_events'])} Study Events planned in {args.plan}")
+        if args.profile:
+            print(options.metrics.summary())
+    elif args.batch:
+        try:
+            summary = convert_batch(file_path, force_single_odm, options)
+        except ConversionError as e:
+            print(e)
+            sys.exit(1)
+        print(
+            f"{summary['succeeded']} of {summary['workbooks']} workbooks converted "
+            f"in {summary['seconds']:.2f}s, summary in "
+            f"{options.output_dir / 'batch_summary.json'}"
+        )
+        if args.metrics_json:
+            with open(args.metrics_json, "w", encoding="utf-8") as metrics_file:
+                json.dump(summary, metrics_file, indent=2)
+        if summary["failed"]:
+            sys.exit(1)
     else:
         # file name
         file_name = os.path.basename(file_path)
         # process odm
         print(file_name)
-        odm(file_path, file_name, force_single_odm)
+        odm(file_path, file_name, force_single_odm, options)
+        if args.profile:
+            print(options.metrics.summary())
+        if args.metrics_json:
+            report = options.metrics.to_dict()
+            report["file"] = file_name
+            with open(args.metrics_json, "w", encoding="utf-8") as metrics_file:
+                json.dump(report, metrics_file, indent=2)